@@ -1,14 +1,14 @@
--- Returns the number of users that have not taken an action within ( months 
+-- Returns the users that have not taken an action within {{months}} months 
 -- Also eliminates users that were not imported into ActionKit and the subscription status is subscribed 
 -- script ran in SQL, NOT MySQL
+-- Reads coc_ak.user_last_activity, kept up to date by civis_scripts/user_last_activity.py 
 
 select distinct core_subscription.user_id from coc_ak.core_subscription 
 
-join coc_ak.core_user on (core_subscription.user_id = core_user.id)
-join coc_ak.core_action on (coc_ak.core_user.id = core_action.user_id) 
+join coc_ak.user_last_activity activity on (core_subscription.user_id = activity.user_id) 
 
 where 
-  (select count(*) from coc_ak.core_action as ca where ca.user_id = core_user.id 
-  and ca.source <> 'import' and ca.status = 'complete' and updated_at >= current_date - interval '9 month') < 1
-  and core_subscription.user_id not in (select user_id from coc_ak.core_open where core_open.created_at >= current_date - interval '9 month' )
-  and core_subscription.user_id not in (select user_id from coc_ak.core_order where core_order.created_at >= current_date - interval '9 month')
+  -- last_activity_at is the latest complete non-import action, open or order 
+  activity.last_action_at is not null
+  and (activity.last_activity_at is null 
+       or activity.last_activity_at < dateadd(month, -{{months}}, current_date))
@@ -0,0 +1,249 @@
+"""
+Benchmarks for the sync and DMARC pipelines, run against local stand-in databases.
+
+    python benchmarks/run_benchmarks.py --rows 10000,1000000 --output results.json
+
+The read path (keyset vs offset pagination) runs on SQLite. The full, append and
+incremental syncs need a Postgres database, configured with the usual parsons
+``POSTGRES_*`` environment variables, and run when ``--postgres`` is given. DMARC
+ingestion runs a synthetic report corpus through the download, decompress, parse and
+batch stages up to the Redshift COPY. Results are written as JSON, one record per
+benchmark, so runs on different commits can be compared. ``baseline.json`` holds the
+baseline run of the SQLite read path and DMARC benchmarks (``--rows
+10000,100000,1000000 --chunk-size 10000``).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'civis_scripts'))
+
+import synthetic
+from sqlite_db import SQLiteDB
+from ak_db_sync import iter_new_row_chunks, table_sync_incremental_upsert
+from sync_metrics import SyncMetrics
+from dmarc_script import LocalBucket, fetch_reports, batch_report_rows
+from parsons import Postgres, DBSync
+
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+SYNC_TABLES = ['core_user', 'core_action', 'core_open']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result(benchmark, seconds, rows=None, **fields):
+    record = {'benchmark': benchmark, 'seconds': round(seconds, 4), 'rows': rows,
+              'rows_per_second': round(rows / seconds, 1) if rows and seconds else None}
+    record.update(fields)
+    logger.info(f"{benchmark} {fields}: {seconds:.2f}s"
+                f"{'' if not rows else f', {rows} rows'}")
+    return record
+
+
+def bench_read_path(rows, workdir, chunk_size, max_offset_rows):
+    """
+    Time reading every row of ``core_action`` from SQLite with keyset and offset
+    pagination.
+    """
+
+    results = []
+    db = SQLiteDB(os.path.join(workdir, f"read_path_{rows}.db"))
+    db.query(synthetic.table_ddl('core_action'))
+    db.query("CREATE INDEX core_action_updated ON core_action (updated_at, id)")
+    synthetic.load_sqlite(db._conn, 'core_action', synthetic.generate_rows('core_action', rows))
+
+    for pagination in ('keyset', 'offset'):
+        if pagination == 'offset' and rows > max_offset_rows:
+            continue
+
+        start = time.perf_counter()
+        read = 0
+        for chunk in iter_new_row_chunks(db, 'core_action', 'updated_at', 'id',
+                                         chunk_size=chunk_size, pagination=pagination,
+                                         new_row_count=rows):
+            read += chunk.rows.num_rows
+        results.append(result('read_path', time.perf_counter() - start, read,
+                              backend='sqlite', pagination=pagination, table_rows=rows,
+                              chunk_size=chunk_size))
+
+    db.close()
+    return results
+
+
+def reset_postgres(pg, rows):
+    with pg.connection() as connection:
+        with connection.cursor() as cursor:
+            for schema in ('bench_source', 'bench_dest'):
+                cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+                cursor.execute(f"CREATE SCHEMA {schema}")
+            for t in SYNC_TABLES:
+                cursor.execute(synthetic.table_ddl(t, f"bench_source.{t}"))
+        connection.commit()
+
+        for t in SYNC_TABLES:
+            synthetic.load_postgres(connection, t, synthetic.generate_rows(t, rows),
+                                    name=f"bench_source.{t}")
+
+
+def bench_syncs(rows, chunk_size, change_fraction):
+    """
+    Time full, append and incremental syncs of the synthetic tables between two
+    Postgres schemas. The append and incremental syncs run after ``change_fraction``
+    of the rows have been added (append) or added and updated (incremental).
+    """
+
+    results = []
+    pg = Postgres()
+
+    start = time.perf_counter()
+    reset_postgres(pg, rows)
+    results.append(result('generate', time.perf_counter() - start, rows * len(SYNC_TABLES),
+                          backend='postgres', table_rows=rows))
+
+    dbsync = DBSync(pg, pg)
+    dbsync.chunk_size = chunk_size
+    changed = max(int(rows * change_fraction), 1)
+
+    # Full syncs of every table
+    for t in SYNC_TABLES:
+        start = time.perf_counter()
+        dbsync.table_sync_full(f"bench_source.{t}", f"bench_dest.{t}")
+        results.append(result('sync_full', time.perf_counter() - start, rows,
+                              backend='postgres', table=t, table_rows=rows))
+
+    # Append sync of new rows
+    with pg.connection() as connection:
+        synthetic.load_postgres(connection, 'core_action',
+                                synthetic.generate_rows('core_action', changed, start_id=rows + 1),
+                                name='bench_source.core_action')
+    start = time.perf_counter()
+    dbsync.table_sync_incremental('bench_source.core_action', 'bench_dest.core_action',
+                                  primary_key='id')
+    results.append(result('sync_append', time.perf_counter() - start, changed,
+                          backend='postgres', table='core_action', table_rows=rows))
+
+    # Incremental upsert of new and updated rows
+    with pg.connection() as connection:
+        synthetic.load_postgres(connection, 'core_action',
+                                synthetic.generate_rows('core_action', changed,
+                                                        start_id=rows + changed + 1),
+                                name='bench_source.core_action')
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE bench_source.core_action SET updated_at = now() "
+                           "WHERE id %% %s = 0", [max(int(1 / change_fraction), 1)])
+        connection.commit()
+
+    metrics = SyncMetrics()
+    start = time.perf_counter()
+    table_sync_incremental_upsert(dbsync, 'bench_source.core_action', 'bench_dest.core_action',
+                                  primary_key='id', updated_col='updated_at',
+                                  merge_mode='stage', vacuum=False, metrics=metrics)
+    results.append(result('sync_incremental', time.perf_counter() - start, changed * 2,
+                          backend='postgres', table='core_action', table_rows=rows,
+                          phases=metrics.summary()))
+
+    return results
+
+
+def bench_dmarc(workdir, files, records_per_file, compression, fetch_workers, parse_processes):
+    """
+    Time DMARC ingestion of a synthetic corpus through the download, decompress, parse
+    and batch stages.
+    """
+
+    bucket = 'dmarc-files'
+    corpus = os.path.join(workdir, 'dmarc', bucket)
+    corpus_bytes = synthetic.write_dmarc_corpus(corpus, files, records_per_file,
+                                                compression=compression)
+
+    s3 = LocalBucket(os.path.dirname(corpus))
+    keys = s3.list_keys(bucket)
+
+    start = time.perf_counter()
+    records = 0
+    batches = 0
+    for _, batch_rows in batch_report_rows(fetch_reports(s3, bucket, keys,
+                                                         max_workers=fetch_workers,
+                                                         parse_processes=parse_processes)):
+        records += len(batch_rows)
+        batches += 1
+
+    shutil.rmtree(os.path.dirname(corpus))
+    return [result('dmarc_ingest', time.perf_counter() - start, records, files=files,
+                   records_per_file=records_per_file, compression=compression or 'none',
+                   corpus_bytes=corpus_bytes, batches=batches, fetch_workers=fetch_workers,
+                   parse_processes=parse_processes)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', default='10000',
+                        help='Comma separated table sizes, e.g. 10000,1000000,10000000')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--max-offset-rows', type=int, default=1000000,
+                        help='Skip offset pagination on tables bigger than this')
+    parser.add_argument('--postgres', action='store_true',
+                        help='Run the sync benchmarks against the POSTGRES_* database')
+    parser.add_argument('--change-fraction', type=float, default=0.01)
+    parser.add_argument('--dmarc-files', type=int, default=200)
+    parser.add_argument('--dmarc-records', type=int, default=50)
+    parser.add_argument('--dmarc-compression', choices=['none', 'gz', 'zip'], default='gz')
+    parser.add_argument('--dmarc-fetch-workers', type=int, default=8)
+    parser.add_argument('--dmarc-parse-processes', type=int, default=0)
+    parser.add_argument('--output', help='File to write the JSON results to. Defaults to stdout.')
+    args = parser.parse_args()
+
+    # The pipelines log every chunk; only keep their warnings
+    for name in ('ak_db_sync', 'sync_metrics', 'dmarc_script'):
+        logging.getLogger(name).setLevel('WARNING')
+
+    workdir = tempfile.mkdtemp(prefix='coc_bench_')
+    results = []
+    try:
+        for rows in (int(r) for r in args.rows.split(',')):
+            results += bench_read_path(rows, workdir, args.chunk_size, args.max_offset_rows)
+            if args.postgres:
+                results += bench_syncs(rows, args.chunk_size, args.change_fraction)
+
+        if args.dmarc_files:
+            compression = None if args.dmarc_compression == 'none' else args.dmarc_compression
+            results += bench_dmarc(workdir, args.dmarc_files, args.dmarc_records, compression,
+                                   args.dmarc_fetch_workers, args.dmarc_parse_processes)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {'commit': git_commit(),
+              'run_at': datetime.datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, default=str)
+    else:
+        print(json.dumps(output, indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import re
+import sqlite3
+from contextlib import contextmanager
+from parsons import Table
+
+# psycopg2-style placeholders, rewritten to SQLite's
+PLACEHOLDER = re.compile(r'%s')
+
+
+class SQLiteDB:
+    """
+    A SQLite stand-in for the parsons database connectors, with just the methods the
+    sync read path calls (``query``, ``query_with_connection``, ``connection``,
+    ``table_exists`` and ``copy``), so it can be benchmarked without a server.
+    `Args:`
+        path: str
+            Path of the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.host = 'localhost'
+        self.db = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    @contextmanager
+    def connection(self):
+        yield self._conn
+
+    def query(self, sql, parameters=None):
+        return self.query_with_connection(sql, self._conn, parameters=parameters)
+
+    def query_with_connection(self, sql, connection, parameters=None, commit=True):
+        cursor = connection.execute(PLACEHOLDER.sub('?', sql), parameters or [])
+        if commit:
+            connection.commit()
+
+        if cursor.description is None:
+            return None
+
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        return Table([dict(zip(columns, r)) for r in rows])
+
+    def table_exists(self, table_name):
+        row = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (table_name,)).fetchone()
+        return row is not None
+
+    def copy(self, tbl, table_name, if_exists='fail', **copy_args):
+        if self.table_exists(table_name):
+            if if_exists == 'fail':
+                raise ValueError(f"Table {table_name} already exists")
+            if if_exists == 'drop':
+                self._conn.execute(f"DROP TABLE {table_name}")
+            elif if_exists == 'truncate':
+                self._conn.execute(f"DELETE FROM {table_name}")
+
+        columns = list(tbl.columns)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)})")
+        self._conn.executemany(
+            f"INSERT INTO {table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [tuple(row[c] for c in columns) for row in tbl])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
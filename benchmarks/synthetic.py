@@ -0,0 +1,237 @@
+import io
+import os
+import csv
+import gzip
+import random
+import zipfile
+import datetime
+
+# Columns of the synthetic ActionKit-shaped tables, in insert order. The types are
+# shared by Postgres and SQLite.
+ACTIONKIT_TABLES = {
+    'core_user': [('id', 'bigint'), ('email', 'varchar(255)'), ('first_name', 'varchar(64)'),
+                  ('last_name', 'varchar(64)'), ('city', 'varchar(64)'), ('state', 'varchar(8)'),
+                  ('subscription_status', 'varchar(32)'), ('created_at', 'timestamp'),
+                  ('updated_at', 'timestamp')],
+    'core_action': [('id', 'bigint'), ('user_id', 'bigint'), ('page_id', 'bigint'),
+                    ('mailing_id', 'bigint'), ('source', 'varchar(64)'),
+                    ('status', 'varchar(32)'), ('created_at', 'timestamp'),
+                    ('updated_at', 'timestamp')],
+    'core_open': [('id', 'bigint'), ('user_id', 'bigint'), ('mailing_id', 'bigint'),
+                  ('created_at', 'timestamp'), ('updated_at', 'timestamp')],
+}
+
+START_TIME = datetime.datetime(2020, 1, 1)
+STATES = ['CA', 'NY', 'TX', 'IL', 'GA', 'FL', 'WA', 'MI']
+SOURCES = ['website', 'mailing', 'import', 'facebook', 'twitter']
+
+def table_ddl(table, name=None):
+    """
+    Build the CREATE TABLE statement of a synthetic table.
+    `Args:`
+        table: str
+            One of ``ACTIONKIT_TABLES``
+        name: str
+            The table path to create. Defaults to ``table``.
+    `Returns:`
+        str
+    """
+
+    columns = ', '.join(f"{c} {t}" for c, t in ACTIONKIT_TABLES[table])
+    return f"CREATE TABLE {name or table} ({columns}, PRIMARY KEY (id))"
+
+def generate_rows(table, count, start_id=1, seed=0, start_time=START_TIME):
+    """
+    Generate rows for a synthetic table. Rows are deterministic for a seed, and
+    ``updated_at`` increases with ``id`` like it does for rows appended by ActionKit.
+    `Args:`
+        table: str
+            One of ``ACTIONKIT_TABLES``
+        count: int
+            The number of rows
+        start_id: int
+            The id of the first row
+        seed: int
+            The random seed
+        start_time: datetime
+            The ``created_at`` of the first row
+    `Returns:`
+        Generator of tuples in ``ACTIONKIT_TABLES`` column order
+    """
+
+    rng = random.Random(seed + start_id)
+
+    for i in range(start_id, start_id + count):
+        created_at = start_time + datetime.timedelta(seconds=i * 7)
+        updated_at = created_at + datetime.timedelta(seconds=rng.randint(0, 6))
+
+        if table == 'core_user':
+            yield (i, f"user{i}@example.org", f"First{i % 997}", f"Last{i % 991}",
+                   f"City{i % 500}", rng.choice(STATES),
+                   rng.choice(['subscribed', 'unsubscribed', 'never', 'bounced']),
+                   created_at, updated_at)
+        elif table == 'core_action':
+            yield (i, rng.randint(1, max(count // 10, 1)), rng.randint(1, 2000),
+                   rng.choice([None, rng.randint(1, 5000)]), rng.choice(SOURCES),
+                   rng.choice(['complete', 'complete', 'complete', 'incomplete']),
+                   created_at, updated_at)
+        elif table == 'core_open':
+            yield (i, rng.randint(1, max(count // 10, 1)), rng.randint(1, 5000),
+                   created_at, updated_at)
+        else:
+            raise ValueError(f"Unknown synthetic table {table}")
+
+def load_sqlite(conn, table, rows, name=None, batch_size=50000):
+    """
+    Insert generated rows into a SQLite table.
+    `Args:`
+        conn: sqlite3.Connection
+            The SQLite connection
+        table: str
+            One of ``ACTIONKIT_TABLES``
+        rows: iterable
+            Rows from ``generate_rows``
+        name: str
+            The table to insert into. Defaults to ``table``.
+        batch_size: int
+            The number of rows per ``executemany``
+    """
+
+    placeholders = ', '.join('?' for _ in ACTIONKIT_TABLES[table])
+    sql = f"INSERT INTO {name or table} VALUES ({placeholders})"
+
+    batch = []
+    for row in rows:
+        batch.append(tuple(v.isoformat(' ') if isinstance(v, datetime.datetime) else v
+                           for v in row))
+        if len(batch) >= batch_size:
+            conn.executemany(sql, batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+    conn.commit()
+
+def load_postgres(connection, table, rows, name=None, batch_size=100000):
+    """
+    Stream generated rows into a Postgres table with ``COPY FROM STDIN``.
+    `Args:`
+        connection: psycopg2 connection
+            The Postgres connection
+        table: str
+            One of ``ACTIONKIT_TABLES``
+        rows: iterable
+            Rows from ``generate_rows``
+        name: str
+            The table to copy into. Defaults to ``table``.
+        batch_size: int
+            The number of rows per ``COPY``
+    """
+
+    columns = ', '.join(c for c, _ in ACTIONKIT_TABLES[table])
+    sql = f"COPY {name or table} ({columns}) FROM STDIN WITH (FORMAT csv)"
+
+    def flush(buffer):
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, buffer)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= batch_size:
+            flush(buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            pending = 0
+    if pending:
+        flush(buffer)
+    connection.commit()
+
+def dmarc_report_xml(report_id, records, seed=0):
+    """
+    Build a synthetic DMARC 2.0 aggregate report.
+    `Args:`
+        report_id: str
+            The report id
+        records: int
+            The number of ``<record>`` elements
+        seed: int
+            The random seed
+    `Returns:`
+        bytes
+    """
+
+    rng = random.Random(f"{seed}-{report_id}")
+    begin = int(START_TIME.timestamp()) + rng.randint(0, 365) * 86400
+    domain = rng.choice(['example.org', 'example.com', 'example.net'])
+
+    parts = ['<?xml version="1.0" encoding="UTF-8" ?>\n'
+             '<feedback xmlns="urn:ietf:params:xml:ns:dmarc-2.0">'
+             '<report_metadata><org_name>example-receiver.com</org_name>'
+             '<email>dmarc@example-receiver.com</email>'
+             f'<report_id>{report_id}</report_id>'
+             f'<date_range><begin>{begin}</begin><end>{begin + 86399}</end></date_range>'
+             '</report_metadata>'
+             f'<policy_published><domain>{domain}</domain><adkim>r</adkim><aspf>r</aspf>'
+             '<p>none</p><sp>none</sp><pct>100</pct></policy_published>']
+
+    for _ in range(records):
+        ip = '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+        dkim = rng.choice(['pass', 'fail'])
+        spf = rng.choice(['pass', 'fail'])
+        parts.append(
+            f'<record><row><source_ip>{ip}</source_ip><count>{rng.randint(1, 50)}</count>'
+            f'<policy_evaluated><disposition>none</disposition><dkim>{dkim}</dkim>'
+            f'<spf>{spf}</spf></policy_evaluated></row>'
+            f'<identifiers><header_from>{domain}</header_from></identifiers>'
+            f'<auth_results><dkim><domain>{domain}</domain><result>{dkim}</result></dkim>'
+            f'<spf><domain>{domain}</domain><result>{spf}</result></spf></auth_results>'
+            '</record>')
+
+    parts.append('</feedback>')
+    return ''.join(parts).encode()
+
+def write_dmarc_corpus(directory, files, records_per_file, compression=None, seed=0):
+    """
+    Write a corpus of synthetic DMARC reports.
+    `Args:`
+        directory: str
+            The directory to write the reports to
+        files: int
+            The number of reports
+        records_per_file: int
+            The number of records in each report
+        compression: str
+            ``None`` for plain XML, ``gz`` or ``zip``
+        seed: int
+            The random seed
+    `Returns:`
+        The total size of the written files in bytes
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    total_bytes = 0
+
+    for i in range(files):
+        report_id = f"bench-{seed}-{i}"
+        xml = dmarc_report_xml(report_id, records_per_file, seed=seed)
+
+        if compression == 'gz':
+            path = os.path.join(directory, f"{report_id}.xml.gz")
+            with gzip.open(path, 'wb') as f:
+                f.write(xml)
+        elif compression == 'zip':
+            path = os.path.join(directory, f"{report_id}.zip")
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(f"{report_id}.xml", xml)
+        else:
+            path = os.path.join(directory, f"{report_id}.xml")
+            with open(path, 'wb') as f:
+                f.write(xml)
+
+        total_bytes += os.path.getsize(path)
+
+    return total_bytes
@@ -3,8 +3,21 @@ import os
 import logging
 import ast
 import time
+import queue
+import itertools
+import collections
+import threading
+import uuid
+import math
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from parsons import Redshift, MySQL, Postgres, DBSync, S3
+from sync_state import SyncStateStore, db_identity
+from sync_metrics import SyncMetrics
+from schema_cache import SchemaCache, column_type_sql
+from columnar_transfer import (fetch_arrow, load_arrow, unload_to_s3, load_unloaded_parquet,
+                               remove_s3_keys, quote_column)
 
 # Define the default logging config for Canales scripts
 logger = logging.getLogger(__name__)
@@ -17,6 +30,14 @@ logger.setLevel('INFO')
 TMC_CIVIS_DATABASE = 815
 TMC_CIVIS_DATABASE_NAME = 'TMC'
 
+# Maximum number of table syncs allowed to touch each database type at once
+DEFAULT_DB_TYPE_CONCURRENCY = {'redshift': 4, 'mysql': 2, 'postgres': 4}
+
+# Ways of checking that a source primary key is distinct, see check_distinct_key
+DISTINCT_CHECK_MODES = ('full', 'window', 'approx', 'scheduled')
+# Number of hash bits picking a HyperLogLog register (4096 registers)
+HLL_PRECISION = 12
+
 RESERVED_WORDS = ['AES128', 'AES256', 'ALL', 'ALLOWOVERWRITE', 'ANALYSE', 'ANALYZE', 'AND', 'ANY',
                   'ARRAY', 'AS', 'ASC', 'AUTHORIZATION', 'BACKUP', 'BETWEEN', 'BINARY',
                   'BLANKSASNULL', 'BOTH', 'BYTEDICT', 'BZIP2', 'CASE', 'CAST', 'CHECK', 'COLLATE',
@@ -96,7 +117,8 @@ def setup_environment(redshift_parameter="REDSHIFT", aws_parameter="AWS"):
     set_env_var('AWS_ACCESS_KEY_ID', env.get(f'{aws_parameter}_USERNAME'))
     set_env_var('AWS_SECRET_ACCESS_KEY', env.get(f'{aws_parameter}_PASSWORD'))
 
-def get_new_rows(table, db, primary_key, cutoff_value, offset=0, chunk_size=None):
+def get_new_rows(table, db, primary_key, cutoff_value, offset=0, chunk_size=None,
+                 select_list='*'):
         """
         Get rows that have a greater primary key value than the one
         provided.
@@ -110,7 +132,7 @@ def get_new_rows(table, db, primary_key, cutoff_value, offset=0, chunk_size=None
 
         sql = f"""
                SELECT
-               *
+               {select_list}
                FROM {table}
                {where_clause}
                """
@@ -122,219 +144,2335 @@ def get_new_rows(table, db, primary_key, cutoff_value, offset=0, chunk_size=None
 
         return db.query(sql)
 
-def table_sync_incremental_upsert(self, source_table, destination_table, primary_key,
-                               updated_col, distinct_check=True, **kwargs):
+def get_new_rows_keyset(table, db, updated_col, primary_key, cutoff_value=None,
+                        last_key=None, chunk_size=None, select_list='*'):
     """
-    Incremental sync of table from a source database to a destination database
-    using an incremental primary key.
+    Get the next chunk of rows ordered by ``(updated_col, primary_key)``, seeking past
+    the last key tuple seen instead of using an OFFSET. Each chunk only scans the rows
+    it returns, so the cost of a backfill is linear in the number of new rows.
 
     `Args:`
-        source_table: str
-            Full table path (e.g. ``my_schema.my_table``)
-        destination_table: str
+        table: str
             Full table path (e.g. ``my_schema.my_table``)
-        if_exists: str
-            If destination table exists either ``drop`` or ``truncate``. Truncate is
-            useful when there are dependent views associated with the table.
+        db: object
+            The parsons database connector to query
+        updated_col: str
+            The name of the last updated column
         primary_key: str
-            The name of the primary key. This must be the same for the source and
-            destination table.
-        distinct_check: bool
-            Check that the source table primary key is distinct prior to running the
-            sync. If it is not, an error will be raised.
-        **kwargs: args
-            Optional copy arguments for destination database.
+            The name of the primary key, used to break ties on ``updated_col``
+        cutoff_value: str
+            Only return rows with ``updated_col`` greater than or equal to this value.
+            Ignored once ``last_key`` is provided.
+        last_key: tuple
+            The ``(updated_col, primary_key)`` values of the last row of the previous
+            chunk. Only rows strictly after this tuple are returned.
+        chunk_size: int
+            The maximum number of rows to return
+        select_list: str
+            The columns to select
     `Returns:`
-        ``None``
+        Parsons Table or ``None``
     """
 
-    # Create the table objects
-    source_tbl = self.source_db.table(source_table)
-    destination_tbl = self.dest_db.table(destination_table)
+    sql, parameters = keyset_query(table, updated_col, primary_key, cutoff_value=cutoff_value,
+                                   last_key=last_key, chunk_size=chunk_size,
+                                   select_list=select_list)
+    return db.query(sql, parameters=parameters or None)
 
-    # Check that the destination table exists. If it does not, then run a
-    # full sync instead.
-    if not destination_tbl.exists:
-        self.table_sync_full(source_table, destination_table)
+def keyset_query(table, updated_col, primary_key, cutoff_value=None, last_key=None,
+                 chunk_size=None, select_list='*'):
+    """
+    Build the query for the next keyset chunk of a table. See ``get_new_rows_keyset``.
+    `Returns:`
+        ``(sql, parameters)`` tuple
+    """
 
-    # If the source table contains 0 rows, do not attempt to copy the table.
-    if source_tbl.num_rows == 0:
-        logger.info('Source table contains 0 rows')
-        return None
+    parameters = []
 
-    # Check that the source table primary key is distinct
-    if distinct_check and not source_tbl.distinct_primary_key(primary_key):
-        raise ValueError(f'{primary_key} is not distinct in source table.')
+    # Rows without an updated value have no place in the keyset order and could never
+    # be sought past, so they are left out
+    if last_key is not None:
+        last_updated, last_pk = last_key
+        # Expanded form of (updated_col, primary_key) > (last_updated, last_pk), as
+        # Redshift does not support row value comparisons.
+        where_clause = (f"where {updated_col} is not null and ({updated_col} > %s "
+                        f"or ({updated_col} = %s and {primary_key} > %s))")
+        parameters.extend([last_updated, last_updated, last_pk])
+    elif cutoff_value is not None:
+        where_clause = f"where {updated_col} >= %s"
+        parameters.append(cutoff_value)
+    else:
+        where_clause = f"where {updated_col} is not null"
 
-    # Get the max source table and destination table primary key
-    dest_max_updated = destination_tbl.max_primary_key(updated_col)
-    dest_max_updated = self.dest_db.query(
-        f"SELECT CAST(MAX({updated_col}) AS DATETIME) FROM {destination_table}"
-    ).first
-    source_max_updated = self.source_db.query(
-        f"SELECT CAST(MAX({updated_col}) AS DATETIME) FROM {source_table}"
-    ).first
-
-    # Check for a mismatch in row counts; if dest_max_pk is None, or destination is empty
-    # and we don't have to worry about this check.
-
-    if dest_max_updated is not None and dest_max_updated > source_max_updated:
-        # raise ValueError('Destination DB table updated later than source DB table.')
-        logger.info('Destination DB table updated later than source DB table.')
-        return None
+    sql = f"""
+           SELECT
+           {select_list}
+           FROM {table}
+           {where_clause}
+           ORDER BY {updated_col}, {primary_key}
+           """
 
-    # Do not copied if row counts are equal.
-    elif dest_max_updated == source_max_updated:
-        logger.info('Tables are in sync.')
-        return None
+    if chunk_size:
+        sql += f" LIMIT {chunk_size}"
 
-    else:
-        # Get count of rows to be copied.
-        if dest_max_updated is not None:
-            new_row_count = source_tbl.get_new_rows_count(updated_col, str(dest_max_updated))
+    return sql, parameters
+
+# A chunk of new rows read from a source table, and the chunk size it was read with
+Chunk = collections.namedtuple('Chunk', ['rows', 'start_key', 'last_key', 'read_seconds',
+                                         'rename_seconds', 'size'])
+
+def estimate_chunk_bytes(rows, sample_size=100):
+    """
+    Estimate the size of a chunk in bytes from the text width of its first rows.
+    `Args:`
+        rows: Parsons Table
+            The chunk
+        sample_size: int
+            The number of rows to measure
+    `Returns:`
+        int
+    """
+
+    row_count = rows.num_rows
+    sample = list(itertools.islice(rows, min(sample_size, row_count)))
+    if not sample:
+        return 0
+
+    sample_bytes = sum(len(str(v)) for row in sample for v in row.values() if v is not None)
+    return int(sample_bytes / len(sample) * row_count)
+
+class ChunkSizeController:
+    """
+    Picks the size of the next chunk of a sync from the measured cost of the previous
+    ones. Each chunk is resized so it takes about ``target_seconds`` to read or write,
+    whichever is slower, and never holds more than ``max_bytes``. Steps are capped at
+    halving or doubling, so one slow chunk does not swing the size wildly.
+
+    With prefetching, the chunks already read ahead were sized before the current one
+    was recorded, so a new size only reaches the source up to ``max_in_flight + 1``
+    chunks later. Each chunk is recorded with the size it was read with, so the chunks
+    still in flight resize from their own size instead of compounding one step on
+    another.
+
+    `Args:`
+        initial_size: int
+            The size of the first chunk
+        min_size: int
+            The smallest chunk size to use
+        max_size: int
+            The largest chunk size to use
+        target_seconds: float
+            The target time to read or write one chunk
+        max_bytes: int
+            The largest estimated chunk size in bytes
+    """
+
+    def __init__(self, initial_size, min_size=1000, max_size=1000000, target_seconds=60,
+                 max_bytes=512 * 1024 * 1024):
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.target_seconds = float(target_seconds)
+        self.max_bytes = int(max_bytes)
+        self.size = self._clamp(initial_size)
+        self.best_size = self.size
+        self.best_rows_per_second = 0
+
+    def _clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def record(self, rows, nbytes, read_seconds, write_seconds, size=None):
+        """
+        Record the cost of a chunk and resize the next one.
+        `Args:`
+            rows: int
+                The number of rows in the chunk
+            nbytes: int
+                The estimated size of the chunk in bytes
+            read_seconds: float
+                The time taken to read the chunk from the source
+            write_seconds: float
+                The time taken to write the chunk to the destination
+            size: int
+                The chunk size the chunk was read with. Defaults to the current size.
+        """
+
+        if not rows:
+            return
+
+        size = size or self.size
+
+        seconds = max(read_seconds, write_seconds, 0.001)
+        rows_per_second = rows / seconds
+
+        # Only a full chunk says anything about how the current size performs
+        if rows >= size and rows_per_second > self.best_rows_per_second:
+            self.best_rows_per_second = rows_per_second
+            self.best_size = size
+
+        scale = max(0.5, min(2.0, self.target_seconds / seconds))
+        new_size = size * scale
+
+        if nbytes:
+            new_size = min(new_size, self.max_bytes / (nbytes / rows))
+
+        new_size = self._clamp(new_size)
+        if new_size != self.size:
+            logger.info(f"Chunk of {rows} rows ({nbytes / 1024 / 1024:.1f} MB) took "
+                        f"{read_seconds:.1f}s to read and {write_seconds:.1f}s to write. "
+                        f"Next chunk size: {new_size}")
+        self.size = new_size
+
+def iter_new_row_chunks(source_db, table, updated_col, primary_key, cutoff_value=None,
+                        chunk_size=None, pagination='keyset', new_row_count=None,
+                        last_key=None, select_list='*'):
+    """
+    Iterate over the chunks of new rows in a source table, with any columns named after
+    Redshift reserved words already renamed.
+
+    `Args:`
+        source_db: object
+            The parsons database connector to read from
+        table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        updated_col: str
+            The name of the last updated column
+        primary_key: str
+            The name of the primary key
+        cutoff_value: str
+            Only return rows with ``updated_col`` greater than or equal to this value
+        chunk_size: int or ChunkSizeController
+            The maximum number of rows in a chunk. A ``ChunkSizeController`` is asked
+            for its current size before every read, and the size is passed on in the
+            ``Chunk`` to record the chunk with.
+        pagination: str
+            ``keyset`` or ``offset``. See ``table_sync_incremental_upsert``.
+        new_row_count: int
+            The number of rows to read. Required for ``offset`` pagination, which has
+            no other way to know when to stop.
+        last_key: tuple
+            Resume ``keyset`` pagination after this ``(updated_col, primary_key)`` tuple
+        select_list: str
+            The columns to select. A projection that already selects every column
+            under its destination name (see ``projection_select_list``) saves renaming
+            the columns of every chunk.
+    `Returns:`
+        Generator of ``Chunk`` tuples. ``start_key`` is the key the chunk was read after
+        (``None`` for the first chunk) and ``last_key`` is the ``(updated_col,
+        primary_key)`` tuple of the last row in the chunk.
+    """
+
+    read_rows = 0
+
+    while True:
+        if isinstance(chunk_size, ChunkSizeController):
+            size = chunk_size.size
         else:
-            new_row_count = source_tbl.num_rows
+            size = chunk_size
+        read_start = time.time()
 
-        logger.info(f'Found {new_row_count} updated rows in source table since {str(dest_max_updated)}')
+        # Get a chunk
+        if pagination == 'keyset':
+            logger.info(f"KEYSET: {last_key} ({read_rows} rows read)")
+            rows = get_new_rows_keyset(table, source_db, updated_col, primary_key,
+                                       cutoff_value=cutoff_value, last_key=last_key,
+                                       chunk_size=size, select_list=select_list)
+        else:
+            if read_rows >= new_row_count:
+                return
+            logger.info(f"OFFSET: {read_rows}")
+            rows = get_new_rows(table, source_db, primary_key=updated_col,
+                                cutoff_value=cutoff_value,
+                                offset=read_rows,
+                                chunk_size=size, select_list=select_list)
 
-        copied_rows = 0
-        # Copy rows in chunks.
-        while copied_rows < new_row_count:
-            # Get a chunk
-            logger.info(f"OFFSET: {copied_rows}")
-            rows = get_new_rows(source_tbl.table, self.source_db, primary_key=updated_col,
-                                           cutoff_value=str(dest_max_updated),
-                                           offset=copied_rows,
-                                           chunk_size=self.chunk_size)
+        row_count = rows.num_rows if rows else 0
+        if row_count == 0:
+            return
 
-            row_count = rows.num_rows if rows else 0
-            if row_count == 0:
-                break
+        read_seconds = time.time() - read_start
 
+        rename_start = time.time()
+        if select_list == '*':
             for c in rows.columns:
                 if c.upper() in RESERVED_WORDS:
                     rows.rename_column(c, f"{c}_col")
+        rename_seconds = time.time() - rename_start
+
+        # Remember where this chunk ended, under the destination column names
+        start_key = last_key
+        last_row = rows[row_count - 1]
+        last_key = (last_row[reserved_column_name(updated_col)],
+                    last_row[reserved_column_name(primary_key)])
+
+        read_rows += row_count
+        yield Chunk(rows, start_key, last_key, read_seconds, rename_seconds, size)
+
+        # A short chunk means there is nothing left past the last key
+        if pagination == 'keyset' and size and row_count < size:
+            return
+
+def iter_arrow_chunks(source_db, table, updated_col, primary_key, select_list, cutoff_value=None,
+                      chunk_size=None, last_key=None):
+    """
+    Iterate over the keyset chunks of new rows in a source table as Arrow tables,
+    fetched column by column from the cursor. Columns are renamed to their destination
+    names by the ``select_list`` (see ``projection_select_list``).
+
+    Takes the same arguments and yields the same ``Chunk`` tuples as the keyset path
+    of ``iter_new_row_chunks``, with a ``pyarrow.Table`` for the rows.
+    """
+
+    # The rows carry destination column names; the query orders by source names
+    updated_name = reserved_column_name(updated_col)
+    primary_key_name = reserved_column_name(primary_key)
+    read_rows = 0
+
+    while True:
+        if isinstance(chunk_size, ChunkSizeController):
+            size = chunk_size.size
+        else:
+            size = chunk_size
+        read_start = time.time()
+
+        logger.info(f"KEYSET (arrow): {last_key} ({read_rows} rows read)")
+        sql, parameters = keyset_query(table, updated_col, primary_key,
+                                       cutoff_value=cutoff_value, last_key=last_key,
+                                       chunk_size=size, select_list=select_list)
+        rows = fetch_arrow(source_db, sql, parameters)
+
+        row_count = rows.num_rows
+        if row_count == 0:
+            return
+
+        start_key = last_key
+        last_key = (rows.column(updated_name)[row_count - 1].as_py(),
+                    rows.column(primary_key_name)[row_count - 1].as_py())
+
+        read_rows += row_count
+        yield Chunk(rows, start_key, last_key, time.time() - read_start, 0, size)
+
+        if size and row_count < size:
+            return
+
+class _PrefetchError:
+    # Wraps an exception raised on the reader thread so it can be re-raised by the consumer
+    def __init__(self, error):
+        self.error = error
+
+def prefetch_chunks(chunks, max_in_flight=1):
+    """
+    Iterate over ``chunks`` on a background reader thread, so the next chunk is read
+    from the source while the current one is written to the destination.
+
+    The reader blocks once ``max_in_flight`` chunks are waiting to be consumed, which
+    caps memory at ``max_in_flight`` queued chunks plus the one being read and the one
+    being written. Exceptions raised by the reader are re-raised in the consumer. Chunk
+    sizes the consumer picks reach the reader only after the chunks already read ahead
+    (see ``ChunkSizeController``).
+
+    `Args:`
+        chunks: iterable
+            The chunks to read. Iterated on the reader thread.
+        max_in_flight: int
+            The maximum number of chunks to read ahead. ``0`` reads chunks in the
+            calling thread with no overlap.
+    `Returns:`
+        Generator of the items of ``chunks``
+    """
+
+    if not max_in_flight or max_in_flight < 1:
+        yield from chunks
+        return
+
+    chunk_queue = queue.Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+    done = object()
 
-            # Try a normal upsert, but if it fails, try witohut vacuuming
+    def put(item):
+        # Wait for space in the queue, giving up if the consumer has gone away
+        while not stop.is_set():
             try:
-                # Copy the chunk
-                self.dest_db.upsert(rows, destination_table, primary_key, **kwargs)
-            except (Exception, psycopg2.DatabaseError) as error:
-                if 'VACUUM is running' in str(error):
-                    kwargs['vacuum'] = False
-                    self.dest_db.upsert(rows, destination_table, primary_key, **kwargs)
-                else:
-                    raise error
+                chunk_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-            # Update the counter
-            copied_rows += row_count
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(done)
+        except Exception as error:
+            put(_PrefetchError(error))
 
-    self._row_count_verify(source_tbl, destination_tbl)
+    thread = threading.Thread(target=reader, name='chunk-reader', daemon=True)
+    thread.start()
 
-    logger.info(f'{source_table} synced to {destination_table}.')
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is done:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
-def main():
+def db_dialect(db):
+    """
+    Get the SQL dialect of a parsons database connector.
+    `Args:`
+        db: object
+            A parsons Redshift, MySQL or Postgres connector
+    `Returns:`
+        ``redshift``, ``mysql`` or ``postgres``
+    """
 
-    # Instantiate class for TMC Redshift
-    setup_environment()
-    rs = Redshift()
+    if isinstance(db, Redshift):
+        return 'redshift'
+    elif isinstance(db, MySQL):
+        return 'mysql'
+    elif isinstance(db, Postgres):
+        return 'postgres'
+    raise ValueError(f"Unsupported database connector {type(db).__name__}")
 
-    # Parse Civis Parameters from environment variables to useful objects
-    temp_bucket_region = os.environ['AWS_REGION'] if os.environ['AWS_REGION']!='Default' else None
+def timestamp_type(db):
+    """
+    Get the name of the timestamp type of a parsons database connector, for casts.
+    Postgres has no ``DATETIME`` type.
+    `Returns:`
+        ``DATETIME`` on MySQL, ``TIMESTAMP`` otherwise
+    """
 
-    if ',' in os.environ['TABLE_CONFIG']:
-        table_config_str = os.environ['TABLE_CONFIG'].replace(', ',',')
-        table_config = list(ast.literal_eval(table_config_str)) if '},' in table_config_str else [ast.literal_eval(table_config_str)]
+    return 'DATETIME' if db_dialect(db) == 'mysql' else 'TIMESTAMP'
+
+def get_table_columns(db, table):
+    """
+    Get the column names of a table from ``information_schema``, in table order.
+    `Args:`
+        db: object
+            The parsons database connector
+        table: str
+            Full table path (e.g. ``my_schema.my_table``)
+    `Returns:`
+        list of column names
+    """
+
+    schema, table_name = table.split('.', 1)
+    columns = db.query(
+        """SELECT column_name AS column_name FROM information_schema.columns
+           WHERE table_schema = %s AND table_name = %s
+           ORDER BY ordinal_position""",
+        parameters=[schema, table_name])
+    return [r['column_name'] for r in columns] if columns else []
+
+def reserved_column_name(column):
+    """
+    Get the destination name of a source column, appending ``_col`` to Redshift
+    reserved words.
+    """
+
+    return f"{column}_col" if column.upper() in RESERVED_WORDS else column
+
+def projection_select_list(dialect, source_schema, destination_columns):
+    """
+    Build the select list that reads a source table's columns under their
+    destination names, in destination column order, so chunks arrive ready to copy
+    without renaming any columns.
+    `Args:`
+        dialect: str
+            The dialect of the source database
+        source_schema: dict
+            The source table's ``SchemaCache`` schema
+        destination_columns: list
+            The destination table's columns
+    `Returns:`
+        str
+    """
+
+    source_columns = {source_schema['rename_map'].get(c, c): c for c in source_schema['columns']}
+
+    missing = [c for c in destination_columns if c not in source_columns]
+    if missing:
+        raise ValueError(f"The source table has no columns for {', '.join(missing)}")
+
+    return ', '.join(f"{quote_column(dialect, source_columns[c])} AS {c}"
+                     for c in destination_columns)
+
+def schema_drift(source_schema, destination_schema):
+    """
+    Compare the columns of a source table with those of its destination table.
+    `Args:`
+        source_schema: dict
+            The source table's ``SchemaCache`` schema
+        destination_schema: dict
+            The destination table's ``SchemaCache`` schema
+    `Returns:`
+        ``(added, removed)`` tuple of lists of destination column names
+    """
+
+    source_columns = [source_schema['rename_map'].get(c, c) for c in source_schema['columns']]
+    destination_columns = destination_schema['columns']
+
+    added = [c for c in source_columns if c not in destination_columns]
+    removed = [c for c in destination_columns if c not in source_columns]
+    return added, removed
+
+def apply_schema_drift(db, destination_table, source_schema, destination_schema):
+    """
+    Bring the columns of a destination table in line with its source table: columns
+    added to the source are added to the destination with ``ALTER TABLE ... ADD
+    COLUMN`` and columns removed from the source are dropped from it. Both schemas
+    must have just been read from the databases, never served from saved state,
+    or a live column could be dropped.
+    `Args:`
+        db: object
+            The destination parsons database connector
+        destination_table: str
+            Full destination table path
+        source_schema: dict
+            The source table's ``SchemaCache`` schema
+        destination_schema: dict
+            The destination table's ``SchemaCache`` schema
+    `Returns:`
+        ``(added, removed)`` tuple of lists of destination column names
+    """
+
+    dialect = db_dialect(db)
+    source_columns = {source_schema['rename_map'].get(c, c): c for c in source_schema['columns']}
+    added, removed = schema_drift(source_schema, destination_schema)
+
+    # Redshift alters one column per statement
+    for c in added:
+        column_type = column_type_sql(source_schema['types'][source_columns[c]], dialect)
+        logger.info(f"Adding column {c} {column_type} to {destination_table}")
+        db.query(f"ALTER TABLE {destination_table} ADD COLUMN {c} {column_type}")
+    for c in removed:
+        logger.info(f"Dropping column {c} from {destination_table}")
+        db.query(f"ALTER TABLE {destination_table} DROP COLUMN {c}")
+
+    return added, removed
+
+def unload_to_stage(source_db, dest_db, source_table, staging_table, updated_col, select_list,
+                    cutoff_value=None, region=None):
+    """
+    Move the new rows of a Redshift source table into a staging table through S3: one
+    UNLOAD to Parquet, then a COPY for a Redshift destination or a native bulk load
+    of each file for other destinations.
+    `Args:`
+        source_db: Redshift
+            The source connector
+        dest_db: object
+            The destination connector
+        source_table: str
+            Full path of the source table
+        staging_table: str
+            Full path of the staging table
+        updated_col: str
+            The name of the last updated column
+        select_list: str
+            The columns to unload (see ``projection_select_list``)
+        cutoff_value: str
+            Only unload rows updated at or after this value
+        region: str
+            The region of the S3 temp bucket
+    `Returns:`
+        ``(rows, watermark)`` tuple of the number of rows staged and the highest
+        updated value unloaded
+    """
+
+    # Bound the unload above, so rows updated while it runs are left for next time
+    high_mark = source_db.query(f"SELECT MAX({updated_col}) AS high_mark FROM {source_table}").first
+    if high_mark is None:
+        return 0, cutoff_value
+
+    if cutoff_value is not None:
+        where_clause = f"WHERE {updated_col} >= %s AND {updated_col} <= %s"
+        parameters = [cutoff_value, high_mark]
     else:
-        table_config = rs.query(f"SELECT * FROM {os.environ['TABLE_CONFIG']}")
-    reverse = False if os.environ['DIRECTION']=='tmc_to_outside' else True
+        where_clause = f"WHERE {updated_col} <= %s"
+        parameters = [high_mark]
 
-    # Instantiate other DB based on type
-    if os.environ['DB_TYPE'].lower() == 'redshift':
-        destination_db = Redshift(username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
-            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
-            host=os.environ['DESTINATION_HOST'],
-            db=os.environ['DESTINATION_DB'],
-            port=5439,
-            timeout=1000,
-            s3_temp_bucket='parsons-tmc',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
-                                
-    elif os.environ['DB_TYPE'].lower() == 'mysql':
-        destination_db = MySQL(
-            host=os.environ['DESTINATION_HOST'],
-            username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
-            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
-            db=os.environ['DESTINATION_DB'])
-                                
-    elif os.environ['DB_TYPE'] == 'postgres':
-        destination_db = Postgres(username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
-            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
-            host=os.environ['DESTINATION_HOST'],
-            db=os.environ['DESTINATION_DB'],
-            timeout=1000)
-                                
+    bucket = os.environ['S3_TEMP_BUCKET']
+    key_prefix = f"coc_sync_unload/{uuid.uuid4().hex}/"
+    keys = unload_to_s3(source_db, f"SELECT {select_list} FROM {source_table} {where_clause}",
+                        parameters, bucket, key_prefix, region=region)
+    try:
+        rows = load_unloaded_parquet(dest_db, db_dialect(dest_db), bucket, key_prefix, keys,
+                                     staging_table, region=region)
+    finally:
+        remove_s3_keys(bucket, keys)
+
+    if rows is None:
+        rows = dest_db.query(f"SELECT COUNT(*) AS row_count FROM {staging_table}").first
+    return rows, str(high_mark)
+
+def create_staging_table(db, destination_table, staging_table):
+    """
+    (Re)create an empty staging table with the same columns as the destination table.
+    `Args:`
+        db: object
+            The parsons database connector
+        destination_table: str
+            Full path of the table to copy the structure of
+        staging_table: str
+            Full path of the staging table
+    """
+
+    db.query(f"DROP TABLE IF EXISTS {staging_table}")
+
+    if db_dialect(db) == 'mysql':
+        db.query(f"CREATE TABLE {staging_table} LIKE {destination_table}")
     else:
-        raise ValueError("Unsupported DB Type provided!")
+        db.query(f"CREATE TABLE {staging_table} (LIKE {destination_table})")
 
-    # Extend DBSync class with Yotam's upsert version
-    DBSync.table_sync_incremental_upsert = table_sync_incremental_upsert
+def get_varchar_lengths(db, table):
+    """
+    Get the declared length and nullability of the character columns of a table.
+    `Returns:`
+        dict of column name to ``(length, nullable)``
+    """
+
+    schema, table_name = table.split('.', 1)
+    columns = db.query(
+        """SELECT column_name AS column_name, character_maximum_length AS length,
+                  is_nullable AS is_nullable
+           FROM information_schema.columns
+           WHERE table_schema = %s AND table_name = %s
+           AND data_type IN ('character varying', 'varchar')""",
+        parameters=[schema, table_name])
+    if not columns:
+        return {}
+    return {r['column_name']: (int(r['length'] or 0), r['is_nullable'] == 'YES')
+            for r in columns}
+
+def widen_destination_columns(db, staging_table, destination_table):
+    """
+    Widen the varchar columns of a destination table to the lengths of its staging
+    table. Copies into the staging table widen its columns to fit longer source
+    values (``alter_table``), and the merge would not fit them in the destination
+    otherwise.
+    `Returns:`
+        list of the widened columns
+    """
+
+    staged = get_varchar_lengths(db, staging_table)
+    widened = []
+
+    for column, (length, nullable) in get_varchar_lengths(db, destination_table).items():
+        staged_length = staged.get(column, (0, True))[0]
+        if staged_length <= length:
+            continue
+
+        logger.info(f"Widening {destination_table}.{column} from VARCHAR({length}) to "
+                    f"VARCHAR({staged_length})")
+        if db_dialect(db) == 'mysql':
+            db.query(f"ALTER TABLE {destination_table} MODIFY COLUMN {column} "
+                     f"VARCHAR({staged_length}) {'NULL' if nullable else 'NOT NULL'}")
+        else:
+            db.query(f"ALTER TABLE {destination_table} ALTER COLUMN {column} "
+                     f"TYPE VARCHAR({staged_length})")
+        widened.append(column)
+
+    return widened
+
+def merge_staging_table(db, staging_table, destination_table, primary_key, updated_col,
+                        columns=None):
+    """
+    Merge a staging table into the destination table in a single transaction, by
+    deleting the destination rows that are being replaced and inserting the latest
+    staged version of each row. Destination varchar columns are first widened to fit
+    the staged values. The staging table is dropped afterwards.
+    `Args:`
+        db: object
+            The parsons database connector
+        staging_table: str
+            Full path of the staging table
+        destination_table: str
+            Full path of the destination table
+        primary_key: str
+            The name of the primary key
+        updated_col: str
+            The name of the last updated column, used to pick the latest version of a
+            row that was staged more than once
+        columns: list
+            The destination table's columns, if they are already known
+    `Returns:`
+        list of the destination columns that were widened
+    """
 
-    if reverse:
-        dbsync = DBSync(destination_db, rs)
+    primary_key = reserved_column_name(primary_key)
+    updated_col = reserved_column_name(updated_col)
+    columns = ', '.join(columns or get_table_columns(db, destination_table))
+
+    widened = widen_destination_columns(db, staging_table, destination_table)
+
+    if db_dialect(db) == 'mysql':
+        delete_sql = f"""
+            DELETE dest FROM {destination_table} dest
+            JOIN {staging_table} stage ON dest.{primary_key} = stage.{primary_key}
+            """
     else:
-        dbsync = DBSync(rs, destination_db)
-
-    for tbl in table_config:
-
-        if destination_db.table_exists(tbl['source']):
-            logger.info(f"Running {tbl['type']} on {tbl['source']} to {tbl['destination']}...")
-
-            if tbl['type'] == 'full_refresh':
-
-                dbsync.table_sync_full(source_table = tbl['source'],
-                                   destination_table = tbl['destination'],
-                                   if_exists=tbl['if_exists'],
-                                   temp_bucket_region=temp_bucket_region,
-                                   alter_table=True,
-                                   distkey=tbl['distkey'],
-                                   sortkey=tbl['sortkey'])
-            
-            elif tbl['type'] == 'append':
-
-                # Default to distinct check being True
-                distinct_check = tbl.get('distinct_check', 'true') == 'true'
-
-                dbsync.table_sync_incremental(source_table = tbl['source'],
-                                   destination_table = tbl['destination'],
-                                   primary_key=tbl.get('primary_key') or tbl['distkey'],
-                                   distinct_check=distinct_check,
-                                   temp_bucket_region=temp_bucket_region,
-                                   alter_table=True,
-                                   distkey=tbl['distkey'],
-                                   sortkey=tbl['sortkey'])
-
-            elif tbl['type'] == 'incremental':
-
-                # Default to distinct check being True
-                distinct_check = tbl.get('distinct_check', 'true') == 'true'
-
-                dbsync.table_sync_incremental_upsert(source_table = tbl['source'],
-                                   destination_table = tbl['destination'],
-                                   primary_key=tbl.get('primary_key') or tbl['distkey'],
-                                   updated_col=tbl['sortkey'],
-                                   distinct_check=distinct_check,
-                                   temp_bucket_region=temp_bucket_region,
-                                   alter_table=True,
-                                   distkey=tbl['distkey'],
-                                   sortkey=tbl['sortkey'])
+        delete_sql = f"""
+            DELETE FROM {destination_table}
+            USING {staging_table} stage
+            WHERE {destination_table}.{primary_key} = stage.{primary_key}
+            """
+
+    insert_sql = f"""
+        INSERT INTO {destination_table} ({columns})
+        SELECT {columns}
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY {primary_key}
+                                         ORDER BY {updated_col} DESC) AS stage_row
+            FROM {staging_table}
+        ) latest
+        WHERE stage_row = 1
+        """
+
+    with db.connection() as connection:
+        db.query_with_connection(delete_sql, connection, commit=False)
+        db.query_with_connection(insert_sql, connection, commit=False)
+        connection.commit()
+
+    db.query(f"DROP TABLE IF EXISTS {staging_table}")
+    return widened
+
+def vacuum_table(db, table):
+    """
+    Run VACUUM and ANALYZE on a Redshift table. A VACUUM that is already running on the
+    cluster is logged and skipped rather than failing the sync.
+    """
+
+    if db_dialect(db) != 'redshift':
+        return
+
+    with db.connection() as connection:
+        # VACUUM cannot run inside a transaction block
+        connection.set_session(autocommit=True)
+        try:
+            db.query_with_connection(f"VACUUM {table}", connection, commit=False)
+        except (Exception, psycopg2.DatabaseError) as error:
+            if 'VACUUM is running' not in str(error):
+                raise error
+            logger.info(f'Skipping VACUUM of {table}, another VACUUM is running.')
+        db.query_with_connection(f"ANALYZE {table}", connection, commit=False)
+
+def upsert_chunk(db, rows, destination_table, primary_key, upsert_args, metrics, source_table,
+                 **fields):
+    """
+    Upsert a chunk into the destination, retrying without a VACUUM if one is already
+    running on the cluster. Once that happens, ``vacuum`` is turned off in
+    ``upsert_args`` for the rest of the sync.
+    `Args:`
+        db: object
+            The destination parsons database connector
+        rows: Parsons Table
+            The chunk to upsert
+        destination_table: str
+            Full destination table path
+        primary_key: str
+            The name of the primary key
+        upsert_args: dict
+            Optional copy arguments for the destination database
+        metrics: SyncMetrics
+            Collector for the upsert timings
+        source_table: str
+            The source table the timings are recorded against
+        **fields: kwargs
+            Any other values to record with the timings
+    """
+
+    row_count = rows.num_rows
+    with metrics.phase(source_table, 'upsert', rows=row_count, **fields) as upsert_metrics:
+        # Try a normal upsert, but if it fails, try witohut vacuuming
+        try:
+            # Copy the chunk
+            db.upsert(rows, destination_table, primary_key, **upsert_args)
+        except (Exception, psycopg2.DatabaseError) as error:
+            if 'VACUUM is running' in str(error):
+                upsert_args['vacuum'] = False
+                upsert_metrics['retries'] = 1
+                with metrics.phase(source_table, 'vacuum_retry', rows=row_count, **fields):
+                    db.upsert(rows, destination_table, primary_key, **upsert_args)
             else:
-                raise ValueError("The only options for type are full_refresh, incremental, and append!")
+                raise error
 
-        else:
-            logger.info(f"{tbl['source']} doesn't exist in source DB")
+def distinct_check_mode(value):
+    """
+    Normalize a ``distinct_check`` setting to one of ``DISTINCT_CHECK_MODES`` or
+    ``None``. ``True`` and ``'true'`` mean a ``full`` check, ``False``, ``'false'`` and
+    empty values turn the check off.
+    """
+
+    if value is None or value is False:
+        return None
+    if value is True:
+        return 'full'
+
+    mode = str(value).strip().lower()
+    if mode in ('', 'false'):
+        return None
+    if mode == 'true':
+        return 'full'
+    if mode not in DISTINCT_CHECK_MODES:
+        raise ValueError(f"The only options for distinct_check are true, false and "
+                         f"{', '.join(DISTINCT_CHECK_MODES)}!")
+    return mode
+
+def hll_estimate(register_bits, precision=HLL_PRECISION, hash_bits=32):
+    """
+    Estimate a distinct count from HyperLogLog registers.
+    `Args:`
+        register_bits: dict
+            Register number to the smallest value of the hash bits left over after the
+            register bits, over every value hashed to that register
+        precision: int
+            The number of hash bits used to pick the register
+        hash_bits: int
+            The width of the hash
+    `Returns:`
+        float
+    """
+
+    registers = 2 ** precision
+    value_bits = hash_bits - precision
+
+    # The rank of a register is the position of the first 1 bit of its smallest value
+    ranks = [value_bits - int(bits).bit_length() + 1 for bits in register_bits.values()]
+    empty = registers - len(ranks)
+
+    alpha = 0.7213 / (1 + 1.079 / registers)
+    estimate = alpha * registers ** 2 / (sum(2.0 ** -r for r in ranks) + empty)
+
+    # Small and large range corrections
+    if estimate <= 2.5 * registers and empty:
+        estimate = registers * math.log(registers / empty)
+    elif estimate > 2 ** hash_bits / 30:
+        estimate = -2 ** hash_bits * math.log(1 - estimate / 2 ** hash_bits)
+    return estimate
+
+def count_distinct_keys(db, table, primary_key, updated_col=None, cutoff_value=None,
+                        approximate=False):
+    """
+    Count the rows and the distinct primary key values of a table.
+
+    Approximate counts use ``APPROXIMATE COUNT(DISTINCT)`` on Redshift. Other
+    databases compute HyperLogLog registers of the key hashes in one aggregate query,
+    which streams instead of collecting every distinct key, and the estimate is
+    finished client-side.
+    `Args:`
+        db: object
+            The parsons database connector
+        table: str
+            Full table path
+        primary_key: str
+            The name of the primary key
+        updated_col: str
+            Only count rows with ``updated_col`` greater than or equal to
+            ``cutoff_value``
+        cutoff_value: str
+            See ``updated_col``
+        approximate: bool
+            Estimate the distinct count instead of counting it exactly
+    `Returns:`
+        ``(row_count, distinct_keys)`` tuple
+    """
+
+    where_clause = ''
+    parameters = []
+    if cutoff_value is not None:
+        where_clause = f"WHERE {updated_col} >= %s"
+        parameters.append(cutoff_value)
+    dialect = db_dialect(db)
+
+    if not approximate or dialect == 'redshift':
+        distinct_sql = f"{'APPROXIMATE ' if approximate else ''}COUNT(DISTINCT {primary_key})"
+        counts = db.query(f"SELECT COUNT(*) AS row_count, {distinct_sql} AS distinct_keys "
+                          f"FROM {table} {where_clause}", parameters=parameters or None)
+        return int(counts[0]['row_count']), int(counts[0]['distinct_keys'] or 0)
+
+    registers = 2 ** HLL_PRECISION
+    key_hash = row_hash_sql(dialect, [primary_key])
+    sketch = db.query(f"""
+        SELECT MOD(key_hash, {registers}) AS register,
+               MIN(FLOOR(key_hash / {registers})) AS register_bits,
+               COUNT(*) AS row_count
+        FROM (SELECT {key_hash} AS key_hash FROM {table} {where_clause}) hashed
+        GROUP BY 1
+        """, parameters=parameters or None)
+    if not sketch:
+        return 0, 0
+
+    row_count = sum(int(r['row_count']) for r in sketch)
+    estimate = hll_estimate({int(r['register']): int(r['register_bits']) for r in sketch})
+    return row_count, int(round(estimate))
+
+def check_distinct_key(db, table, primary_key, mode, updated_col=None, cutoff_value=None,
+                       state_store=None, state_key=None, full_check_days=7):
+    """
+    Check that the primary key of a source table is distinct, raising an error if it
+    is not.
+
+    ``full`` counts distinct keys over the whole table. ``window`` only counts the rows
+    updated since ``cutoff_value``, the rows about to be copied. ``approx`` estimates
+    the distinct keys of the whole table and passes when the estimate reaches the row
+    count; an estimate below it, whether from duplicates or the estimate's error,
+    falls back to a ``full`` count. ``scheduled`` runs a ``full`` check when the last
+    one is older than ``full_check_days`` and a ``window`` check otherwise. Without
+    a state store there is no record of the last full check, so ``scheduled``
+    always runs the ``full`` check.
+    `Args:`
+        db: object
+            The source parsons database connector
+        table: str
+            Full table path
+        primary_key: str
+            The name of the primary key
+        mode: str
+            One of ``DISTINCT_CHECK_MODES``
+        updated_col: str
+            The column bounding the ``window`` of new rows
+        cutoff_value: str
+            The start of the ``window`` of new rows. Without one, the window is the
+            whole table.
+        state_store: SyncStateStore
+            Optional store of the last check of each mode, needed to schedule checks
+        state_key: tuple
+            The ``(source, destination, source_table, destination_table)`` key of the
+            table pair in the state store
+        full_check_days: int
+            The number of days between ``scheduled`` full checks
+    `Returns:`
+        The mode that was run
+    """
+
+    if mode == 'scheduled':
+        last_check = state_store and state_store.get_distinct_check(*state_key, mode='full')
+        due = (datetime.datetime.utcnow() - datetime.timedelta(days=full_check_days)).isoformat()
+        mode = 'full' if not last_check or last_check['checked_at'] < due else 'window'
+
+    if mode == 'window':
+        row_count, distinct_keys = count_distinct_keys(db, table, primary_key,
+                                                       updated_col=updated_col,
+                                                       cutoff_value=cutoff_value)
+    else:
+        row_count, distinct_keys = count_distinct_keys(db, table, primary_key,
+                                                       approximate=mode == 'approx')
+
+    if mode == 'approx' and distinct_keys < row_count:
+        # The estimate is only a pre-filter, so duplicates are confirmed exactly
+        logger.info(f"Approximate distinct check of {table}: about {distinct_keys} distinct "
+                    f"{primary_key} values in {row_count} rows, counting exactly")
+        mode = 'full'
+        row_count, distinct_keys = count_distinct_keys(db, table, primary_key)
+
+    distinct = distinct_keys >= row_count
+
+    logger.info(f"{mode.capitalize()} distinct check of {table}: {distinct_keys} distinct "
+                f"{primary_key} values in {row_count} rows")
+    if not distinct:
+        raise ValueError(f'{primary_key} is not distinct in source table.')
+
+    if state_store and state_key:
+        state_store.save_distinct_check(*state_key, mode, row_count=row_count,
+                                        distinct_keys=distinct_keys)
+    return mode
+
+def table_sync_incremental_upsert(self, source_table, destination_table, primary_key,
+                               updated_col, distinct_check=True, pagination='keyset',
+                               prefetch=1, state_store=None, force_verify=False,
+                               merge_mode='upsert', vacuum=True, chunk_sizing=None,
+                               metrics=None, transfer_format='table', partitions=1,
+                               distinct_check_days=7, schema_cache=None, **kwargs):
+    """
+    Incremental sync of table from a source database to a destination database
+    using an incremental primary key.
+
+    `Args:`
+        source_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        destination_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        if_exists: str
+            If destination table exists either ``drop`` or ``truncate``. Truncate is
+            useful when there are dependent views associated with the table.
+        primary_key: str
+            The name of the primary key. This must be the same for the source and
+            destination table.
+        distinct_check: bool or str
+            Check that the source table primary key is distinct prior to running the
+            sync. If it is not, an error will be raised. ``True`` or ``full`` checks
+            the whole table whenever the probes run, ``approx`` estimates the distinct
+            count of the whole table first and counts exactly only when the estimate
+            is below the row count, ``window`` checks the new rows on every sync and
+            ``scheduled`` checks the new rows on every sync and the whole table every
+            ``distinct_check_days`` (always, without a ``state_store``). See
+            ``check_distinct_key``.
+        pagination: str
+            How to page through new rows. ``keyset`` (the default) orders by
+            ``(updated_col, primary_key)`` and resumes from the last tuple seen.
+            ``offset`` uses the legacy unordered ``LIMIT``/``OFFSET`` paging.
+        prefetch: int
+            The number of chunks to read ahead of the chunk being upserted. ``0``
+            reads and upserts each chunk in turn.
+        state_store: SyncStateStore
+            Optional store of sync watermarks. When the table pair has a saved
+            watermark, the sync starts from it and skips the row count, distinct,
+            max updated and row count verification probes. With ``keyset``
+            pagination, a checkpoint is also saved after every committed chunk, and a
+            sync that was interrupted resumes from its last checkpoint.
+        force_verify: bool
+            Ignore any saved watermark and run every probe, re-deriving the watermark
+            from the tables themselves.
+        merge_mode: str
+            ``upsert`` (the default) upserts every chunk into the destination.
+            ``stage`` bulk copies every chunk into a ``{destination_table}_stage`` table
+            and merges it into the destination once, in a single transaction, at the end.
+        vacuum: bool
+            In ``stage`` mode, VACUUM and ANALYZE a Redshift destination once after the
+            merge.
+        chunk_sizing: dict
+            Resize every chunk from the measured cost of the previous ones instead of
+            using the fixed ``chunk_size``. The dict holds ``ChunkSizeController``
+            arguments (``min_size``, ``max_size``, ``target_seconds``, ``max_bytes``).
+            With a state store, the best size found is used to start the next sync.
+        metrics: SyncMetrics
+            Optional collector for the timings of every phase of the sync
+        transfer_format: str
+            How ``stage`` mode moves rows. ``table`` (the default) reads parsons Tables
+            and copies them with the connector. ``arrow`` reads keyset chunks into
+            Arrow tables and bulk loads them with the destination's native loader.
+            ``unload`` UNLOADs all new rows of a Redshift source to Parquet in one go.
+            ``arrow`` and ``unload`` need pyarrow.
+        partitions: int
+            When the destination table does not exist yet, backfill it with
+            ``table_sync_parallel`` on this many workers instead of a serial full sync.
+        distinct_check_days: int
+            The number of days between the full checks of ``scheduled`` distinct checks
+        schema_cache: SchemaCache
+            Optional cache of table schemas shared by the syncs of a run. Source rows
+            are read through a projection built from it, and columns added to or
+            removed from the source are added to or dropped from the destination.
+        **kwargs: args
+            Optional copy arguments for destination database.
+    `Returns:`
+        ``None``
+    """
+
+    if pagination not in ('keyset', 'offset'):
+        raise ValueError("The only options for pagination are keyset and offset!")
+
+    distinct_check = distinct_check_mode(distinct_check)
+
+    if merge_mode not in ('upsert', 'stage'):
+        raise ValueError("The only options for merge_mode are upsert and stage!")
+
+    if transfer_format not in ('table', 'arrow', 'unload'):
+        raise ValueError("The only options for transfer_format are table, arrow and unload!")
+    if transfer_format != 'table' and merge_mode != 'stage':
+        raise ValueError(f"The {transfer_format} transfer_format needs merge_mode stage!")
+    if transfer_format == 'arrow' and pagination != 'keyset':
+        raise ValueError("The arrow transfer_format needs keyset pagination!")
+    if transfer_format == 'unload' and db_dialect(self.source_db) != 'redshift':
+        raise ValueError("The unload transfer_format needs a Redshift source!")
+
+    start = time.time()
+    metrics = metrics or SyncMetrics()
+    schema_cache = schema_cache or SchemaCache(rename=reserved_column_name)
+
+    # Create the table objects
+    source_tbl = self.source_db.table(source_table)
+    destination_tbl = self.dest_db.table(destination_table)
+
+    # Check that the destination table exists. If it does not, then run a
+    # full sync instead.
+    with metrics.phase(source_table, 'probe', query='destination_exists'):
+        destination_exists = schema_cache.table_exists(self.dest_db, destination_table)
+    if not destination_exists:
+        if partitions > 1:
+            table_sync_parallel(self, source_table, destination_table, primary_key,
+                                partitions=partitions, updated_col=updated_col,
+                                metrics=metrics, **kwargs)
+        else:
+            with metrics.phase(source_table, 'full_sync'):
+                self.table_sync_full(source_table, destination_table)
+        schema_cache.invalidate(self.dest_db, destination_table)
+        force_verify = True
+
+    state_key = (db_identity(self.source_db), db_identity(self.dest_db),
+                 source_table, destination_table)
+
+    # Follow columns added to or removed from the source
+    with metrics.phase(source_table, 'probe', query='schema'):
+        source_schema = schema_cache.table_schema(self.source_db, source_table)
+        destination_schema = schema_cache.table_schema(self.dest_db, destination_table)
+    added, removed = [], []
+    if any(schema_drift(source_schema, destination_schema)):
+        # Either schema may have been served from a previous run, so both are read
+        # again before anything is altered
+        with metrics.phase(source_table, 'probe', query='schema'):
+            schema_cache.invalidate(self.source_db, source_table)
+            schema_cache.invalidate(self.dest_db, destination_table)
+            source_schema = schema_cache.table_schema(self.source_db, source_table)
+            destination_schema = schema_cache.table_schema(self.dest_db, destination_table)
+        added, removed = apply_schema_drift(self.dest_db, destination_table, source_schema,
+                                            destination_schema)
+    if added or removed:
+        schema_cache.invalidate(self.dest_db, destination_table)
+        destination_schema = schema_cache.table_schema(self.dest_db, destination_table)
+        if state_store:
+            # Chunks staged before the change no longer match the destination
+            state_store.clear_checkpoint(*state_key)
+
+    # Read source rows straight into the destination's columns
+    destination_columns = destination_schema['columns']
+    select_list = projection_select_list(db_dialect(self.source_db), source_schema,
+                                         destination_columns)
+
+    state = None
+    checkpoint = None
+    if state_store and not force_verify:
+        state = state_store.get_state(*state_key)
+        if pagination == 'keyset':
+            checkpoint = state_store.get_checkpoint(*state_key)
+    elif state_store:
+        state_store.clear_checkpoint(*state_key)
+
+    staging_table = f"{destination_table}_stage"
+    if checkpoint and merge_mode == 'stage' and not self.dest_db.table_exists(staging_table):
+        # The staged chunks are gone, so they have to be copied again
+        logger.info(f'{staging_table} is missing, ignoring checkpoint.')
+        checkpoint = None
+
+    resume_key = None
+    offset_high_mark = None
+    copied_rows = 0
+    chunk_id = 0
+
+    if checkpoint:
+        # Pick up an interrupted sync where it stopped. The last committed chunk is
+        # read and upserted again, which the upsert makes idempotent.
+        cutoff_value = checkpoint['cutoff_value']
+        resume_key = checkpoint['start_key']
+        chunk_id = checkpoint['chunk_id'] - 1
+        copied_rows = checkpoint['rows_copied'] - checkpoint['chunk_rows']
+        logger.info(f'Resuming {source_table} from checkpoint at chunk {checkpoint["chunk_id"]} '
+                    f'({copied_rows} rows already copied)')
+
+        new_row_count = None
+        verified = False
+
+    elif state and state['watermark'] is not None:
+        # Start from the saved watermark and skip the full-table probes. Rows at the
+        # watermark itself are copied again, which the upsert makes harmless.
+        cutoff_value = state['watermark']
+        logger.info(f'Resuming {source_table} from saved watermark {cutoff_value}')
+
+        new_row_count = None
+        if pagination == 'offset':
+            with metrics.phase(source_table, 'probe', query='new_rows_count'):
+                new_row_count = source_tbl.get_new_rows_count(updated_col, cutoff_value)
+            # Offset chunks are unordered, so the next watermark is the newest row
+            # there is to copy, taken before the copy starts
+            with metrics.phase(source_table, 'probe', query='source_max_updated'):
+                offset_high_mark = self.source_db.query(
+                    f"SELECT MAX({updated_col}) AS max_updated FROM {source_table} "
+                    f"WHERE {updated_col} >= %s", parameters=[cutoff_value]).first
+
+        verified = False
+
+    else:
+        # If the source table contains 0 rows, do not attempt to copy the table.
+        with metrics.phase(source_table, 'probe', query='source_rows'):
+            source_rows = source_tbl.num_rows
+        if source_rows == 0:
+            logger.info('Source table contains 0 rows')
+            return None
+
+        # Get the max source table and destination table updated values
+        with metrics.phase(source_table, 'probe', query='destination_max_updated'):
+            dest_max_updated = self.dest_db.query(
+                f"SELECT CAST(MAX({updated_col}) AS {timestamp_type(self.dest_db)}) "
+                f"FROM {destination_table}"
+            ).first
+        with metrics.phase(source_table, 'probe', query='source_max_updated'):
+            source_max_updated = self.source_db.query(
+                f"SELECT CAST(MAX({updated_col}) AS {timestamp_type(self.source_db)}) "
+                f"FROM {source_table}"
+            ).first
+
+        # Check for a mismatch in row counts; if dest_max_pk is None, or destination is empty
+        # and we don't have to worry about this check.
+
+        if dest_max_updated is not None and dest_max_updated > source_max_updated:
+            # raise ValueError('Destination DB table updated later than source DB table.')
+            logger.info('Destination DB table updated later than source DB table.')
+            return None
+
+        # Do not copied if row counts are equal.
+        elif dest_max_updated == source_max_updated:
+            logger.info('Tables are in sync.')
+            if state_store:
+                state_store.save_state(*state_key, watermark=str(dest_max_updated),
+                                       source_rows=source_rows, rows_copied=0,
+                                       verified=True, seconds=round(time.time() - start, 1))
+            return None
+
+        # Get count of rows to be copied.
+        if dest_max_updated is not None:
+            with metrics.phase(source_table, 'probe', query='new_rows_count'):
+                new_row_count = source_tbl.get_new_rows_count(updated_col,
+                                                              str(dest_max_updated))
+        else:
+            new_row_count = source_rows
+
+        logger.info(f'Found {new_row_count} updated rows in source table since {str(dest_max_updated)}')
+
+        cutoff_value = str(dest_max_updated) if dest_max_updated is not None else None
+        verified = True
+
+    # Check that the source table primary key is distinct. Whole-table checks only run
+    # with the other probes; window checks are cheap enough to run on every sync.
+    if distinct_check and not checkpoint and (verified or distinct_check in ('window',
+                                                                             'scheduled')):
+        with metrics.phase(source_table, 'distinct_check', mode=distinct_check):
+            check_distinct_key(self.source_db, source_table, primary_key, distinct_check,
+                               updated_col=updated_col, cutoff_value=cutoff_value,
+                               state_store=state_store, state_key=state_key,
+                               full_check_days=distinct_check_days)
+
+    chunk_size = self.chunk_size
+    if chunk_sizing is not None:
+        initial_size = state_store and state_store.get_chunk_size(*state_key)
+        chunk_size = ChunkSizeController(initial_size or self.chunk_size, **chunk_sizing)
+
+    if transfer_format == 'arrow':
+        chunks = iter_arrow_chunks(self.source_db, source_tbl.table, updated_col, primary_key,
+                                   select_list, cutoff_value=cutoff_value,
+                                   chunk_size=chunk_size, last_key=resume_key)
+    elif transfer_format == 'unload':
+        # The rows are moved by a single UNLOAD below, not in chunks
+        chunks = iter(())
+    else:
+        chunks = iter_new_row_chunks(self.source_db, source_tbl.table, updated_col, primary_key,
+                                     cutoff_value=cutoff_value, chunk_size=chunk_size,
+                                     pagination=pagination, new_row_count=new_row_count,
+                                     last_key=resume_key, select_list=select_list)
+
+    if merge_mode == 'stage' and not checkpoint:
+        with metrics.phase(source_table, 'create_stage'):
+            create_staging_table(self.dest_db, destination_table, staging_table)
+
+    watermark = cutoff_value
+
+    if transfer_format == 'unload':
+        with metrics.phase(source_table, 'unload') as phase:
+            copied_rows, watermark = unload_to_stage(
+                self.source_db, self.dest_db, source_table, staging_table, updated_col,
+                select_list, cutoff_value=cutoff_value,
+                region=kwargs.get('temp_bucket_region'))
+            phase['rows'] = copied_rows
+
+    # Copy rows in chunks, reading the next chunk while the current one is upserted.
+    for rows, start_key, last_key, read_seconds, rename_seconds, read_size in prefetch_chunks(
+            chunks, max_in_flight=prefetch):
+        row_count = rows.num_rows
+        chunk_bytes = rows.nbytes if transfer_format == 'arrow' else estimate_chunk_bytes(rows)
+        chunk_id += 1
+        metrics.record(source_table, 'fetch', read_seconds, rows=row_count, bytes=chunk_bytes,
+                       chunk_id=chunk_id)
+        metrics.record(source_table, 'rename', rename_seconds, rows=row_count, chunk_id=chunk_id)
+        write_start = time.time()
+
+        if merge_mode == 'stage':
+            # Bulk copy the chunk; it is merged into the destination at the end
+            with metrics.phase(source_table, 'stage_copy', rows=row_count, bytes=chunk_bytes,
+                               chunk_id=chunk_id):
+                if transfer_format == 'arrow':
+                    load_arrow(self.dest_db, db_dialect(self.dest_db), rows, staging_table,
+                               region=kwargs.get('temp_bucket_region'))
+                else:
+                    self.dest_db.copy(rows, staging_table, if_exists='append', **kwargs)
+        else:
+            upsert_chunk(self.dest_db, rows, destination_table, primary_key, kwargs, metrics,
+                         source_table, bytes=chunk_bytes, chunk_id=chunk_id)
+
+        # Update the counter
+        copied_rows += row_count
+        logger.info(f"Copied {copied_rows} of {new_row_count or 'unknown'} rows")
+
+        if isinstance(chunk_size, ChunkSizeController):
+            chunk_size.record(row_count, chunk_bytes, read_seconds, time.time() - write_start,
+                              size=read_size)
+
+        # Keyset chunks arrive in updated order, so the last key is the high-water mark
+        if pagination == 'keyset' and last_key[0] is not None:
+            watermark = str(last_key[0])
+
+            # Record the committed chunk so a restart can resume from it
+            if state_store:
+                state_store.save_checkpoint(*state_key, cutoff_value=cutoff_value,
+                                            chunk_id=chunk_id, start_key=start_key,
+                                            last_key=last_key, chunk_rows=row_count,
+                                            rows_copied=copied_rows)
+                state_store.push()
+
+    if merge_mode == 'stage':
+        logger.info(f'Merging {staging_table} into {destination_table}...')
+        with metrics.phase(source_table, 'merge', rows=copied_rows):
+            widened = merge_staging_table(self.dest_db, staging_table, destination_table,
+                                          primary_key, updated_col, columns=destination_columns)
+        if widened:
+            schema_cache.invalidate(self.dest_db, destination_table)
+        if vacuum and copied_rows:
+            with metrics.phase(source_table, 'vacuum'):
+                vacuum_table(self.dest_db, destination_table)
+
+    if verified:
+        with metrics.phase(source_table, 'verify'):
+            self._row_count_verify(source_tbl, destination_tbl)
+        if pagination == 'offset':
+            # Offset chunks are unordered; the probed maximum is the safe watermark
+            watermark = str(source_max_updated)
+    elif offset_high_mark is not None:
+        watermark = str(offset_high_mark)
+
+    if state_store and watermark is not None:
+        state_store.save_state(*state_key, watermark=watermark,
+                               source_rows=source_rows if verified else None,
+                               rows_copied=copied_rows, verified=verified,
+                               pagination=pagination, merge_mode=merge_mode,
+                               seconds=round(time.time() - start, 1))
+        state_store.clear_checkpoint(*state_key)
+
+    if state_store and isinstance(chunk_size, ChunkSizeController):
+        if chunk_size.best_rows_per_second:
+            state_store.save_chunk_size(*state_key, chunk_size.best_size,
+                                        rows_per_second=chunk_size.best_rows_per_second)
+
+    logger.info(f'{source_table} synced to {destination_table}.')
+
+# The text NULL values are hashed as
+NULL_HASH_TEXT = '<NULL>'
+
+def row_hash_sql(dialect, columns):
+    """
+    Build a SQL expression hashing the values of a row to an unsigned 32-bit integer,
+    so that the same values hash the same way on Redshift, MySQL and Postgres.
+    `Args:`
+        dialect: str
+            ``redshift``, ``mysql`` or ``postgres``
+        columns: list
+            The columns to hash, in order
+    `Returns:`
+        str
+    """
+
+    # NULLs are hashed as a marker without backslashes, which every dialect reads the
+    # same way, so they differ from empty strings
+    null_text = f"'{NULL_HASH_TEXT}'"
+    if dialect == 'mysql':
+        values = [f"COALESCE(CAST({c} AS CHAR), {null_text})" for c in columns]
+        return (f"CAST(CONV(LEFT(MD5(CONCAT_WS('|', {', '.join(values)})), 8), 16, 10) "
+                f"AS UNSIGNED)")
+
+    text_type = 'VARCHAR(65535)' if dialect == 'redshift' else 'TEXT'
+    row_text = " || '|' || ".join(f"COALESCE(CAST({c} AS {text_type}), {null_text})"
+                                  for c in columns)
+
+    if dialect == 'redshift':
+        return f"STRTOL(LEFT(MD5({row_text}), 8), 16)"
+    return f"('x' || LPAD(LEFT(MD5({row_text}), 8), 16, '0'))::bit(64)::bigint"
+
+def get_block_hashes(db, table, primary_key, columns, block_size):
+    """
+    Hash a table in blocks of ``block_size`` consecutive primary key values. Each
+    block's hash is the exact ``DECIMAL`` sum of its row hashes on every dialect.
+    `Args:`
+        db: object
+            The parsons database connector
+        table: str
+            Full table path
+        primary_key: str
+            The name of the integer primary key
+        columns: list
+            The columns to include in the hash
+        block_size: int
+            The width of each block of primary key values
+    `Returns:`
+        dict of block number to ``(row_count, block_hash)``
+    """
+
+    sql = f"""
+        SELECT FLOOR({primary_key} / {block_size}) AS block,
+               COUNT(*) AS row_count,
+               CAST(SUM({row_hash_sql(db_dialect(db), columns)}) AS DECIMAL(38, 0)) AS block_hash
+        FROM {table}
+        GROUP BY 1
+        """
+
+    blocks = db.query(sql)
+    if not blocks:
+        return {}
+    return {int(r['block']): (int(r['row_count']), int(r['block_hash'])) for r in blocks}
+
+def diff_block_ranges(source_blocks, destination_blocks, max_rows=None):
+    """
+    Find the blocks whose hashes differ between two tables and group consecutive ones
+    into ranges.
+    `Args:`
+        source_blocks: dict
+            Block hashes of the source table (see ``get_block_hashes``)
+        destination_blocks: dict
+            Block hashes of the destination table
+        max_rows: int
+            Start a new range once a range holds this many source rows
+    `Returns:`
+        list of ``(first_block, last_block)`` tuples
+    """
+
+    changed = sorted(b for b in set(source_blocks) | set(destination_blocks)
+                     if source_blocks.get(b) != destination_blocks.get(b))
+
+    ranges = []
+    range_rows = 0
+    for b in changed:
+        block_rows = source_blocks.get(b, (0, 0))[0]
+        if (ranges and b == ranges[-1][1] + 1
+                and not (max_rows and range_rows + block_rows > max_rows)):
+            ranges[-1] = (ranges[-1][0], b)
+            range_rows += block_rows
+        else:
+            ranges.append((b, b))
+            range_rows = block_rows
+
+    return ranges
+
+def table_sync_hash_diff(self, source_table, destination_table, primary_key, block_size=10000,
+                         hash_columns=None, metrics=None, **kwargs):
+    """
+    Sync a table that has no reliable updated column or monotonic primary key, by
+    comparing row hashes of both tables in blocks of primary key values and copying
+    only the blocks that differ.
+
+    Each side computes a count and a sum of row hashes per block in a single
+    aggregate query. Source rows in a changed block are upserted into the destination
+    and destination rows that are no longer in the source are deleted. Values have to
+    render to the same text on both sides to hash the same way; columns that do not
+    (e.g. floats across database types) can be left out with ``hash_columns``, at
+    the cost of not detecting changes to them.
+
+    `Args:`
+        source_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        destination_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        primary_key: str
+            The name of the integer primary key
+        block_size: int
+            The number of consecutive primary key values hashed together
+        hash_columns: list
+            The source columns to compare. Defaults to every column in both tables.
+        metrics: SyncMetrics
+            Optional collector for the timings of every phase of the sync
+        **kwargs: args
+            Optional copy arguments for destination database.
+    `Returns:`
+        ``None``
+    """
+
+    metrics = metrics or SyncMetrics()
+
+    with metrics.phase(source_table, 'probe', query='destination_exists'):
+        destination_exists = self.dest_db.table_exists(destination_table)
+    if not destination_exists:
+        with metrics.phase(source_table, 'full_sync'):
+            self.table_sync_full(source_table, destination_table, **kwargs)
+        return None
+
+    with metrics.phase(source_table, 'probe', query='columns'):
+        destination_columns = set(get_table_columns(self.dest_db, destination_table))
+        source_columns = hash_columns or get_table_columns(self.source_db, source_table)
+    source_columns = [c for c in source_columns
+                      if reserved_column_name(c) in destination_columns]
+    destination_hash_columns = [reserved_column_name(c) for c in source_columns]
+
+    # Hash both sides at the same time
+    with metrics.phase(source_table, 'block_hash'):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_future = executor.submit(get_block_hashes, self.source_db, source_table,
+                                            primary_key, source_columns, block_size)
+            destination_future = executor.submit(
+                get_block_hashes, self.dest_db, destination_table,
+                reserved_column_name(primary_key), destination_hash_columns, block_size)
+            source_blocks = source_future.result()
+            destination_blocks = destination_future.result()
+
+    ranges = diff_block_ranges(source_blocks, destination_blocks, max_rows=self.chunk_size)
+    changed_blocks = sum(last - first + 1 for first, last in ranges)
+    logger.info(f'{changed_blocks} of {len(set(source_blocks) | set(destination_blocks))} '
+                f'blocks of {block_size} keys differ between {source_table} and '
+                f'{destination_table}.')
+
+    copied_rows = 0
+    deleted_rows = 0
+    destination_key = reserved_column_name(primary_key)
+
+    for chunk_id, (first_block, last_block) in enumerate(ranges, start=1):
+        low = first_block * block_size
+        high = (last_block + 1) * block_size
+
+        with metrics.phase(source_table, 'fetch', chunk_id=chunk_id) as fetch_metrics:
+            rows = self.source_db.query(
+                f"SELECT * FROM {source_table} WHERE {primary_key} >= %s AND {primary_key} < %s",
+                parameters=[low, high])
+            fetch_metrics['rows'] = rows.num_rows if rows else 0
+
+        source_keys = set()
+        if rows and rows.num_rows:
+            source_keys = set(rows[primary_key])
+            for c in rows.columns:
+                if c.upper() in RESERVED_WORDS:
+                    rows.rename_column(c, f"{c}_col")
+
+            upsert_chunk(self.dest_db, rows, destination_table, primary_key, kwargs, metrics,
+                         source_table, chunk_id=chunk_id)
+            copied_rows += rows.num_rows
+
+        # Remove destination rows that are no longer in the source
+        with metrics.phase(source_table, 'delete', chunk_id=chunk_id) as delete_metrics:
+            destination_keys = self.dest_db.query(
+                f"SELECT {destination_key} FROM {destination_table} "
+                f"WHERE {destination_key} >= %s AND {destination_key} < %s",
+                parameters=[low, high])
+            removed = (sorted(set(destination_keys[destination_key]) - source_keys)
+                       if destination_keys else [])
+            for i in range(0, len(removed), 1000):
+                batch = removed[i:i + 1000]
+                self.dest_db.query(
+                    f"DELETE FROM {destination_table} WHERE {destination_key} IN "
+                    f"({', '.join(['%s'] * len(batch))})", parameters=batch)
+            delete_metrics['rows'] = len(removed)
+            deleted_rows += len(removed)
+
+    logger.info(f'{source_table} synced to {destination_table}: {copied_rows} rows copied, '
+                f'{deleted_rows} rows deleted.')
+
+# The key range of the rows whose partition column is NULL, which no bounded range holds
+NULL_KEY_RANGE = 'null'
+
+def key_range_query(table, partition_col, primary_key, key_range, last_key=None,
+                    chunk_size=None, filter_col=None, filter_value=None):
+    """
+    Build the query for the next chunk of one key range of a table, ordered by
+    ``(partition_col, primary_key)`` and seeking past the last key seen.
+    `Args:`
+        table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        partition_col: str
+            The column the key space is split on
+        primary_key: str
+            The name of the primary key, used to break ties on ``partition_col``
+        key_range: tuple
+            ``(lower, upper)`` bounds of the range. ``lower`` is inclusive, ``upper``
+            exclusive and ``None`` leaves that side unbounded. Rows with a NULL
+            ``partition_col`` are only in ``NULL_KEY_RANGE``.
+        last_key: tuple
+            The ``(partition_col, primary_key)`` values of the last row of the
+            previous chunk
+        chunk_size: int
+            The maximum number of rows to return
+        filter_col: str
+            Only return rows with ``filter_col`` greater than or equal to
+            ``filter_value``
+        filter_value: str
+            See ``filter_col``
+    `Returns:`
+        ``(sql, parameters)`` tuple
+    """
+
+    conditions = []
+    parameters = []
+
+    if key_range == NULL_KEY_RANGE:
+        # The rows all share the NULL key, so they are paged on the primary key alone
+        conditions.append(f"{partition_col} is null")
+        lower = upper = None
+        partition_col = primary_key
+    else:
+        lower, upper = key_range
+        if partition_col != primary_key:
+            conditions.append(f"{partition_col} is not null")
+
+    if lower is not None:
+        conditions.append(f"{partition_col} >= %s")
+        parameters.append(lower)
+    if upper is not None:
+        conditions.append(f"{partition_col} < %s")
+        parameters.append(upper)
+    if filter_value is not None:
+        conditions.append(f"{filter_col} >= %s")
+        parameters.append(filter_value)
+
+    if partition_col == primary_key:
+        if last_key is not None:
+            conditions.append(f"{primary_key} > %s")
+            parameters.append(last_key[1])
+        order_by = primary_key
+    else:
+        if last_key is not None:
+            conditions.append(f"({partition_col} > %s "
+                              f"or ({partition_col} = %s and {primary_key} > %s))")
+            parameters.extend([last_key[0], last_key[0], last_key[1]])
+        order_by = f"{partition_col}, {primary_key}"
+
+    where_clause = f"where {' and '.join(conditions)}" if conditions else ''
+    sql = f"""
+           SELECT
+           *
+           FROM {table}
+           {where_clause}
+           ORDER BY {order_by}
+           """
+
+    if chunk_size:
+        sql += f" LIMIT {chunk_size}"
+
+    return sql, parameters
+
+def get_partition_ranges(db, table, partition_col, partitions, filter_col=None,
+                         filter_value=None, sample_rows=10000):
+    """
+    Split the key space of a table into contiguous ranges holding roughly the same
+    number of rows. The split points are quantiles of a random sample of
+    ``partition_col``, so skewed keys still split evenly.
+    `Args:`
+        db: object
+            The parsons database connector
+        table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        partition_col: str
+            The column to split on
+        partitions: int
+            The number of ranges
+        filter_col: str
+            Only count rows with ``filter_col`` greater than or equal to
+            ``filter_value``
+        filter_value: str
+            See ``filter_col``
+        sample_rows: int
+            The approximate number of rows to sample
+    `Returns:`
+        list of ``(lower, upper)`` ranges, see ``key_range_query``. The first range has
+        no lower bound and the last no upper bound. ``NULL_KEY_RANGE`` comes last if
+        any row has a NULL ``partition_col``. Empty if the table has no rows.
+    """
+
+    where_clause = ''
+    parameters = []
+    if filter_value is not None:
+        where_clause = f"WHERE {filter_col} >= %s"
+        parameters.append(filter_value)
+
+    bounds = db.query(f"""SELECT COUNT(*) AS row_count, COUNT({partition_col}) AS key_count,
+                          MIN({partition_col}) AS low, MAX({partition_col}) AS high
+                          FROM {table} {where_clause}""", parameters=parameters or None)
+    row_count, low, high = bounds[0]['row_count'], bounds[0]['low'], bounds[0]['high']
+    null_ranges = [NULL_KEY_RANGE] if row_count != bounds[0]['key_count'] else []
+    row_count = bounds[0]['key_count']
+    if not row_count:
+        return null_ranges
+
+    logger.info(f"Splitting {row_count} rows of {table} from {low} to {high} on "
+                f"{partition_col} into {partitions} ranges")
+
+    random_sql = 'RAND()' if db_dialect(db) == 'mysql' else 'RANDOM()'
+    fraction = min(1.0, sample_rows / row_count)
+    sample_where = (f"{where_clause} {'AND' if where_clause else 'WHERE'} "
+                    f"{partition_col} IS NOT NULL AND {random_sql} < {fraction}")
+    sample = db.query(f"SELECT {partition_col} AS split_key FROM {table} {sample_where} "
+                      f"ORDER BY {partition_col}", parameters=parameters or None)
+    values = [r['split_key'] for r in sample] if sample else []
+
+    # Split points are the sample quantiles, without repeats and above the minimum
+    # so that no range is empty by construction
+    split_points = []
+    for i in range(1, partitions):
+        if not values:
+            break
+        value = values[i * len(values) // partitions]
+        if value > low and (not split_points or value > split_points[-1]):
+            split_points.append(value)
+
+    edges = [None] + split_points + [None]
+    return list(zip(edges[:-1], edges[1:])) + null_ranges
+
+def copy_key_range(source_db, dest_db, source_table, target_table, partition_col, primary_key,
+                   key_range, chunk_size=None, filter_col=None, filter_value=None,
+                   last_key=None, metrics=None, range_id=None, **copy_args):
+    """
+    Copy one key range of a source table into a destination table in keyset chunks.
+    The parsons connectors open a connection per query, so ranges copied on separate
+    threads each read and write on their own connections.
+    `Args:`
+        source_db: object
+            The source parsons database connector
+        dest_db: object
+            The destination parsons database connector
+        source_table: str
+            Full source table path
+        target_table: str
+            Full path of the table to append the rows to
+        partition_col: str
+            The column the key space is split on
+        primary_key: str
+            The name of the primary key
+        key_range: tuple
+            The ``(lower, upper)`` range to copy
+        chunk_size: int
+            The maximum number of rows per chunk
+        filter_col: str
+            Only copy rows with ``filter_col`` greater than or equal to ``filter_value``
+        filter_value: str
+            See ``filter_col``
+        last_key: tuple
+            Resume after this ``(partition_col, primary_key)`` tuple
+        metrics: SyncMetrics
+            Optional collector for the chunk timings
+        range_id: int
+            The number of the range, recorded with the metrics
+        **copy_args: kwargs
+            Optional copy arguments for the destination database
+    `Returns:`
+        The number of rows copied
+    """
+
+    metrics = metrics or SyncMetrics()
+    copied_rows = 0
+
+    while True:
+        sql, parameters = key_range_query(source_table, partition_col, primary_key, key_range,
+                                          last_key=last_key, chunk_size=chunk_size,
+                                          filter_col=filter_col, filter_value=filter_value)
+        with metrics.phase(source_table, 'fetch', range_id=range_id) as fetch_metrics:
+            rows = source_db.query(sql, parameters=parameters or None)
+            row_count = rows.num_rows if rows else 0
+            fetch_metrics['rows'] = row_count
+        if row_count == 0:
+            break
+
+        last_row = rows[row_count - 1]
+        last_key = (last_row[partition_col], last_row[primary_key])
+
+        for c in rows.columns:
+            if c.upper() in RESERVED_WORDS:
+                rows.rename_column(c, f"{c}_col")
+
+        with metrics.phase(source_table, 'range_copy', rows=row_count, range_id=range_id):
+            dest_db.copy(rows, target_table, if_exists='append', **copy_args)
+        copied_rows += row_count
+
+        if not chunk_size or row_count < chunk_size:
+            break
+
+    logger.info(f"Copied {copied_rows} rows of range {range_id} {key_range} of {source_table}")
+    return copied_rows
+
+def swap_tables(db, staging_table, destination_table):
+    """
+    Replace a destination table with a fully loaded staging table by renaming both in
+    one transaction, then drop the old table.
+    `Args:`
+        db: object
+            The parsons database connector
+        staging_table: str
+            Full path of the loaded staging table, in the destination's schema
+        destination_table: str
+            Full path of the table to replace
+    """
+
+    schema, table_name = destination_table.split('.', 1)
+    old_table = f"{destination_table}_old"
+    destination_exists = db.table_exists(destination_table)
+
+    db.query(f"DROP TABLE IF EXISTS {old_table}")
+
+    if db_dialect(db) == 'mysql':
+        # RENAME TABLE swaps every table in one atomic statement
+        renames = [f"{staging_table} TO {destination_table}"]
+        if destination_exists:
+            renames.insert(0, f"{destination_table} TO {old_table}")
+        db.query(f"RENAME TABLE {', '.join(renames)}")
+    else:
+        with db.connection() as connection:
+            if destination_exists:
+                db.query_with_connection(
+                    f"ALTER TABLE {destination_table} RENAME TO {table_name}_old",
+                    connection, commit=False)
+            db.query_with_connection(f"ALTER TABLE {staging_table} RENAME TO {table_name}",
+                                     connection, commit=False)
+            connection.commit()
+
+    db.query(f"DROP TABLE IF EXISTS {old_table}")
+
+def replace_table_contents(db, staging_table, destination_table):
+    """
+    Replace the rows of a destination table with those of a fully loaded staging table
+    in one transaction, then drop the staging table. Unlike ``swap_tables`` the
+    destination table itself is kept, so views and grants on it are untouched.
+    `Args:`
+        db: object
+            The parsons database connector
+        staging_table: str
+            Full path of the loaded staging table
+        destination_table: str
+            Full path of the table to refill
+    """
+
+    columns = ', '.join(get_table_columns(db, staging_table))
+
+    # TRUNCATE commits the open transaction on Redshift and MySQL, so they delete instead
+    if db_dialect(db) == 'postgres':
+        clear_sql = f"TRUNCATE {destination_table}"
+    else:
+        clear_sql = f"DELETE FROM {destination_table}"
+
+    with db.connection() as connection:
+        db.query_with_connection(clear_sql, connection, commit=False)
+        db.query_with_connection(
+            f"INSERT INTO {destination_table} ({columns}) SELECT {columns} FROM {staging_table}",
+            connection, commit=False)
+        connection.commit()
+
+    db.query(f"DROP TABLE IF EXISTS {staging_table}")
+
+def table_sync_parallel(self, source_table, destination_table, primary_key, partitions=4,
+                        partition_col=None, updated_col=None, full_refresh=True,
+                        sample_rows=10000, if_exists='drop', metrics=None, **kwargs):
+    """
+    Copy a large table on several workers at once. The key space of the source is
+    split into ``partitions`` contiguous ranges of about the same number of rows (see
+    ``get_partition_ranges``) and each range is copied in keyset chunks on its own
+    worker into a ``{destination_table}_stage`` table. The staging table is then
+    reconciled with the destination once: swapped in (or copied in, when
+    ``if_exists`` is ``truncate``) for a full refresh, or merged for an incremental
+    sync. A full refresh raises an error instead of swapping when the staging table's
+    row count does not match the source, leaving the destination in place.
+
+    `Args:`
+        source_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        destination_table: str
+            Full table path (e.g. ``my_schema.my_table``)
+        primary_key: str
+            The name of the primary key
+        partitions: int
+            The number of key ranges, and of workers copying them
+        partition_col: str
+            The column to split the key space on. Defaults to ``primary_key``; an
+            ``updated_col`` also works, with the primary key breaking ties.
+        updated_col: str
+            The name of the last updated column. Needed when ``full_refresh`` is
+            ``False``.
+        full_refresh: bool
+            Copy every row and swap the staging table in for the destination. When
+            ``False`` and the destination exists, only rows updated since the
+            destination's latest ``updated_col`` are copied and they are merged into it.
+        sample_rows: int
+            The number of rows sampled to pick the range boundaries
+        if_exists: str
+            What a full refresh does with an existing destination table: ``drop``
+            swaps the staging table in for it, ``truncate`` empties it and copies the
+            staging rows in, keeping the table and the views that depend on it, and
+            ``fail`` raises an error
+        metrics: SyncMetrics
+            Optional collector for the timings of every phase of the sync
+        **kwargs: args
+            Optional copy arguments for destination database.
+    `Returns:`
+        ``None``
+    """
+
+    metrics = metrics or SyncMetrics()
+    partition_col = partition_col or primary_key
+    staging_table = f"{destination_table}_stage"
+
+    if if_exists not in ('drop', 'truncate', 'fail'):
+        raise ValueError(f"Unsupported if_exists {if_exists} for a parallel sync")
+
+    with metrics.phase(source_table, 'probe', query='destination_exists'):
+        destination_exists = self.dest_db.table_exists(destination_table)
+    if not destination_exists:
+        full_refresh = True
+    elif not full_refresh and not updated_col:
+        raise ValueError("Incremental parallel syncs need an updated_col!")
+    elif full_refresh and if_exists == 'fail':
+        raise ValueError(f"Destination table {destination_table} already exists.")
+
+    filter_col = None
+    filter_value = None
+    if not full_refresh:
+        with metrics.phase(source_table, 'probe', query='destination_max_updated'):
+            dest_max_updated = self.dest_db.query(
+                f"SELECT MAX({reserved_column_name(updated_col)}) AS max_updated "
+                f"FROM {destination_table}").first
+        if dest_max_updated is not None:
+            filter_col = updated_col
+            filter_value = str(dest_max_updated)
+
+    if full_refresh:
+        # Counted before the copy, so rows added to the source meanwhile do not fail
+        # the check before the swap
+        with metrics.phase(source_table, 'probe', query='source_rows'):
+            source_rows_before = self.source_db.table(source_table).num_rows
+
+    with metrics.phase(source_table, 'partition'):
+        ranges = get_partition_ranges(self.source_db, source_table, partition_col, partitions,
+                                      filter_col=filter_col, filter_value=filter_value,
+                                      sample_rows=sample_rows)
+    if not ranges:
+        logger.info(f'No rows to copy from {source_table}')
+        return None
+
+    resume_keys = [None] * len(ranges)
+    finished_ranges = set()
+    copied_rows = 0
+
+    with metrics.phase(source_table, 'create_stage'):
+        if full_refresh:
+            # The staging table is created from the source's first chunk, the same
+            # way a serial full sync creates the destination. Its range then carries
+            # on after that chunk. Ranges emptied since they were split are skipped.
+            for range_id, key_range in enumerate(ranges):
+                sql, parameters = key_range_query(source_table, partition_col, primary_key,
+                                                  key_range, chunk_size=self.chunk_size)
+                rows = self.source_db.query(sql, parameters=parameters or None)
+                row_count = rows.num_rows if rows else 0
+                if row_count:
+                    break
+                finished_ranges.add(range_id)
+            else:
+                logger.info(f'No rows to copy from {source_table}')
+                return None
+
+            last_row = rows[row_count - 1]
+            resume_keys[range_id] = (last_row[partition_col], last_row[primary_key])
+            for c in rows.columns:
+                if c.upper() in RESERVED_WORDS:
+                    rows.rename_column(c, f"{c}_col")
+            self.dest_db.copy(rows, staging_table, if_exists='drop', **kwargs)
+            copied_rows += row_count
+            if not self.chunk_size or row_count < self.chunk_size:
+                # The whole range fit in one chunk
+                finished_ranges.add(range_id)
+        else:
+            create_staging_table(self.dest_db, destination_table, staging_table)
+
+    logger.info(f'Copying {source_table} in {len(ranges)} ranges: {ranges}')
+
+    def copy_range(range_id):
+        if range_id in finished_ranges:
+            return 0
+        return copy_key_range(self.source_db, self.dest_db, source_table, staging_table,
+                              partition_col, primary_key, ranges[range_id],
+                              chunk_size=self.chunk_size, filter_col=filter_col,
+                              filter_value=filter_value, last_key=resume_keys[range_id],
+                              metrics=metrics, range_id=range_id, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        copied_rows += sum(executor.map(copy_range, range(len(ranges))))
+
+    if full_refresh:
+        # A short copy must not replace the destination, so the staging table is
+        # checked against the source before the swap
+        with metrics.phase(source_table, 'verify'):
+            staging_rows = self.dest_db.table(staging_table).num_rows
+            source_rows_after = self.source_db.table(source_table).num_rows
+        if not source_rows_before <= staging_rows <= source_rows_after:
+            raise ValueError(f"{staging_table} has {staging_rows} rows but {source_table} had "
+                             f"{source_rows_before} to {source_rows_after}. "
+                             f"{destination_table} was left in place.")
+        with metrics.phase(source_table, 'swap', rows=copied_rows):
+            if destination_exists and if_exists == 'truncate':
+                replace_table_contents(self.dest_db, staging_table, destination_table)
+            else:
+                swap_tables(self.dest_db, staging_table, destination_table)
+    else:
+        with metrics.phase(source_table, 'merge', rows=copied_rows):
+            merge_staging_table(self.dest_db, staging_table, destination_table, primary_key,
+                                updated_col)
+
+    logger.info(f'{source_table} synced to {destination_table}: {copied_rows} rows copied '
+                f'on {len(ranges)} workers.')
+
+def create_destination_db():
+    """
+    Instantiate the partner database connector based on the ``DB_TYPE`` Civis parameter.
+    Each call returns a new connector, so every sync worker gets its own connection.
+    `Returns:`
+        Parsons Redshift, MySQL or Postgres connector
+    """
+
+    if os.environ['DB_TYPE'].lower() == 'redshift':
+        return Redshift(username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
+            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
+            host=os.environ['DESTINATION_HOST'],
+            db=os.environ['DESTINATION_DB'],
+            port=5439,
+            timeout=1000,
+            s3_temp_bucket='parsons-tmc',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+    elif os.environ['DB_TYPE'].lower() == 'mysql':
+        return MySQL(
+            host=os.environ['DESTINATION_HOST'],
+            username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
+            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
+            db=os.environ['DESTINATION_DB'])
+
+    elif os.environ['DB_TYPE'] == 'postgres':
+        return Postgres(username=os.environ['DESTINATION_CREDENTIAL_USERNAME'],
+            password=os.environ['DESTINATION_CREDENTIAL_PASSWORD'],
+            host=os.environ['DESTINATION_HOST'],
+            db=os.environ['DESTINATION_DB'],
+            timeout=1000)
+
+    else:
+        raise ValueError("Unsupported DB Type provided!")
+
+def table_chunk_sizing(tbl):
+    """
+    Build the adaptive chunk sizing arguments of a ``TABLE_CONFIG`` entry.
+    `Args:`
+        tbl: dict
+            The ``TABLE_CONFIG`` entry. Adaptive sizing is on when ``adaptive_chunks``
+            is ``true``, with optional ``min_chunk_size``, ``max_chunk_size``,
+            ``target_chunk_seconds`` and ``max_chunk_mb`` overrides.
+    `Returns:`
+        dict of ``ChunkSizeController`` arguments, or ``None`` for a fixed chunk size
+    """
+
+    if tbl.get('adaptive_chunks', 'false') != 'true':
+        return None
+
+    chunk_sizing = {}
+    if tbl.get('min_chunk_size'):
+        chunk_sizing['min_size'] = int(tbl['min_chunk_size'])
+    if tbl.get('max_chunk_size'):
+        chunk_sizing['max_size'] = int(tbl['max_chunk_size'])
+    if tbl.get('target_chunk_seconds'):
+        chunk_sizing['target_seconds'] = float(tbl['target_chunk_seconds'])
+    if tbl.get('max_chunk_mb'):
+        chunk_sizing['max_bytes'] = int(float(tbl['max_chunk_mb']) * 1024 * 1024)
+    return chunk_sizing
+
+def sync_table(dbsync, destination_db, tbl, temp_bucket_region, state_store=None,
+               force_verify=False, metrics=None, schema_cache=None):
+    """
+    Run the sync described by a single ``TABLE_CONFIG`` entry.
+    `Args:`
+        dbsync: DBSync
+            The DBSync instance to run the sync with
+        destination_db: object
+            The partner database connector, used to check the table exists
+        tbl: dict
+            The ``TABLE_CONFIG`` entry
+        temp_bucket_region: str
+            The region of the S3 temp bucket
+        state_store: SyncStateStore
+            Optional store of sync watermarks for incremental syncs
+        force_verify: bool
+            Ignore saved watermarks and run every probe
+        metrics: SyncMetrics
+            Optional collector for sync timings
+        schema_cache: SchemaCache
+            Optional cache of table schemas shared by the syncs of a run
+    `Returns:`
+        ``True`` if the table was synced, ``False`` if it was skipped
+    """
+
+    metrics = metrics or SyncMetrics()
+    schema_cache = schema_cache or SchemaCache(rename=reserved_column_name)
+
+    with metrics.phase(tbl['source'], 'probe', query='source_exists'):
+        source_exists = schema_cache.table_exists(destination_db, tbl['source'])
+    if not source_exists:
+        logger.info(f"{tbl['source']} doesn't exist in source DB")
+        return False
+
+    logger.info(f"Running {tbl['type']} on {tbl['source']} to {tbl['destination']}...")
+
+    # Number of workers copying key ranges of a large table at once
+    partitions = int(tbl.get('parallel_partitions') or 1)
+
+    with metrics.phase(tbl['source'], 'sync', type=tbl['type']):
+        if tbl['type'] == 'full_refresh' and partitions > 1:
+
+            dbsync.table_sync_parallel(source_table = tbl['source'],
+                               destination_table = tbl['destination'],
+                               primary_key=tbl.get('primary_key') or tbl['distkey'],
+                               partitions=partitions,
+                               partition_col=tbl.get('partition_col'),
+                               if_exists=tbl['if_exists'],
+                               metrics=metrics,
+                               temp_bucket_region=temp_bucket_region,
+                               alter_table=True,
+                               distkey=tbl['distkey'],
+                               sortkey=tbl['sortkey'])
+
+        elif tbl['type'] == 'full_refresh':
+
+            dbsync.table_sync_full(source_table = tbl['source'],
+                               destination_table = tbl['destination'],
+                               if_exists=tbl['if_exists'],
+                               temp_bucket_region=temp_bucket_region,
+                               alter_table=True,
+                               distkey=tbl['distkey'],
+                               sortkey=tbl['sortkey'])
+
+        elif tbl['type'] == 'append':
+
+            # Default to distinct check being True
+            distinct_check = distinct_check_mode(tbl.get('distinct_check', 'true'))
+            primary_key = tbl.get('primary_key') or tbl['distkey']
+
+            if distinct_check not in (None, 'full'):
+                # DBSync only runs full checks, so the cheaper ones run here. Appended
+                # rows are the ones past the destination's largest primary key.
+                cutoff_value = None
+                if schema_cache.table_exists(dbsync.dest_db, tbl['destination']):
+                    cutoff_value = dbsync.dest_db.query(
+                        f"SELECT MAX({reserved_column_name(primary_key)}) AS max_key "
+                        f"FROM {tbl['destination']}").first
+                state_key = (db_identity(dbsync.source_db), db_identity(dbsync.dest_db),
+                             tbl['source'], tbl['destination'])
+                with metrics.phase(tbl['source'], 'distinct_check', mode=distinct_check):
+                    check_distinct_key(dbsync.source_db, tbl['source'], primary_key,
+                                       distinct_check, updated_col=primary_key,
+                                       cutoff_value=cutoff_value, state_store=state_store,
+                                       state_key=state_key,
+                                       full_check_days=int(tbl.get('distinct_check_days') or 7))
+
+            dbsync.table_sync_incremental(source_table = tbl['source'],
+                               destination_table = tbl['destination'],
+                               primary_key=primary_key,
+                               distinct_check=distinct_check == 'full',
+                               temp_bucket_region=temp_bucket_region,
+                               alter_table=True,
+                               distkey=tbl['distkey'],
+                               sortkey=tbl['sortkey'])
+
+        elif tbl['type'] == 'incremental':
+
+            # Default to distinct check being True
+            distinct_check = distinct_check_mode(tbl.get('distinct_check', 'true'))
+
+            dbsync.table_sync_incremental_upsert(source_table = tbl['source'],
+                               destination_table = tbl['destination'],
+                               primary_key=tbl.get('primary_key') or tbl['distkey'],
+                               updated_col=tbl['sortkey'],
+                               distinct_check=distinct_check,
+                               pagination=tbl.get('pagination', 'keyset'),
+                               prefetch=int(tbl.get('prefetch_chunks', 1)),
+                               state_store=state_store,
+                               force_verify=force_verify or tbl.get('force_verify') == 'true',
+                               merge_mode=tbl.get('merge_mode') or 'upsert',
+                               vacuum=tbl.get('vacuum', 'true') == 'true',
+                               chunk_sizing=table_chunk_sizing(tbl),
+                               transfer_format=tbl.get('transfer_format') or 'table',
+                               partitions=partitions,
+                               distinct_check_days=int(tbl.get('distinct_check_days') or 7),
+                               schema_cache=schema_cache,
+                               metrics=metrics,
+                               temp_bucket_region=temp_bucket_region,
+                               alter_table=True,
+                               distkey=tbl['distkey'],
+                               sortkey=tbl['sortkey'])
+        elif tbl['type'] == 'hash_diff':
+
+            hash_columns = tbl.get('hash_columns')
+            if isinstance(hash_columns, str):
+                hash_columns = [c.strip() for c in hash_columns.split(',') if c.strip()]
+
+            dbsync.table_sync_hash_diff(source_table = tbl['source'],
+                               destination_table = tbl['destination'],
+                               primary_key=tbl.get('primary_key') or tbl['distkey'],
+                               block_size=int(tbl.get('hash_block_size') or 10000),
+                               hash_columns=hash_columns or None,
+                               metrics=metrics,
+                               temp_bucket_region=temp_bucket_region,
+                               alter_table=True,
+                               distkey=tbl['distkey'],
+                               sortkey=tbl['sortkey'])
+        else:
+            raise ValueError("The only options for type are full_refresh, incremental, append "
+                             "and hash_diff!")
+
+    # Full refreshes recreate the destination, so its saved schema may be out of date
+    if tbl['type'] == 'full_refresh':
+        schema_cache.invalidate(dbsync.dest_db, tbl['destination'])
+
+    return True
+
+def _table_schedule_key(tbl):
+    # Highest priority first; within a priority, heaviest tables first so the
+    # longest sync starts as early as possible.
+    return (-float(tbl.get('priority') or 0), -float(tbl.get('weight') or 0))
+
+def run_table_syncs(table_config, temp_bucket_region, reverse=False, max_workers=1,
+                    db_type_concurrency=None, state_store=None, force_verify=False,
+                    metrics=None, schema_cache=None):
+    """
+    Run every ``TABLE_CONFIG`` entry on a bounded pool of workers.
+
+    Tables are started in order of their ``priority`` (higher first) and ``weight``
+    (heavier first) keys. Each worker opens its own TMC Redshift and partner database
+    connections. A failed table does not stop the others; a summary of every table is
+    logged at the end and an error is raised if any table failed.
+
+    `Args:`
+        table_config: list
+            The ``TABLE_CONFIG`` entries
+        temp_bucket_region: str
+            The region of the S3 temp bucket
+        reverse: bool
+            Sync from the partner database to TMC instead of TMC to the partner
+        max_workers: int
+            The maximum number of tables to sync at once
+        db_type_concurrency: dict
+            Maximum number of concurrent syncs touching each database type, e.g.
+            ``{'redshift': 4, 'mysql': 2}``. Types not listed are only limited by
+            ``max_workers``.
+        state_store: SyncStateStore
+            Optional store of sync watermarks for incremental syncs
+        force_verify: bool
+            Ignore saved watermarks and run every probe
+        metrics: SyncMetrics
+            Optional collector for sync timings
+        schema_cache: SchemaCache
+            Optional cache of table schemas, shared by every worker
+    `Returns:`
+        list of dicts with the ``source``, ``destination``, ``status``, ``seconds`` and
+        ``error`` of each table sync
+    """
+
+    db_type = os.environ['DB_TYPE'].lower()
+    db_type_concurrency = db_type_concurrency or {}
+    semaphores = {t: threading.BoundedSemaphore(int(n))
+                  for t, n in db_type_concurrency.items()}
+    # Every sync touches TMC Redshift and the partner database
+    sync_db_types = sorted({'redshift', db_type} & set(semaphores))
+
+    # Extend DBSync class with Yotam's upsert version
+    DBSync.table_sync_incremental_upsert = table_sync_incremental_upsert
+    DBSync.table_sync_hash_diff = table_sync_hash_diff
+    DBSync.table_sync_parallel = table_sync_parallel
+
+    # Every table's schema is read once per run, whichever worker needs it first
+    schema_cache = schema_cache or SchemaCache(state_store, rename=reserved_column_name)
+
+    def worker(tbl):
+        start = time.time()
+        result = {'source': tbl['source'], 'destination': tbl['destination'],
+                  'status': 'skipped', 'seconds': 0, 'error': None}
+
+        # Acquire in a fixed order so two workers can never deadlock
+        for t in sync_db_types:
+            semaphores[t].acquire()
+        try:
+            rs = Redshift()
+            destination_db = create_destination_db()
+            if reverse:
+                dbsync = DBSync(destination_db, rs)
+            else:
+                dbsync = DBSync(rs, destination_db)
+
+            if sync_table(dbsync, destination_db, tbl, temp_bucket_region,
+                          state_store=state_store, force_verify=force_verify,
+                          metrics=metrics, schema_cache=schema_cache):
+                result['status'] = 'success'
+        except Exception as error:
+            logger.error(f"{tbl['source']} failed to sync: {error}")
+            result['status'] = 'failed'
+            result['error'] = str(error)
+        finally:
+            for t in reversed(sync_db_types):
+                semaphores[t].release()
+
+        result['seconds'] = round(time.time() - start, 1)
+        return result
+
+    ordered_config = sorted(table_config, key=_table_schedule_key)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        results = list(executor.map(worker, ordered_config))
+
+    logger.info('Sync summary:')
+    for r in results:
+        logger.info(f"{r['status'].upper()} {r['source']} to {r['destination']} "
+                    f"in {r['seconds']}s" + (f": {r['error']}" if r['error'] else ''))
+
+    failed = [r['source'] for r in results if r['status'] == 'failed']
+    if failed:
+        raise RuntimeError(f"{len(failed)} table(s) failed to sync: {', '.join(failed)}")
+
+    return results
+
+def main():
+
+    # Instantiate class for TMC Redshift
+    setup_environment()
+    rs = Redshift()
+
+    # Parse Civis Parameters from environment variables to useful objects
+    temp_bucket_region = os.environ['AWS_REGION'] if os.environ['AWS_REGION']!='Default' else None
+
+    if ',' in os.environ['TABLE_CONFIG']:
+        table_config_str = os.environ['TABLE_CONFIG'].replace(', ',',')
+        table_config = list(ast.literal_eval(table_config_str)) if '},' in table_config_str else [ast.literal_eval(table_config_str)]
+    else:
+        table_config = rs.query(f"SELECT * FROM {os.environ['TABLE_CONFIG']}")
+    reverse = False if os.environ['DIRECTION']=='tmc_to_outside' else True
+
+    # Default to syncing one table at a time
+    max_workers = int(os.environ.get('MAX_WORKERS') or 1)
+    if os.environ.get('DB_TYPE_CONCURRENCY'):
+        db_type_concurrency = ast.literal_eval(os.environ['DB_TYPE_CONCURRENCY'])
+    else:
+        db_type_concurrency = DEFAULT_DB_TYPE_CONCURRENCY
+
+    # Saved watermarks let incremental syncs skip their full-table probes
+    state_store = SyncStateStore.from_env()
+    force_verify = os.environ.get('FORCE_VERIFY', 'false').lower() == 'true'
+
+    # Saved table schemas are read again from information_schema after this many seconds
+    schema_cache = SchemaCache(state_store, rename=reserved_column_name,
+                               max_age_seconds=int(os.environ.get('SCHEMA_CACHE_MAX_AGE')
+                                                   or 24 * 60 * 60))
+
+    # Structured timings of every sync phase, optionally written as JSON lines
+    metrics = SyncMetrics(path=os.environ.get('SYNC_METRICS_PATH'))
+
+    try:
+        run_table_syncs(table_config, temp_bucket_region, reverse=reverse,
+                        max_workers=max_workers, db_type_concurrency=db_type_concurrency,
+                        state_store=state_store, force_verify=force_verify,
+                        metrics=metrics, schema_cache=schema_cache)
+    finally:
+        if state_store:
+            state_store.push()
+
+        metrics.report()
+        if os.environ.get('SYNC_METRICS_TABLE'):
+            metrics.to_redshift(rs, os.environ['SYNC_METRICS_TABLE'],
+                                temp_bucket_region=temp_bucket_region)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
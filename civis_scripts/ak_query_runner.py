@@ -0,0 +1,336 @@
+import os
+import re
+import ast
+import time
+import logging
+import datetime
+from parsons import Redshift, MySQL, Table
+from sync_state import SyncStateStore, db_identity
+from query_cache import QueryCache
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+TMC_CIVIS_DATABASE = 815
+
+# Query templates are looked up relative to the actionKit_scripts directory
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'actionKit_scripts')
+
+# {% if name %} ... {% else %} ... {% endif %} blocks, not nested
+CONDITIONAL_BLOCK = re.compile(
+    r'\{%\s*if\s+(not\s+)?([A-Za-z_]\w*)\s*%\}(.*?)(?:\{%\s*else\s*%\}(.*?))?\{%\s*endif\s*%\}',
+    re.DOTALL)
+# {{name}} and {name} placeholders. Names start with a letter, so regex quantifiers
+# such as {2} are left alone.
+PLACEHOLDER = re.compile(r'\{\{\s*([A-Za-z_]\w*)\s*\}\}|\{([A-Za-z_]\w*)\}')
+
+# Columns added to every result row, recording the window the run covered
+WINDOW_COLUMNS = ['window_start', 'window_end']
+
+def set_env_var(name, value, overwrite=False):
+    """
+    Set an environment variable to a value.
+    `Args:`
+        name: str
+            Name of the env var
+        value: str
+            New value for the env var
+        overwrite: bool
+            Whether to set the env var even if it already exists
+    """
+    # Do nothing if we don't have a value
+    if not value:
+        return
+
+    # Do nothing if env var already exists
+    if os.environ.get(name) and not overwrite:
+        return
+
+    os.environ[name] = value
+
+def setup_environment(redshift_parameter="REDSHIFT", aws_parameter="AWS"):
+    """
+    Sets up environment variables needed for various common services used by our scripts.
+    Call this at the beginning of your script.
+    `Args:`
+        redshift_parameter: str
+            Name of the Civis script parameter holding Redshift credentials. This parameter
+            should be of type "database (2 dropdown)" in Civis.
+        aws_parameter: str
+            Name of the Civis script parameter holding AWS credentials.
+    """
+
+    env = os.environ
+
+    # Civis setup
+
+    set_env_var('CIVIS_DATABASE', str(TMC_CIVIS_DATABASE))
+
+    # Redshift setup
+
+    set_env_var('REDSHIFT_PORT', '5432')
+    set_env_var('REDSHIFT_DB', 'dev')
+    set_env_var('REDSHIFT_HOST', env.get(f'{redshift_parameter}_HOST'))
+    set_env_var('REDSHIFT_USERNAME', env.get(f'{redshift_parameter}_CREDENTIAL_USERNAME'))
+    set_env_var('REDSHIFT_PASSWORD', env.get(f'{redshift_parameter}_CREDENTIAL_PASSWORD'))
+
+    # AWS setup
+
+    set_env_var('S3_TEMP_BUCKET', 'parsons-tmc')
+    set_env_var('AWS_ACCESS_KEY_ID', env.get(f'{aws_parameter}_USERNAME'))
+    set_env_var('AWS_SECRET_ACCESS_KEY', env.get(f'{aws_parameter}_PASSWORD'))
+
+def load_template(path):
+    """
+    Read a query template. Relative paths are looked up in ``actionKit_scripts``.
+    `Args:`
+        path: str
+            Path of the template
+    `Returns:`
+        str
+    """
+
+    if not os.path.isabs(path) and not os.path.exists(path):
+        path = os.path.join(TEMPLATE_DIR, path)
+    with open(path) as f:
+        return f.read()
+
+def render_template(template, params):
+    """
+    Render a query template into SQL and its bound parameters. ``{% if %}`` blocks
+    are kept or dropped by the truth of their parameter, and every ``{name}`` or
+    ``{{name}}`` placeholder becomes a ``%s`` bound to the parameter's value, so values
+    are never formatted into the SQL text.
+    `Args:`
+        template: str
+            The query template
+        params: dict
+            The parameter values
+    `Returns:`
+        ``(sql, parameters)`` tuple
+    """
+
+    def conditional(match):
+        negate, name, body, else_body = match.groups()
+        if name not in params:
+            raise ValueError(f"Query template condition {name} has no parameter value")
+        keep = not params[name] if negate else bool(params[name])
+        return body if keep else (else_body or '')
+
+    sql = CONDITIONAL_BLOCK.sub(conditional, template)
+
+    names = [a or b for a, b in PLACEHOLDER.findall(sql)]
+    missing = sorted(set(n for n in names if n not in params))
+    if missing:
+        raise ValueError(f"Query template placeholders have no parameter value: {', '.join(missing)}")
+
+    if not names:
+        return sql, None
+
+    # Literal % signs must be doubled once the query has bound parameters
+    sql = PLACEHOLDER.sub('%s', sql.replace('%', '%%'))
+    return sql, [params[n] for n in names]
+
+def cache_time(now):
+    """
+    Truncate a time bound into a query to the day, so reruns on the same day share a
+    cache key. The sync versions of the tables the query reads still tell when its
+    cached results went out of date.
+    """
+
+    if isinstance(now, datetime.datetime):
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return str(now)[:10]
+
+def execute_query(db, sql, parameters=None, cache=None, cache_parameters=None):
+    """
+    Run a rendered query, answering it from the cache when the same query has already
+    run since the tables it reads were last synced.
+    `Args:`
+        db: Redshift or MySQL
+            The connector to run the query on
+        sql: str
+            The rendered SQL
+        parameters: list
+            The bound parameters
+        cache: QueryCache
+            Optional result cache
+        cache_parameters: list
+            The parameters to key the cache by, if not the bound parameters
+    `Returns:`
+        parsons Table
+    """
+
+    if cache_parameters is None:
+        cache_parameters = parameters
+
+    if cache:
+        tbl = cache.get(db_identity(db), sql, cache_parameters)
+        if tbl is not None:
+            logger.info(f"Served {tbl.num_rows} rows from the query cache")
+            return tbl
+
+    tbl = db.query(sql, parameters=parameters) or Table()
+
+    if cache:
+        cache.put(db_identity(db), sql, cache_parameters, tbl)
+    return tbl
+
+def merge_results(rs, tbl, result_table, merge='append', key=None, **copy_args):
+    """
+    Write the results of a run to the persistent result table.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        tbl: Table
+            The results of the run
+        result_table: str
+            Full table path of the result table
+        merge: str
+            ``append`` adds the rows of each run, ``replace`` swaps in the rows of the
+            latest run and ``upsert`` replaces the rows that share a ``key`` value
+        key: str
+            The key column of ``upsert`` merges
+        **copy_args: kwargs
+            Optional copy arguments
+    """
+
+    if merge == 'replace':
+        rs.copy(tbl, result_table, if_exists='drop', **copy_args)
+        return
+
+    if merge == 'append' or not rs.table_exists(result_table):
+        rs.copy(tbl, result_table, if_exists='append', **copy_args)
+        return
+
+    if merge != 'upsert':
+        raise ValueError(f"Unknown merge mode {merge}")
+    if not key:
+        raise ValueError("Upsert merges need a key column")
+
+    staging_table = f"{result_table}_stage"
+    columns = ', '.join(tbl.columns)
+    rs.copy(tbl, staging_table, if_exists='drop', **copy_args)
+
+    try:
+        with rs.connection() as connection:
+            rs.query_with_connection(f"""
+                DELETE FROM {result_table} USING {staging_table} stage
+                WHERE {result_table}.{key} = stage.{key}""", connection, commit=False)
+            rs.query_with_connection(f"""
+                INSERT INTO {result_table} ({columns}) SELECT {columns} FROM {staging_table}""",
+                connection, commit=False)
+            connection.commit()
+    finally:
+        # Don't leave the staging table behind when the merge fails
+        rs.query(f"DROP TABLE IF EXISTS {staging_table}")
+
+def run_templated_query(source_db, rs, query, state_store=None, full_refresh=False, cache=None,
+                        **copy_args):
+    """
+    Render and run one query template and merge its results into its result table.
+    A query that has run before is rendered with ``partial_run`` set and ``last_run``
+    bound to the time of its previous run, so templates that support it only read
+    what changed since then.
+    `Args:`
+        source_db: Redshift or MySQL
+            The connector to run the query on
+        rs: Redshift
+            The parsons Redshift connector holding the result table
+        query: dict
+            The query config: ``name``, ``template``, ``result_table`` and optionally
+            ``merge``, ``key`` and ``params``
+        state_store: SyncStateStore
+            Optional store of the ``last_run`` watermark of each query
+        full_refresh: bool
+            Ignore the saved watermark and run over the full history
+        cache: QueryCache
+            Optional result cache
+        **copy_args: kwargs
+            Optional copy arguments
+    `Returns:`
+        The number of result rows
+    """
+
+    name = query['name']
+    result_table = query['result_table']
+    state_key = (db_identity(source_db), db_identity(rs), name, result_table)
+
+    # Take "now" from the source database, so it matches the times stored there
+    now = source_db.query("SELECT CURRENT_TIMESTAMP AS now").first
+
+    last_run = None
+    if state_store and not full_refresh:
+        state = state_store.get_state(*state_key)
+        last_run = state['watermark'] if state else None
+
+    params = dict(query.get('params') or {})
+    params.update(partial_run=last_run is not None, last_run=last_run, now=now)
+
+    template = load_template(query['template'])
+    sql, parameters = render_template(template, params)
+    cache_parameters = render_template(template, {**params, 'now': cache_time(now)})[1]
+
+    start = time.time()
+    tbl = execute_query(source_db, sql, parameters, cache=cache,
+                        cache_parameters=cache_parameters)
+    logger.info(f"{name} returned {tbl.num_rows} rows in {time.time() - start:.1f} seconds"
+                f"{' since ' + str(last_run) if last_run else ''}")
+
+    if tbl.num_rows:
+        for column, value in zip(WINDOW_COLUMNS, (last_run, now)):
+            tbl.add_column(column, value)
+        merge_results(rs, tbl, result_table, merge=query.get('merge', 'append'),
+                      key=query.get('key'), **copy_args)
+
+    if state_store:
+        state_store.save_state(*state_key, now, rows_copied=tbl.num_rows)
+
+    return tbl.num_rows
+
+def main():
+    setup_environment()
+    rs = Redshift()
+
+    temp_bucket_region = os.environ.get('AWS_REGION')
+    temp_bucket_region = temp_bucket_region if temp_bucket_region != 'Default' else None
+
+    # A list of query configs, e.g.
+    # [{'name': 'users_taken_action_ever', 'template': 'users_taken_action_ever_v2',
+    #   'db': 'mysql', 'result_table': 'coc_reporting.users_taken_action_ever'}]
+    queries = ast.literal_eval(os.environ['QUERY_CONFIG'])
+    if isinstance(queries, dict):
+        queries = [queries]
+
+    full_refresh = os.environ.get('QUERY_FULL_REFRESH', 'false').lower() == 'true'
+
+    # last_run watermarks; without them every run covers the full history
+    state_store = SyncStateStore.from_env('QUERY_RUNNER_STATE')
+
+    # Optional result cache, invalidated by the sync state of the tables each query reads
+    cache = QueryCache.from_env(state_store=SyncStateStore.from_env())
+
+    mysql = None
+    try:
+        for query in queries:
+            if query.get('db', 'mysql').lower() == 'mysql':
+                mysql = mysql or MySQL()
+                source_db = mysql
+            else:
+                source_db = rs
+
+            run_templated_query(source_db, rs, query, state_store=state_store,
+                                full_refresh=full_refresh, cache=cache,
+                                temp_bucket_region=temp_bucket_region)
+    finally:
+        if state_store:
+            state_store.push()
+
+
+if __name__ == '__main__':
+    main()
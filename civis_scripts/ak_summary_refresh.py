@@ -0,0 +1,307 @@
+import os
+import time
+import logging
+import datetime
+from parsons import Redshift
+from sync_state import SyncStateStore, db_identity
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+TMC_CIVIS_DATABASE = 815
+
+SUMMARY_TABLE = 'coc_summary_tables.ak_summary_table'
+SUMMARY_SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ak_summary_table')
+
+# Comment lines in the ak_summary_table script that mark out the reusable select
+SELECT_START_MARKER = '-- summary select start'
+SELECT_END_MARKER = '-- summary select end'
+WEEK_FILTER_MARKER = '-- incremental week filter'
+
+# The tables whose changes move rows of the summary, with the column that tracks
+# changes and a query for the fundraiser weeks touched between two watermarks
+CHANGE_SOURCES = {
+    'coc_ak.core_order': ('updated_at', """
+        SELECT DISTINCT DATE_TRUNC('week', created_at) fundraiser_week
+        FROM coc_ak.core_order
+        WHERE updated_at > %s AND updated_at <= %s"""),
+    'coc_ak.core_transaction': ('updated_at', """
+        SELECT DISTINCT DATE_TRUNC('week', ord.created_at) fundraiser_week
+        FROM coc_ak.core_transaction trans
+        JOIN coc_ak.core_order ord ON ord.id = trans.order_id
+        WHERE trans.updated_at > %s AND trans.updated_at <= %s"""),
+    # An open changes the open rate of every order row of users who acted on the mailing
+    'coc_ak.core_open': ('created_at', """
+        SELECT DISTINCT DATE_TRUNC('week', ord.created_at) fundraiser_week
+        FROM coc_ak.core_open opene
+        JOIN coc_ak.core_action actions ON actions.mailing_id = opene.mailing_id
+        JOIN coc_ak.core_order ord ON ord.user_id = actions.user_id
+        WHERE opene.created_at > %s AND opene.created_at <= %s"""),
+}
+
+def set_env_var(name, value, overwrite=False):
+    """
+    Set an environment variable to a value.
+    `Args:`
+        name: str
+            Name of the env var
+        value: str
+            New value for the env var
+        overwrite: bool
+            Whether to set the env var even if it already exists
+    """
+    # Do nothing if we don't have a value
+    if not value:
+        return
+
+    # Do nothing if env var already exists
+    if os.environ.get(name) and not overwrite:
+        return
+
+    os.environ[name] = value
+
+def setup_environment(redshift_parameter="REDSHIFT", aws_parameter="AWS"):
+    """
+    Sets up environment variables needed for various common services used by our scripts.
+    Call this at the beginning of your script.
+    `Args:`
+        redshift_parameter: str
+            Name of the Civis script parameter holding Redshift credentials. This parameter
+            should be of type "database (2 dropdown)" in Civis.
+        aws_parameter: str
+            Name of the Civis script parameter holding AWS credentials.
+    """
+
+    env = os.environ
+
+    # Civis setup
+
+    set_env_var('CIVIS_DATABASE', str(TMC_CIVIS_DATABASE))
+
+    # Redshift setup
+
+    set_env_var('REDSHIFT_PORT', '5432')
+    set_env_var('REDSHIFT_DB', 'dev')
+    set_env_var('REDSHIFT_HOST', env.get(f'{redshift_parameter}_HOST'))
+    set_env_var('REDSHIFT_USERNAME', env.get(f'{redshift_parameter}_CREDENTIAL_USERNAME'))
+    set_env_var('REDSHIFT_PASSWORD', env.get(f'{redshift_parameter}_CREDENTIAL_PASSWORD'))
+
+    # AWS setup
+
+    set_env_var('S3_TEMP_BUCKET', 'parsons-tmc')
+    set_env_var('AWS_ACCESS_KEY_ID', env.get(f'{aws_parameter}_USERNAME'))
+    set_env_var('AWS_SECRET_ACCESS_KEY', env.get(f'{aws_parameter}_PASSWORD'))
+
+def read_summary_select(path=SUMMARY_SQL_PATH):
+    """
+    Read the summary select out of the ak_summary_table script, so the full rebuild
+    and the incremental refresh share one definition of the table.
+    `Args:`
+        path: str
+            Path of the ak_summary_table script
+    `Returns:`
+        str
+    """
+
+    with open(path) as f:
+        sql = f.read()
+
+    if SELECT_START_MARKER not in sql or SELECT_END_MARKER not in sql:
+        raise ValueError(f"{path} is missing the summary select markers")
+
+    select = sql[sql.index(SELECT_START_MARKER) + len(SELECT_START_MARKER):sql.index(SELECT_END_MARKER)]
+    if WEEK_FILTER_MARKER not in select:
+        raise ValueError(f"{path} is missing the incremental week filter marker")
+
+    return select
+
+def week_filtered_select(select, weeks):
+    """
+    Limit the summary select to a set of fundraiser weeks.
+    `Args:`
+        select: str
+            The summary select
+        weeks: list
+            The weeks to keep, bound as query parameters
+    `Returns:`
+        str
+    """
+
+    placeholders = ', '.join(['%s'] * len(weeks))
+    return select.replace(WEEK_FILTER_MARKER,
+                          f"AND DATE_TRUNC('week', ord.created_at) IN ({placeholders})")
+
+def rebuild_summary_table(rs, select, table):
+    """
+    Rebuild the whole summary table next to the live one and swap it in with renames
+    inside one transaction, so readers never see a missing or half-built table.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        select: str
+            The summary select
+        table: str
+            Full table path of the summary table
+    """
+
+    new_table = f"{table}_new"
+    old_table = f"{table}_old"
+
+    rs.query(f"DROP TABLE IF EXISTS {new_table}")
+    rs.query(f"CREATE TABLE {new_table} AS {select}")
+    rs.query(f"DROP TABLE IF EXISTS {old_table}")
+    # The first run has no live table yet, so give the swap an empty one to move aside
+    rs.query(f"CREATE TABLE IF NOT EXISTS {table} (LIKE {new_table})")
+
+    with rs.connection() as connection:
+        rs.query_with_connection(f"ALTER TABLE {table} RENAME TO {old_table.split('.')[-1]}",
+                                 connection, commit=False)
+        rs.query_with_connection(f"ALTER TABLE {new_table} RENAME TO {table.split('.')[-1]}",
+                                 connection, commit=False)
+        connection.commit()
+
+    rs.query(f"DROP TABLE {old_table}")
+
+def refresh_summary_weeks(rs, select, table, weeks):
+    """
+    Recompute the summary rows of some fundraiser weeks and swap them in with a
+    delete and insert in one transaction. The week before each one is computed as
+    well, so the week-over-week growth of the first refreshed week has its previous
+    week to compare against, but only the requested weeks are written.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        select: str
+            The summary select
+        table: str
+            Full table path of the summary table
+        weeks: list
+            The fundraiser weeks to recompute
+    """
+
+    weeks = sorted(set(weeks))
+    context_weeks = sorted(set(weeks) | {w - datetime.timedelta(days=7) for w in weeks})
+    placeholders = ', '.join(['%s'] * len(weeks))
+
+    delete_sql = f"DELETE FROM {table} WHERE fundraiser_week IN ({placeholders})"
+    insert_sql = f"""
+        INSERT INTO {table}
+        SELECT * FROM ({week_filtered_select(select, context_weeks)}) refreshed
+        WHERE fundraiser_week IN ({placeholders})"""
+
+    with rs.connection() as connection:
+        rs.query_with_connection(delete_sql, connection, parameters=weeks, commit=False)
+        rs.query_with_connection(insert_sql, connection, parameters=context_weeks + weeks,
+                                 commit=False)
+        connection.commit()
+
+def get_high_marks(rs):
+    """
+    Get the latest change value of each change source.
+    `Returns:`
+        dict of source table to its high mark
+    """
+
+    high_marks = {}
+    for source_table, (change_col, _) in CHANGE_SOURCES.items():
+        tbl = rs.query(f"SELECT MAX({change_col}) high_mark FROM {source_table}")
+        high_marks[source_table] = tbl.first if tbl else None
+    return high_marks
+
+def get_touched_weeks(rs, watermarks, high_marks):
+    """
+    Get the fundraiser weeks with orders, transactions or opens that changed between
+    the saved watermarks and the current high marks.
+    `Returns:`
+        set of weeks
+    """
+
+    weeks = set()
+    for source_table, (_, touched_sql) in CHANGE_SOURCES.items():
+        if high_marks[source_table] is None:
+            continue
+        tbl = rs.query(touched_sql, parameters=[watermarks[source_table], high_marks[source_table]])
+        if tbl:
+            weeks.update(w for w in tbl['fundraiser_week'] if w is not None)
+    return weeks
+
+def refresh_summary_table(rs, table=SUMMARY_TABLE, sql_path=SUMMARY_SQL_PATH, state_store=None,
+                          full_refresh=False):
+    """
+    Bring the summary table up to date. Only the fundraiser weeks touched since the
+    last refresh are recomputed. The whole table is rebuilt when ``full_refresh`` is
+    set, when the table does not exist yet or when there is no saved watermark for
+    every change source.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        table: str
+            Full table path of the summary table
+        sql_path: str
+            Path of the ak_summary_table script
+        state_store: SyncStateStore
+            Optional store of the watermark of each change source
+        full_refresh: bool
+            Rebuild the whole table
+    """
+
+    select = read_summary_select(sql_path)
+    identity = db_identity(rs)
+
+    # Read the high marks first, so changes made during the refresh are picked up next time
+    high_marks = get_high_marks(rs)
+
+    watermarks = {}
+    if state_store:
+        for source_table in CHANGE_SOURCES:
+            state = state_store.get_state(identity, identity, source_table, table)
+            watermarks[source_table] = state['watermark'] if state else None
+
+    if (full_refresh or not state_store or not rs.table_exists(table)
+            or any(w is None for w in watermarks.values())):
+        logger.info(f"Rebuilding all of {table}")
+        rebuild_summary_table(rs, select, table)
+    else:
+        weeks = get_touched_weeks(rs, watermarks, high_marks)
+        if not weeks:
+            logger.info(f"No fundraiser weeks of {table} have changed")
+        else:
+            logger.info(f"Refreshing {len(weeks)} fundraiser weeks of {table}")
+            refresh_summary_weeks(rs, select, table, weeks)
+
+    if state_store:
+        for source_table, high_mark in high_marks.items():
+            if high_mark is not None:
+                state_store.save_state(identity, identity, source_table, table, high_mark)
+
+def main():
+    setup_environment()
+
+    #set begin time to see how long the script takes to run
+    start = time.time()
+
+    rs = Redshift()
+    table = os.environ.get('AK_SUMMARY_TABLE') or SUMMARY_TABLE
+    sql_path = os.environ.get('AK_SUMMARY_SQL') or SUMMARY_SQL_PATH
+    full_refresh = os.environ.get('AK_SUMMARY_FULL_REFRESH', 'false').lower() == 'true'
+
+    # Watermarks of the change sources; without them every run is a full rebuild
+    state_store = SyncStateStore.from_env('AK_SUMMARY_STATE')
+
+    try:
+        refresh_summary_table(rs, table=table, sql_path=sql_path, state_store=state_store,
+                              full_refresh=full_refresh)
+    finally:
+        if state_store:
+            state_store.push()
+
+    logger.info(f"Summary refresh took {time.time() - start:.1f} seconds")
+
+
+if __name__ == '__main__':
+    main()
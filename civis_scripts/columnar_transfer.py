@@ -0,0 +1,247 @@
+import io
+import os
+import uuid
+import logging
+import tempfile
+from parsons import S3
+
+# pyarrow is optional; it is only needed for the arrow and unload transfer formats
+try:
+    import pyarrow
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+# Rows fetched from the cursor at a time while building an Arrow table
+FETCH_BATCH_ROWS = 50000
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("The arrow and unload transfer formats need pyarrow installed.")
+
+
+def quote_column(dialect, column):
+    """
+    Quote a column name, so columns named after reserved words can be selected.
+    """
+
+    return f"`{column}`" if dialect == 'mysql' else f'"{column}"'
+
+
+def fetch_arrow(db, sql, parameters=None):
+    """
+    Run a query and collect its results straight into an Arrow table, column by
+    column, without building a parsons Table or a dict per row.
+    `Args:`
+        db: object
+            The parsons database connector
+        sql: str
+            The query
+        parameters: list
+            The bound parameters
+    `Returns:`
+        ``pyarrow.Table``
+    """
+
+    require_pyarrow()
+
+    with db.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql, parameters or None)
+        names = [d[0] for d in cursor.description]
+        columns = [[] for _ in names]
+
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_ROWS)
+            if not rows:
+                break
+            for values, column in zip(zip(*rows), columns):
+                column.extend(values)
+        cursor.close()
+
+    return pyarrow.table([pyarrow.array(c) for c in columns], names=names)
+
+
+def _s3_credentials(rs):
+    # parsons builds the CREDENTIALS clause from the AWS environment variables
+    return rs.get_creds(None, None)
+
+
+def copy_parquet_from_s3(rs, table_name, bucket, key_prefix, region=None):
+    """
+    COPY the Parquet files under an S3 prefix into a Redshift table. The file
+    columns must be in table order.
+    """
+
+    region_sql = f"REGION '{region}'" if region else ''
+    rs.query(f"COPY {table_name} FROM 's3://{bucket}/{key_prefix}' "
+             f"{_s3_credentials(rs)} FORMAT AS PARQUET {region_sql}")
+
+
+def mysql_csv_table(tbl):
+    """
+    Cast the columns of an Arrow table that ``LOAD DATA`` cannot parse as written by
+    ``pyarrow.csv``: booleans become 1 and 0, and timestamps with a time zone become
+    UTC times without one.
+    `Args:`
+        tbl: pyarrow.Table
+    `Returns:`
+        pyarrow.Table
+    """
+
+    require_pyarrow()
+    for i, field in enumerate(tbl.schema):
+        if pyarrow.types.is_boolean(field.type):
+            tbl = tbl.set_column(i, field.name, tbl.column(i).cast(pyarrow.int8()))
+        elif pyarrow.types.is_timestamp(field.type) and field.type.tz is not None:
+            tbl = tbl.set_column(i, field.name,
+                                 tbl.column(i).cast(pyarrow.timestamp(field.type.unit)))
+    return tbl
+
+
+def load_arrow(db, dialect, tbl, table_name, region=None):
+    """
+    Bulk load an Arrow table with the destination's native loader: ``COPY FROM
+    STDIN`` for Postgres, ``LOAD DATA LOCAL INFILE`` for MySQL and ``COPY ... FORMAT
+    AS PARQUET`` from the S3 temp bucket for Redshift. The table columns must match
+    the destination column names.
+    `Args:`
+        db: object
+            The parsons database connector of the destination
+        dialect: str
+            ``redshift``, ``mysql`` or ``postgres``
+        tbl: pyarrow.Table
+            The rows to load
+        table_name: str
+            Full path of the destination table
+        region: str
+            The region of the S3 temp bucket, for Redshift
+    """
+
+    require_pyarrow()
+    columns = ', '.join(quote_column(dialect, c) for c in tbl.column_names)
+
+    if dialect == 'redshift':
+        bucket = os.environ['S3_TEMP_BUCKET']
+        key = f"coc_sync_transfer/{uuid.uuid4().hex}.parquet"
+        local_path = tempfile.mkstemp(suffix='.parquet')[1]
+        try:
+            pq.write_table(tbl, local_path, compression='snappy')
+            s3 = S3()
+            s3.put_file(bucket, key, local_path)
+            try:
+                copy_parquet_from_s3(db, table_name, bucket, key, region=region)
+            finally:
+                s3.remove_file(bucket, key)
+        finally:
+            os.remove(local_path)
+
+    elif dialect == 'postgres':
+        buffer = io.BytesIO()
+        pa_csv.write_csv(tbl, buffer)
+        buffer.seek(0)
+        with db.connection() as connection:
+            cursor = connection.cursor()
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN "
+                               f"WITH (FORMAT csv, HEADER true)", buffer)
+            connection.commit()
+
+    elif dialect == 'mysql':
+        # Every value is quoted and NULLs are written as a bare NULL, which LOAD DATA
+        # reads as NULL while a quoted "NULL" or "" stays a string. Quotes are doubled
+        # by pyarrow and backslashes are data, so nothing is escaped.
+        # The connection has to allow LOCAL INFILE.
+        local_path = tempfile.mkstemp(suffix='.csv')[1]
+        try:
+            pa_csv.write_csv(mysql_csv_table(tbl), local_path,
+                             write_options=pa_csv.WriteOptions(null_string='NULL',
+                                                               quoting_style='all_valid'))
+            with db.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute(f"""LOAD DATA LOCAL INFILE %s INTO TABLE {table_name}
+                                   FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                                   ESCAPED BY ''
+                                   LINES TERMINATED BY '\\n' IGNORE 1 LINES
+                                   ({columns})""", [local_path])
+                connection.commit()
+        finally:
+            os.remove(local_path)
+
+    else:
+        raise ValueError(f"Unsupported destination dialect {dialect}")
+
+
+def unload_to_s3(rs, sql, parameters, bucket, key_prefix, region=None):
+    """
+    UNLOAD the results of a Redshift query to compressed Parquet files in S3. The
+    work is split across the cluster's slices and no rows pass through Python.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector of the source
+        sql: str
+            The query to unload
+        parameters: list
+            The bound parameters of the query
+        bucket: str
+            The bucket to unload to
+        key_prefix: str
+            The key prefix of the unloaded files
+        region: str
+            The region of the bucket
+    `Returns:`
+        list of the unloaded keys
+    """
+
+    # UNLOAD takes its query as a string literal, so the parameters are bound into it
+    # by the driver first
+    with rs.connection() as connection:
+        query = connection.cursor().mogrify(sql, parameters or None).decode()
+
+    region_sql = f"REGION '{region}'" if region else ''
+    rs.query(f"UNLOAD (%s) TO %s {_s3_credentials(rs)} FORMAT AS PARQUET ALLOWOVERWRITE "
+             f"{region_sql}", parameters=[query, f"s3://{bucket}/{key_prefix}"])
+
+    return sorted(S3().list_keys(bucket, key_prefix))
+
+
+def load_unloaded_parquet(db, dialect, bucket, key_prefix, keys, table_name, region=None):
+    """
+    Load the files of an UNLOAD into a destination table. Redshift COPYs them
+    straight from S3; other destinations read them one file at a time and bulk load
+    each with ``load_arrow``.
+    `Returns:`
+        The number of rows loaded, or ``None`` when Redshift loaded them directly
+    """
+
+    if dialect == 'redshift':
+        copy_parquet_from_s3(db, table_name, bucket, key_prefix, region=region)
+        return None
+
+    require_pyarrow()
+    s3 = S3()
+    rows = 0
+    for key in keys:
+        local_path = s3.get_file(bucket, key)
+        try:
+            tbl = pq.read_table(local_path)
+        finally:
+            os.remove(local_path)
+        load_arrow(db, dialect, tbl, table_name, region=region)
+        rows += tbl.num_rows
+    return rows
+
+
+def remove_s3_keys(bucket, keys):
+    s3 = S3()
+    for key in keys:
+        s3.remove_file(bucket, key)
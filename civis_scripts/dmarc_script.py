@@ -1,12 +1,92 @@
 import os 
 import datetime 
-import pandas as pd 
 import time 
 import sys
 import json
+import gzip
+import zipfile
+import ipaddress
+import shutil
+import hashlib
+import tempfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from parsons import Table, S3, Redshift, utilities, logger 
-import numpy as np
+
+# Leading bytes of the compressed formats reports are mailed in
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+
+# Columns of the DMARC table, one row per <record> of an aggregate report. Dates are
+# timestamps, IPs are stored in their canonical compressed form and the policy and
+# auth results are short lowercase codes or booleans, so the widths stay small.
+DMARC_COLUMN_TYPES = {'orgname': 'varchar(256)',
+                      'email': 'varchar(256)',
+                      'reportid': 'varchar(256)',
+                      'date_range_begin': 'timestamp',
+                      'date_range_end': 'timestamp',
+                      'domain': 'varchar(255)',
+                      'adkim': 'char(1)',
+                      'aspf': 'char(1)',
+                      'p': 'varchar(10)',
+                      'sp': 'varchar(10)',
+                      'pct': 'smallint',
+                      'source_ip': 'varchar(39)',
+                      'disposition': 'varchar(10)',
+                      'dkim_pass': 'boolean',
+                      'spf_pass': 'boolean',
+                      'count': 'integer',
+                      'header_from': 'varchar(255)',
+                      'dkim_domain': 'varchar(255)',
+                      'dkim_result': 'varchar(9)',
+                      'spf_domain': 'varchar(255)',
+                      'spf_result': 'varchar(9)'}
+DMARC_DISTKEY = 'domain'
+DMARC_SORTKEY = 'date_range_begin'
+
+# How each raw text value is converted to its column type
+EPOCH_FIELDS = ['date_range_begin', 'date_range_end']
+INTEGER_FIELDS = ['pct', 'count']
+PASS_FAIL_FIELDS = ['dkim_pass', 'spf_pass']
+CODE_FIELDS = ['adkim', 'aspf', 'p', 'sp', 'disposition', 'dkim_result', 'spf_result']
+DOMAIN_FIELDS = ['domain', 'header_from', 'dkim_domain', 'spf_domain']
+
+# Columns of the daily rollup, one row per report day, domain and source IP
+DMARC_ROLLUP_COLUMN_TYPES = {'report_date': 'date',
+                             'domain': 'varchar(255)',
+                             'source_ip': 'varchar(39)',
+                             'reports': 'integer',
+                             'messages': 'bigint',
+                             'dkim_pass': 'bigint',
+                             'spf_pass': 'bigint',
+                             'dmarc_pass': 'bigint',
+                             'quarantined': 'bigint',
+                             'rejected': 'bigint'}
+
+# Paths of the report-level values, relative to their parent element
+REPORT_METADATA_FIELDS = {'orgname': 'org_name',
+                          'email': 'email',
+                          'reportid': 'report_id',
+                          'date_range_begin': 'date_range/begin',
+                          'date_range_end': 'date_range/end'}
+POLICY_PUBLISHED_FIELDS = {'domain': 'domain',
+                           'adkim': 'adkim',
+                           'aspf': 'aspf',
+                           'p': 'p',
+                           'sp': 'sp',
+                           'pct': 'pct'}
+# Paths of the per-record values, relative to <record>
+RECORD_FIELDS = {'source_ip': 'row/source_ip',
+                 'count': 'row/count',
+                 'disposition': 'row/policy_evaluated/disposition',
+                 'dkim_pass': 'row/policy_evaluated/dkim',
+                 'spf_pass': 'row/policy_evaluated/spf',
+                 'header_from': 'identifiers/header_from',
+                 'dkim_domain': 'auth_results/dkim/domain',
+                 'dkim_result': 'auth_results/dkim/result',
+                 'spf_domain': 'auth_results/spf/domain',
+                 'spf_result': 'auth_results/spf/result'}
 
 
 def set_env_var(name, value, overwrite=False):
@@ -69,6 +149,602 @@ def setup_environment(redshift_parameter="REDSHIFT", aws_parameter="AWS"):
     #set_env_var('AWS_REGION', 'US West (Oregon) us-west-2')
 
 
+def _local_name(tag):
+    # Drop the namespace that DMARC 2.0 reports put on every tag
+    return tag.rsplit('}', 1)[-1]
+
+def _find_text(element, path):
+    # Follow a namespace-free path of tag names and return the stripped text
+    for name in path.split('/'):
+        element = next((child for child in element if _local_name(child.tag) == name), None)
+        if element is None:
+            return None
+    return element.text.strip() if element.text and element.text.strip() else None
+
+def parse_dmarc_report(file):
+    """
+    Stream the rows of a DMARC aggregate report, one per ``<record>``, each joined to
+    the report metadata and published policy. The XML is parsed incrementally and
+    every element is discarded once read, so memory stays constant however many
+    records the report holds.
+    `Args:`
+        file: str or file
+            Path or binary file object of the XML report
+    `Returns:`
+        Generator of dicts with the ``DMARC_COLUMN_TYPES`` columns, as text
+    """
+
+    report = dict.fromkeys(list(REPORT_METADATA_FIELDS) + list(POLICY_PUBLISHED_FIELDS))
+    root = None
+
+    for event, element in ET.iterparse(file, events=('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end':
+            continue
+
+        tag = _local_name(element.tag)
+
+        if tag == 'report_metadata':
+            report.update({k: _find_text(element, path)
+                           for k, path in REPORT_METADATA_FIELDS.items()})
+        elif tag == 'policy_published':
+            report.update({k: _find_text(element, path)
+                           for k, path in POLICY_PUBLISHED_FIELDS.items()})
+        elif tag == 'record':
+            row = dict(report)
+            row.update({k: _find_text(element, path) for k, path in RECORD_FIELDS.items()})
+            yield row
+        else:
+            continue
+
+        # Free the finished element and anything parsed before it
+        root.clear()
+
+def _epoch_to_timestamp(value):
+    return datetime.datetime.utcfromtimestamp(int(value)).strftime('%Y-%m-%d %H:%M:%S')
+
+def _compact_ip(value):
+    return ipaddress.ip_address(value).compressed
+
+def _pass_fail(value):
+    return {'pass': True, 'fail': False}.get(value.lower())
+
+def type_dmarc_row(row):
+    """
+    Convert the text values of a parsed row to their ``DMARC_COLUMN_TYPES`` types.
+    A value that does not convert is loaded as null rather than failing the report.
+    `Args:`
+        row: dict
+            A row from ``parse_dmarc_report``
+    `Returns:`
+        dict
+    """
+
+    typed = dict(row)
+    converters = [(EPOCH_FIELDS, _epoch_to_timestamp),
+                  (INTEGER_FIELDS, int),
+                  (PASS_FAIL_FIELDS, _pass_fail),
+                  (CODE_FIELDS, str.lower),
+                  (DOMAIN_FIELDS, str.lower),
+                  (['source_ip'], _compact_ip)]
+
+    for fields, convert in converters:
+        for f in fields:
+            if typed.get(f) is None:
+                continue
+            try:
+                typed[f] = convert(typed[f])
+            except (ValueError, OverflowError, OSError):
+                typed[f] = None
+
+    # Percentages outside 0-100 and codes longer than their column are not valid values
+    if typed.get('pct') is not None and not 0 <= typed['pct'] <= 100:
+        typed['pct'] = None
+    for f in CODE_FIELDS:
+        width = int(DMARC_COLUMN_TYPES[f].split('(')[1].rstrip(')'))
+        if typed.get(f) and len(typed[f]) > width:
+            typed[f] = None
+
+    return typed
+
+def ensure_dmarc_table(rs, table_name):
+    """
+    Create the DMARC table, or add any columns it is missing.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        table_name: str
+            Full table path of the DMARC table
+    """
+
+    columns_sql = ', '.join(f"{c} {t}" for c, t in DMARC_COLUMN_TYPES.items())
+
+    if not rs.table_exists(table_name): #if the table doesn't exist create it
+        rs.query(f"""create table {table_name} ({columns_sql})
+                     diststyle key distkey({DMARC_DISTKEY}) sortkey({DMARC_SORTKEY});""")
+        return
+
+    schema, table = table_name.split('.', 1)
+    existing = rs.query("""select column_name from information_schema.columns
+                           where table_schema = %s and table_name = %s""",
+                        parameters=[schema, table])
+    existing_columns = {r['column_name'] for r in existing} if existing else set()
+
+    for c, t in DMARC_COLUMN_TYPES.items():
+        if c not in existing_columns:
+            logger.info(f"Adding column {c} to {table_name}")
+            rs.query(f"alter table {table_name} add column {c} {t};")
+
+def ensure_rollup_table(rs, rollup_table):
+    """
+    Create the daily rollup table.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        rollup_table: str
+            Full table path of the rollup table
+    """
+
+    columns_sql = ', '.join(f"{c} {t}" for c, t in DMARC_ROLLUP_COLUMN_TYPES.items())
+    rs.query(f"""create table if not exists {rollup_table} ({columns_sql})
+                 diststyle key distkey(domain) sortkey(report_date);""")
+
+def rollup_sql(table_name, staging_table, rollup_table):
+    """
+    Build the statements that recompute the rollup rows touched by a staged batch:
+    every (day, domain, source IP) in the batch is deleted from the rollup and summed
+    again from the DMARC table.
+    `Returns:`
+        ``(delete_sql, insert_sql)`` tuple
+    """
+
+    touched = f"""(select distinct trunc(date_range_begin) as report_date, domain, source_ip
+                   from {staging_table}
+                   where date_range_begin is not null and domain is not null
+                   and source_ip is not null) touched"""
+
+    delete_sql = f"""
+        delete from {rollup_table} using {touched}
+        where {rollup_table}.report_date = touched.report_date
+        and {rollup_table}.domain = touched.domain
+        and {rollup_table}.source_ip = touched.source_ip;"""
+
+    insert_sql = f"""
+        insert into {rollup_table} ({', '.join(DMARC_ROLLUP_COLUMN_TYPES)})
+        select touched.report_date, touched.domain, touched.source_ip,
+               count(distinct r.reportid),
+               sum(r.count),
+               sum(case when r.dkim_pass then r.count else 0 end),
+               sum(case when r.spf_pass then r.count else 0 end),
+               sum(case when r.dkim_pass or r.spf_pass then r.count else 0 end),
+               sum(case when r.disposition = 'quarantine' then r.count else 0 end),
+               sum(case when r.disposition = 'reject' then r.count else 0 end)
+        from {table_name} r
+        join {touched}
+          on trunc(r.date_range_begin) = touched.report_date
+         and r.domain = touched.domain
+         and r.source_ip = touched.source_ip
+        group by 1, 2, 3;"""
+
+    return delete_sql, insert_sql
+
+def ensure_manifest_table(rs, manifest_table):
+    """
+    Create the manifest table that records which S3 objects have been loaded.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        manifest_table: str
+            Full table path of the manifest table
+    """
+
+    rs.query(f"""create table if not exists {manifest_table} (
+                     s3_key varchar(1024),
+                     etag varchar(256),
+                     size_bytes bigint,
+                     loaded_at timestamp);""")
+
+def _manifest_entry(key, meta):
+    # S3 returns the ETag wrapped in double quotes
+    return key, (meta.get('ETag') or '').strip('"'), int(meta.get('Size') or 0)
+
+def get_manifest(rs, manifest_table, prefixes=None):
+    """
+    Get the objects that have already been loaded.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        manifest_table: str
+            Full table path of the manifest table
+        prefixes: list
+            Only read entries under these key prefixes. Defaults to every entry.
+    `Returns:`
+        set of ``(key, etag, size)`` tuples
+    """
+
+    sql = f"select s3_key, etag, size_bytes from {manifest_table}"
+    parameters = None
+    if prefixes:
+        sql += " where " + " or ".join("s3_key like %s" for _ in prefixes)
+        parameters = [p.replace('%', '\\%').replace('_', '\\_') + '%' for p in prefixes]
+
+    entries = rs.query(sql, parameters=parameters)
+    if not entries:
+        return set()
+    return {(r['s3_key'], r['etag'], int(r['size_bytes'] or 0)) for r in entries}
+
+def list_report_keys(s3, bucket, prefix=None, days_back=None):
+    """
+    List the report keys to consider for loading. With ``days_back`` the prefix is a
+    ``strftime`` pattern, e.g. ``reports/%Y/%m/%d/``, expanded for each of the last
+    ``days_back`` days (and today), so only those date partitions are listed instead
+    of the whole bucket.
+    `Args:`
+        s3: S3 or LocalBucket
+            The connector to list with
+        bucket: str
+            The bucket name
+        prefix: str
+            Only list keys under this prefix
+        days_back: int
+            The number of days of date partitions to list
+    `Returns:`
+        ``(keys, prefixes)`` tuple of the keys mapped to their ``list_keys`` metadata
+        and the prefixes that were listed
+    """
+
+    if days_back is None:
+        prefixes = [prefix] if prefix else []
+    else:
+        today = datetime.date.today()
+        prefixes = []
+        for days in range(days_back, -1, -1):
+            day_prefix = (today - datetime.timedelta(days=days)).strftime(prefix or '')
+            if day_prefix not in prefixes:
+                prefixes.append(day_prefix)
+
+    if not prefixes:
+        return s3.list_keys(bucket), []
+
+    keys = {}
+    for p in prefixes:
+        keys.update(s3.list_keys(bucket, prefix=p))
+    return keys, prefixes
+
+def filter_new_keys(keys, manifest):
+    """
+    Drop the keys that are in the manifest with the same ETag and size. A key that was
+    overwritten since it was loaded is kept.
+    `Args:`
+        keys: dict
+            Keys mapped to their ``list_keys`` metadata
+        manifest: set
+            ``(key, etag, size)`` tuples from ``get_manifest``
+    `Returns:`
+        dict
+    """
+
+    return {k: meta for k, meta in keys.items() if _manifest_entry(k, meta) not in manifest}
+
+class LocalBucket:
+    """
+    A filesystem-backed stand-in for the parsons S3 connector, for running the loader
+    against local files. Each bucket is a directory under ``root`` and each key a file
+    path relative to it.
+    `Args:`
+        root: str
+            The directory holding the bucket directories
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_keys(self, bucket, prefix=None):
+        bucket_dir = os.path.join(self.root, bucket)
+        keys = {}
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, bucket_dir).replace(os.sep, '/')
+                if prefix and not key.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                keys[key] = {'Size': stat.st_size,
+                             'LastModified': datetime.datetime.fromtimestamp(stat.st_mtime),
+                             'ETag': hashlib.md5(f"{stat.st_size}-{stat.st_mtime}".encode()).hexdigest()}
+        return keys
+
+    def get_file(self, bucket, key, local_path=None):
+        # Copy to a temp file like S3.get_file, so callers can delete what they get back
+        if local_path is None:
+            local_path = tempfile.mkstemp()[1]
+        shutil.copyfile(os.path.join(self.root, bucket, key), local_path)
+        return local_path
+
+def iter_report_streams(path):
+    """
+    Open a downloaded report for streaming, whether it is plain XML, gzipped
+    (``.xml.gz``) or zipped (``.zip``). The format is detected from the leading bytes
+    rather than the key name, and compressed reports are decompressed as they are
+    read, so no uncompressed copy is written or held in memory.
+    `Args:`
+        path: str
+            Local path of the report
+    `Returns:`
+        Generator of binary file objects, one per XML document. Each is closed once
+        the next one is requested.
+    """
+
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        with gzip.open(path, 'rb') as stream:
+            yield stream
+    elif magic.startswith(ZIP_MAGIC):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                with archive.open(member) as stream:
+                    yield stream
+    else:
+        with open(path, 'rb') as stream:
+            yield stream
+
+def parse_report_file(path):
+    """
+    Parse a downloaded report, compressed or not, into a list of typed rows. Top level
+    so it can run in a process pool.
+    `Args:`
+        path: str
+            Local path of the report
+    `Returns:`
+        list of dicts, or ``None`` if the file is not a valid DMARC report, e.g. it is
+        truncated, so it is not recorded as loaded
+    """
+
+    rows = []
+    try:
+        for stream in iter_report_streams(path):
+            rows.extend(type_dmarc_row(r) for r in parse_dmarc_report(stream))
+    except (ET.ParseError, zipfile.BadZipFile, OSError, EOFError) as error:
+        logger.info(f"Failed to parse {path}, it is not a valid DMARC report: {error}")
+        return None
+    return rows
+
+def fetch_reports(s3, bucket, keys, max_workers=8, max_in_flight_bytes=256 * 1024 * 1024,
+                  parse_processes=0):
+    """
+    Download and parse reports concurrently. Downloads run on a pool of threads and,
+    when ``parse_processes`` is set, parsing fans out to a pool of processes. New
+    downloads are only started while the reports being fetched or parsed add up to
+    less than ``max_in_flight_bytes``.
+    `Args:`
+        s3: S3 or LocalBucket
+            The connector to download with
+        bucket: str
+            The bucket name
+        keys: dict
+            The keys to fetch, mapped to their ``list_keys`` metadata
+        max_workers: int
+            The number of concurrent downloads
+        max_in_flight_bytes: int
+            The maximum total size of reports being fetched or parsed at once
+        parse_processes: int
+            The number of processes to parse with. ``0`` parses on the download threads.
+    `Returns:`
+        Generator of ``(key, rows)`` tuples in completion order. ``rows`` is ``None``
+        when the report could not be fetched or parsed.
+    """
+
+    parse_pool = ProcessPoolExecutor(parse_processes) if parse_processes else None
+
+    def fetch(key):
+        file = s3.get_file(bucket, key)
+        try:
+            if parse_pool:
+                return parse_pool.submit(parse_report_file, file).result()
+            return parse_report_file(file)
+        finally:
+            utilities.files.close_temp_file(file)
+
+    pending = {}
+    in_flight_bytes = 0
+    remaining = iter(keys.items())
+    next_key = next(remaining, None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or next_key:
+                # Start downloads while there is room. One report is always allowed, so
+                # a report bigger than the cap still gets fetched on its own.
+                while next_key and len(pending) < max_workers:
+                    key, meta = next_key
+                    size = int(meta.get('Size') or 0)
+                    if pending and in_flight_bytes + size > max_in_flight_bytes:
+                        break
+                    pending[pool.submit(fetch, key)] = (key, size)
+                    in_flight_bytes += size
+                    next_key = next(remaining, None)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, size = pending.pop(future)
+                    in_flight_bytes -= size
+                    try:
+                        rows = future.result()
+                    except Exception as error:
+                        logger.info(f"Failed to fetch {key}: {error}")
+                        rows = None
+                    yield key, rows
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+
+def _row_bytes(row):
+    # Approximate size of a row once written to the staging CSV
+    return sum(len(str(v)) + 1 for v in row.values() if v is not None)
+
+def batch_report_rows(reports, max_rows=100000, max_bytes=64 * 1024 * 1024):
+    """
+    Gather the parsed rows of many reports into size-bounded batches. The rows of a
+    report are never split across batches, so a batch that fails to load maps to a
+    whole set of S3 keys that can be retried.
+    `Args:`
+        reports: iterable
+            ``(key, rows)`` tuples of S3 keys and their parsed rows
+        max_rows: int
+            Close a batch once it holds at least this many rows
+        max_bytes: int
+            Close a batch once its rows take up at least this many bytes
+    `Returns:`
+        Generator of ``(keys, rows)`` tuples
+    """
+
+    batch_keys = []
+    batch_rows = []
+    batch_bytes = 0
+
+    for key, rows in reports:
+        batch_keys.append(key)
+        for row in rows:
+            batch_rows.append(row)
+            batch_bytes += _row_bytes(row)
+
+        if len(batch_rows) >= max_rows or batch_bytes >= max_bytes:
+            yield batch_keys, batch_rows
+            batch_keys, batch_rows, batch_bytes = [], [], 0
+
+    if batch_keys:
+        yield batch_keys, batch_rows
+
+def load_batch(rs, rows, table_name, manifest_table=None, manifest_entries=None,
+               rollup_table=None):
+    """
+    Load a batch of DMARC rows and record its S3 objects in the manifest. The rows are
+    COPYed into a staging table, then one transaction inserts the rows of reports
+    whose ``reportid`` is not already in the DMARC table, refreshes the rollup rows
+    the batch touches and adds the manifest entries, so a batch is either fully
+    loaded and recorded or not at all.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        rows: list
+            The rows to load
+        table_name: str
+            Full table path of the DMARC table
+        manifest_table: str
+            Full table path of the manifest table
+        manifest_entries: list
+            ``(key, etag, size)`` tuples of the objects the rows came from
+        rollup_table: str
+            Full table path of the daily rollup table
+    """
+
+    staging_table = f"{table_name}_stage"
+    columns = ', '.join(DMARC_COLUMN_TYPES)
+
+    if rows:
+        rs.copy(Table(rows), staging_table, truncatecolumns=True,
+                columntypes=DMARC_COLUMN_TYPES, specifycols=True,
+                temp_bucket_region='us-west-2', if_exists='drop')
+
+    with rs.connection() as connection:
+        if rows:
+            rs.query_with_connection(f"""
+                insert into {table_name} ({columns})
+                select {columns} from {staging_table} stage
+                where not exists (select 1 from {table_name} loaded
+                                  where loaded.reportid = stage.reportid);""",
+                connection, commit=False)
+
+        if rows and rollup_table:
+            for sql in rollup_sql(table_name, staging_table, rollup_table):
+                rs.query_with_connection(sql, connection, commit=False)
+
+        if manifest_table and manifest_entries:
+            values = ', '.join('(%s, %s, %s, getdate())' for _ in manifest_entries)
+            rs.query_with_connection(
+                f"insert into {manifest_table} (s3_key, etag, size_bytes, loaded_at) values {values};",
+                connection, parameters=[v for entry in manifest_entries for v in entry],
+                commit=False)
+
+        connection.commit()
+
+    if rows:
+        rs.query(f"drop table if exists {staging_table};")
+
+def load_reports(rs, s3, bucket, keys, table_name, manifest_table=None, rollup_table=None,
+                 batch_rows=100000, batch_bytes=64 * 1024 * 1024, fetch_workers=8,
+                 max_in_flight_bytes=256 * 1024 * 1024, parse_processes=0):
+    """
+    Fetch, parse and load reports in batches, recording each loaded batch's objects in
+    the manifest. A file that cannot be fetched or parsed, or whose batch fails to
+    load, is logged and left out of the manifest so the next run picks it up again;
+    the rest of the load carries on.
+    `Args:`
+        rs: Redshift
+            The parsons Redshift connector
+        s3: S3 or LocalBucket
+            The connector to download with
+        bucket: str
+            The bucket name
+        keys: dict
+            The keys to load, mapped to their ``list_keys`` metadata
+        table_name: str
+            Full table path of the DMARC table
+        manifest_table: str
+            Full table path of the manifest table
+        rollup_table: str
+            Full table path of the daily rollup table
+        batch_rows: int
+            See ``batch_report_rows``
+        batch_bytes: int
+            See ``batch_report_rows``
+        fetch_workers: int
+            See ``fetch_reports``
+        max_in_flight_bytes: int
+            See ``fetch_reports``
+        parse_processes: int
+            See ``fetch_reports``
+    `Returns:`
+        list of the keys that failed to load
+    """
+
+    failed_keys = []
+    seen_reports = set()
+
+    def reports():
+        for x, rows in fetch_reports(s3, bucket, keys, max_workers=fetch_workers,
+                                     max_in_flight_bytes=max_in_flight_bytes,
+                                     parse_processes=parse_processes):
+            if rows is None:
+                failed_keys.append(x)
+                continue
+            # The same report sent twice in one run is only loaded once
+            report_ids = {r['reportid'] for r in rows}
+            if report_ids and report_ids <= seen_reports:
+                rows = []
+            seen_reports.update(report_ids)
+            yield x, rows
+
+    for batch_number, (batch_keys, rows) in enumerate(
+            batch_report_rows(reports(), max_rows=batch_rows, max_bytes=batch_bytes), start=1):
+        manifest_entries = [_manifest_entry(k, keys[k]) for k in batch_keys]
+
+        try:
+            load_batch(rs, rows, table_name, manifest_table, manifest_entries, rollup_table)
+        except Exception as error:
+            logger.info(f"Batch {batch_number} of {len(batch_keys)} files failed to load: {error}")
+            failed_keys.extend(batch_keys)
+            continue
+
+        logger.info(f"Batch {batch_number} loaded {len(rows)} records from {len(batch_keys)} files!")
+
+    return failed_keys
+
 def main():
     #setup_environment()
     setup_environment()
@@ -79,196 +755,58 @@ def main():
 
     #create an instance of S3 and Redshift
     rs = Redshift()
-    s3 = S3()
+
+    # Read reports from a local directory instead of S3 when one is given
+    if os.environ.get('DMARC_LOCAL_BUCKET_DIR'):
+        s3 = LocalBucket(os.environ['DMARC_LOCAL_BUCKET_DIR'])
+    else:
+        s3 = S3()
 
     coc_bucket = 'dmarc-files'
-    keys = s3.list_keys(coc_bucket)
-    files = keys.keys()
 
     timestamp = datetime.datetime.now().strftime("%Y%m%d") #timestamp used in log table 
 
-    user_table = 'coc_dmarc.dmarc_table'
-
-    if not rs.table_exists(user_table): #if the table doesn't exist create it
-       rs.query(f"create table {user_table} (orgname varchar(2048), email varchar(2048), reportid varchar(2048), date_range_begin varchar(2048),date_range_end varchar(2048), domain varchar(1024), adkim varchar(1024), aspf varchar(1024), p varchar(1024), sp varchar(2048), pct varchar(1024), source_ip varchar(1024), disposition varchar(1024), dkim varchar(1024), spf varchar(1024));")
-
-            
-    def file_To_Table(file):
-        
-        org_substring = 'NA'
-        email_substring = 'NA'
-        id_substring = 'NA'
-        begin_substring = 'NA'
-        adkim_substring = 'NA'
-        end_substring = 'NA'
-        domain_substring = 'NA'
-        p_substring = 'NA'
-        aspf_substring = 'NA'
-        sp_substring = 'NA'
-        pct_substring = 'NA'
-        ip_substring = 'NA'
-        dkim_substring = 'NA'
-        disposition_substring = 'NA'
-        result_substring = 'NA'
-        spf_substring = 'NA'
-
-        
-      
-        for column in file.data:
-            column_data = str(column)
-            
-            if '<org_name>' in column_data:
-                start = column_data.find('<org_name>') + len('<org_name>')
-                end = column_data.find('</org_name>')
-                org_substring = column_data[start:end]
-                
-                    
-
-            if '<email>' in column_data:
-                start = column_data.find('<email>') + len('<email>')
-                end = column_data.find('</email>')
-                email_substring = column_data[start:end]
-                
-
-            if '<report_id>' in column_data:
-                start = column_data.find('<report_id>') + len('<report_id>')
-                end = column_data.find('</report_id>')
-                id_substring = column_data[start:end]
-                
-      
-            if '<begin>' in column_data:
-                start = column_data.find('<begin>') + len('<begin>')
-                end = column_data.find('</begin>')
-                begin_substring = column_data[start:end]
-                
-                
-            if '<end>' in column_data:
-                start = column_data.find('<end>') + len('<end>')
-                end = column_data.find('</end>')
-                end_substring = column_data[start:end]
-            
-                
-                
-            if '<domain>' in column_data:
-                start = column_data.find('<domain>') + len('<domain>')
-                end = column_data.find('</domain>')
-                domain_substring = column_data[start:end] 
-                
-    
-    
-            if '<adkim>' in column_data:
-                start = column_data.find('<adkim>') + len('<adkim>')
-                end = column_data.find('</adkim>')
-                adkim_substring = column_data[start:end] 
-                
-    
-    
-            if '<aspf>' in column_data:
-                start = column_data.find('<aspf>') + len('<aspf>')
-                end = column_data.find('</aspf>')
-                aspf_substring = column_data[start:end]  
-                
-    
-            if '<p>' in column_data:
-                start = column_data.find('<p>') + len('<p>')
-                end = column_data.find('</p>')
-                p_substring = column_data[start:end]  
-                
-    
-    
-            if '<sp>' in column_data:
-                start = column_data.find('<sp>') + len('<sp>')
-                end = column_data.find('</sp>')
-                sp_substring = column_data[start:end]   
-                
-    
-    
-            if '<pct>' in column_data:
-                start = column_data.find('<pct>') + len('<pct>')
-                end = column_data.find('</pct>')
-                pct_substring = column_data[start:end] 
-                
-
-                
-            if '<source_ip>' in column_data:
-                start = column_data.find('<source_ip>') + len('<source_ip>')
-                end = column_data.find('</source_ip>')
-                ip_substring = column_data[start:end]    
-                
-                
-    
-            if '<dkim>' in column_data:
-                start = column_data.find('<dkim>') + len('<dkim>')
-                end = column_data.find('</dkim>')
-                dkim_substring = column_data[start:end]   
-           
-                
-  
-            if '<disposition>' in column_data:
-                start = column_data.find('<disposition>') + len('<disposition>')
-                end = column_data.find('</disposition>')
-                disposition_substring = column_data[start:end] 
-                
-
-            if '<spf>' in column_data:
-                start = column_data.find('<spf>') + len('<spf>')
-                end = column_data.find('</spf>')
-                spf_substring = column_data[start:end]    
-                
-        
-            if '<result>' in column_data:
-                start = column_data.find('<result>') + len('<result>')
-                end = column_data.find('</result>')
-                result_substring = column_data[start:end]    
-                
-
-        df = pd.DataFrame({'orgname':[org_substring],
-                        'email': [email_substring],
-                        'reportid': [id_substring],
-                        'Date Range Begin': [begin_substring],
-                        'Date Range End': [end_substring],
-                        'Domain': [domain_substring],
-                        'ADKIM': [adkim_substring],
-                        'ASPF': [aspf_substring],
-                        'P': [p_substring],
-                        'SP': [sp_substring],
-                        'PCT': [pct_substring],
-                        'Source IP': [ip_substring],
-                        'Disposition': [disposition_substring],
-                        'DKIM': [dkim_substring],
-                        'SPF': [spf_substring]})
-    
-        parsons_table = Table.from_dataframe(df)
-        return parsons_table
-    
-    
+    user_table = os.environ.get('DMARC_TABLE') or 'coc_dmarc.dmarc_records'
+    rollup_table = os.environ.get('DMARC_ROLLUP_TABLE') or 'coc_dmarc.dmarc_daily_rollup'
+    manifest_table = os.environ.get('DMARC_MANIFEST_TABLE') or f'{user_table}_manifest'
+
+    # Only list one prefix, or its date partitions over the last DMARC_DAYS_BACK days
+    prefix = os.environ.get('DMARC_PREFIX') or None
+    days_back = os.environ.get('DMARC_DAYS_BACK')
+    days_back = int(days_back) if days_back else None
+
+    # Size of each COPY into Redshift
+    batch_rows = int(os.environ.get('DMARC_BATCH_ROWS') or 100000)
+    batch_bytes = int(float(os.environ.get('DMARC_BATCH_MB') or 64) * 1024 * 1024)
+
+    # Concurrency of the download and parse stages
+    fetch_workers = int(os.environ.get('DMARC_FETCH_WORKERS') or 8)
+    max_in_flight_bytes = int(float(os.environ.get('DMARC_MAX_INFLIGHT_MB') or 256) * 1024 * 1024)
+    parse_processes = int(os.environ.get('DMARC_PARSE_PROCESSES') or 0)
+
+    ensure_dmarc_table(rs, user_table)
+    ensure_rollup_table(rs, rollup_table)
+    ensure_manifest_table(rs, manifest_table)
+
+    # Skip the objects that were already loaded and have not changed since
+    listed_keys, prefixes = list_report_keys(s3, coc_bucket, prefix=prefix, days_back=days_back)
+    keys = filter_new_keys(listed_keys, get_manifest(rs, manifest_table, prefixes))
+    logger.info(f"{len(keys)} of {len(listed_keys)} files are new or changed")
+
     if len(keys) == 0:
         print ("No files to sync today!")
-    else:
-        for x in files:
-            from parsons import Table
-            file = s3.get_file(coc_bucket, x)
-            file = Table.from_csv(file)
-                
-             #TODO: Table undeifned, may need to import from parsons?
-            final_table = file_To_Table(file)
-            
-            
-            if final_table.first != 'NA':
-                try:
-                    #final_table.to_redshift(user_table, if_exists='truncate')
-                    rs.copy(final_table,user_table,truncatecolumns=True,columntypes={'orgname': 'varchar(2048)', 'email': 'varchar(2048)', 'reportid': 'varchar(2048)', 'date_range_begin': 'varchar(2048)','date_range_end': 'varchar(2048)', 'domain': 'varchar(1024)', 'adkim': 'varchar(1024)', 'aspf': 'varchar(1024)', 'p': 'varchar(1024)', 'sp': 'varchar(2048)', 'pct': 'varchar(1024)', 'source_ip': 'varchar(1024)', 'disposition': 'varchar(1024)', 'dkim': 'varchar(1024)', 'spf': 'varchar(1024)'},temp_bucket_region= 'us-west-2',if_exists='append')
-                except Exception:
-                    rs.copy(final_table,user_table,truncatecolumns=True,columntypes={'orgname': 'varchar(2048)', 'email': 'varchar(2048)', 'reportid': 'varchar(2048)', 'date_range_begin': 'varchar(2048)','date_range_end': 'varchar(2048)', 'domain': 'varchar(1024)', 'adkim': 'varchar(1024)', 'aspf': 'varchar(1024)', 'p': 'varchar(1024)', 'sp': 'varchar(2048)', 'pct': 'varchar(1024)', 'source_ip': 'varchar(1024)', 'disposition': 'varchar(1024)', 'dkim': 'varchar(1024)', 'spf': 'varchar(1024)'},temp_bucket_region= 'us-west-2',if_exists='drop')
-
-                    #final_table.to_redshift(user_table, if_exists='drop')
-            
-                logger.info("This {} is completed!".format(x))
-
-                utilities.files.close_temp_file(file)
-
-    
-    #final_table.to_redshift(user_table, specifycols=True, if_exists='truncate')
+        return
+
+    failed_keys = load_reports(rs, s3, coc_bucket, keys, user_table, manifest_table=manifest_table,
+                               rollup_table=rollup_table, batch_rows=batch_rows,
+                               batch_bytes=batch_bytes, fetch_workers=fetch_workers,
+                               max_in_flight_bytes=max_in_flight_bytes,
+                               parse_processes=parse_processes)
+
+    logger.info(f"DMARC load took {time.time() - start:.1f} seconds")
+
+    if failed_keys:
+        raise RuntimeError(f"{len(failed_keys)} DMARC files failed to load: {', '.join(failed_keys)}")
 
 if __name__ == '__main__':
     main()
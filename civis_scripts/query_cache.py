@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+from parsons import Table
+
+# pyarrow is optional; without it results are cached as pickles instead of Parquet
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+DEFAULT_CACHE_DIR = 'query_cache'
+
+SQL_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+# Tables a query reads, e.g. "from coc_ak.core_user" or "join core_action"
+REFERENCED_TABLE = re.compile(r'\b(?:from|join)\s+([A-Za-z_][\w.]*)', re.IGNORECASE)
+# Names a query defines itself, e.g. "with recent as (" or ", totals as ("
+COMMON_TABLE = re.compile(r'(?:\bwith|,)\s+([A-Za-z_]\w*)\s+as\s*\(', re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """
+    Strip comments and collapse whitespace, so formatting changes to a query do not
+    change its cache key.
+    """
+
+    return ' '.join(SQL_COMMENT.sub(' ', sql).split())
+
+
+def referenced_tables(sql):
+    """
+    Get the tables a query reads from.
+    `Returns:`
+        sorted list of table names
+    """
+
+    sql = normalize_sql(sql)
+    defined = set(t.lower() for t in COMMON_TABLE.findall(sql))
+    return sorted(set(t.lower() for t in REFERENCED_TABLE.findall(sql)) - defined)
+
+
+class QueryCache:
+    """
+    On-disk cache of query results, keyed by the database, the normalized SQL and its
+    parameters.
+
+    Results are stored as Parquet files when pyarrow is installed and as pickles
+    otherwise, with a SQLite index of their size, last use and the sync versions of
+    the tables they read. Only queries whose tables all have a version in the sync
+    state store for the database they run on are cached, since nothing would tell when
+    any other table changes. An entry is stale once the store shows any of its tables
+    has been synced since, or once it is older than ``max_age_seconds``. The least
+    recently used entries are evicted to keep the cache under ``max_bytes``. The cache
+    is safe to share between threads.
+
+    `Args:`
+        directory: str
+            The directory to keep results and the index in
+        max_bytes: int
+            The maximum total size of cached results
+        max_age_seconds: int
+            The maximum age of an entry
+        state_store: SyncStateStore
+            Optional sync state store, used to tell when the tables a result read
+            have been synced
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=1024 * 1024 * 1024,
+                 max_age_seconds=24 * 60 * 60, state_store=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.state_store = state_store
+        self.format = 'parquet' if pyarrow else 'pickle'
+        self._lock = threading.RLock()
+        self._conn = None
+
+    @classmethod
+    def from_env(cls, prefix='QUERY_CACHE', state_store=None):
+        """
+        Create a cache from the ``{prefix}_DIR``, ``{prefix}_MB`` and
+        ``{prefix}_MAX_AGE`` (seconds) environment variables.
+        `Returns:`
+            ``QueryCache`` or ``None`` if no directory is set
+        """
+
+        directory = os.environ.get(f'{prefix}_DIR')
+        if not directory:
+            return None
+
+        return cls(directory,
+                   max_bytes=int(float(os.environ.get(f'{prefix}_MB') or 1024) * 1024 * 1024),
+                   max_age_seconds=int(os.environ.get(f'{prefix}_MAX_AGE') or 24 * 60 * 60),
+                   state_store=state_store)
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                         check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS query_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    table_versions TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )""")
+            self._conn.commit()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def cache_key(self, db_identity, sql, parameters=None):
+        """
+        Build the cache key of a query.
+        `Args:`
+            db_identity: str
+                The database the query runs on (see ``sync_state.db_identity``)
+            sql: str
+                The rendered SQL
+            parameters: list
+                The bound parameters
+        `Returns:`
+            str
+        """
+
+        payload = json.dumps([db_identity, normalize_sql(sql), parameters], default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _table_versions(self, db_identity, sql):
+        tables = referenced_tables(sql)
+        if not self.state_store:
+            return dict.fromkeys(tables)
+        return self.state_store.get_table_versions(tables, destination=db_identity)
+
+    def cacheable(self, db_identity, sql):
+        """
+        Check whether every table a query reads has a tracked sync version on the
+        database it runs on, so its cached results can be told apart from fresh ones.
+        `Returns:`
+            bool
+        """
+
+        return all(v is not None for v in self._table_versions(db_identity, sql).values())
+
+    def get(self, db_identity, sql, parameters=None):
+        """
+        Get the cached results of a query.
+        `Returns:`
+            parsons Table or ``None`` if there is no fresh entry
+        """
+
+        if not self.cacheable(db_identity, sql):
+            return None
+
+        key = self.cache_key(db_identity, sql, parameters)
+        with self._lock:
+            entry = self.conn.execute("SELECT * FROM query_cache WHERE cache_key = ?",
+                                      (key,)).fetchone()
+            if entry is None:
+                return None
+
+            if (time.time() - entry['created_at'] > self.max_age_seconds
+                    or json.loads(entry['table_versions']) != self._table_versions(db_identity, sql)):
+                self._delete(entry)
+                return None
+
+            try:
+                tbl = self._read(entry['path'])
+            except (OSError, EOFError, pickle.UnpicklingError) as error:
+                logger.info(f"Dropping unreadable cache entry {entry['path']}: {error}")
+                self._delete(entry)
+                return None
+
+            self.conn.execute("UPDATE query_cache SET last_used_at = ? WHERE cache_key = ?",
+                              (time.time(), key))
+            self.conn.commit()
+        return tbl
+
+    def put(self, db_identity, sql, parameters, tbl):
+        """
+        Cache the results of a query, evicting the least recently used entries if the
+        cache grows past ``max_bytes``. Queries that read a table without a tracked
+        sync version are not cached.
+        """
+
+        key = self.cache_key(db_identity, sql, parameters)
+        path = os.path.join(self.directory, f"{key}.{self.format}")
+
+        with self._lock:
+            # Read the versions before writing, so a sync that lands meanwhile makes it stale
+            versions = self._table_versions(db_identity, sql)
+            if any(v is None for v in versions.values()):
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(path, tbl)
+            now = time.time()
+            self.conn.execute(
+                """INSERT OR REPLACE INTO query_cache
+                   (cache_key, path, bytes, table_versions, created_at, last_used_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (key, path, os.path.getsize(path), json.dumps(versions), now, now))
+            self.conn.commit()
+            self._evict()
+
+    def _write(self, path, tbl):
+        rows = list(tbl)
+        if self.format == 'parquet':
+            if rows:
+                arrow_table = pyarrow.Table.from_pylist(rows)
+            else:
+                arrow_table = pyarrow.table({c: [] for c in tbl.columns})
+            pq.write_table(arrow_table, path)
+        else:
+            with open(path, 'wb') as f:
+                pickle.dump({'columns': list(tbl.columns), 'rows': rows}, f)
+
+    def _read(self, path):
+        if path.endswith('.parquet'):
+            arrow_table = pq.read_table(path)
+            rows = arrow_table.to_pylist()
+            return Table(rows) if rows else Table([arrow_table.column_names])
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        return Table(data['rows']) if data['rows'] else Table([data['columns']])
+
+    def _delete(self, entry):
+        self.conn.execute("DELETE FROM query_cache WHERE cache_key = ?", (entry['cache_key'],))
+        self.conn.commit()
+        if os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM query_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for entry in self.conn.execute(
+                "SELECT * FROM query_cache ORDER BY last_used_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._delete(entry)
+            total -= entry['bytes']
@@ -0,0 +1,224 @@
+import time
+import logging
+import threading
+from parsons import Redshift
+from sync_state import db_identity
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+# Widest VARCHAR Redshift allows
+REDSHIFT_MAX_VARCHAR = 65535
+# Widest VARCHAR that fits a MySQL row of utf8mb4 text
+MYSQL_MAX_VARCHAR = 16383
+
+
+def column_type_sql(column, dialect):
+    """
+    Translate a column type read from ``information_schema`` into a type for a
+    destination database, for adding the column with ``ALTER TABLE``.
+    `Args:`
+        column: dict
+            The column's ``data_type``, ``character_maximum_length``,
+            ``numeric_precision`` and ``numeric_scale``
+        dialect: str
+            ``redshift``, ``mysql`` or ``postgres``
+    `Returns:`
+        str
+    """
+
+    data_type = column['data_type'].lower()
+    length = column.get('character_maximum_length')
+    precision = column.get('numeric_precision')
+    scale = column.get('numeric_scale')
+
+    if data_type in ('character varying', 'varchar', 'character', 'char', 'nvarchar', 'bpchar',
+                     'text', 'tinytext', 'mediumtext', 'longtext'):
+        if dialect == 'redshift':
+            return f"VARCHAR({min(length or REDSHIFT_MAX_VARCHAR, REDSHIFT_MAX_VARCHAR)})"
+        if length and (dialect != 'mysql' or length <= MYSQL_MAX_VARCHAR):
+            return f"VARCHAR({length})"
+        return 'TEXT'
+
+    if data_type in ('tinyint', 'smallint'):
+        return 'SMALLINT'
+    if data_type in ('mediumint', 'int', 'integer'):
+        return 'INTEGER'
+    if data_type == 'bigint':
+        return 'BIGINT'
+    if data_type in ('numeric', 'decimal'):
+        return f"DECIMAL({precision}, {scale or 0})" if precision else 'DECIMAL(38, 10)'
+    if data_type in ('real', 'float', 'double', 'double precision'):
+        return 'DOUBLE' if dialect == 'mysql' else 'DOUBLE PRECISION'
+    if data_type in ('boolean', 'bool'):
+        return 'BOOLEAN'
+    if data_type == 'date':
+        return 'DATE'
+    if data_type in ('timestamp', 'timestamp without time zone', 'datetime'):
+        return 'DATETIME' if dialect == 'mysql' else 'TIMESTAMP'
+    if data_type == 'timestamp with time zone':
+        return 'DATETIME' if dialect == 'mysql' else 'TIMESTAMPTZ'
+
+    return f"VARCHAR({REDSHIFT_MAX_VARCHAR})" if dialect == 'redshift' else 'TEXT'
+
+
+class SchemaCache:
+    """
+    Cache of the schema of every table a sync touches: its column names and types,
+    the rename map from source column names to destination names, and on Redshift its
+    distribution and sort keys.
+
+    A schema saved in the state store by an earlier run is used as is, without
+    querying the database, until it is older than ``max_age_seconds`` or it is
+    invalidated because the sync altered the table. Otherwise the columns are read
+    from ``information_schema`` and compared with the saved schema: a table whose
+    columns are unchanged keeps its saved keys, and a changed table is logged as
+    drifted and has its keys read again. The cache is safe to share between sync
+    workers.
+
+    `Args:`
+        state_store: SyncStateStore
+            Optional store to persist schemas between runs
+        rename: function
+            Maps a source column name to its destination name
+        max_age_seconds: int
+            How long a saved schema is used before it is read again, which bounds how
+            long changes made outside the sync go unnoticed
+    """
+
+    def __init__(self, state_store=None, rename=None, max_age_seconds=24 * 60 * 60):
+        self.state_store = state_store
+        self.rename = rename or (lambda column: column)
+        self.max_age_seconds = max_age_seconds
+        self._schemas = {}
+        self._lock = threading.RLock()
+
+    def _read_columns(self, db, table):
+        schema, table_name = table.split('.', 1)
+        columns = db.query(
+            """SELECT column_name AS column_name, data_type AS data_type,
+                      character_maximum_length AS character_maximum_length,
+                      numeric_precision AS numeric_precision, numeric_scale AS numeric_scale
+               FROM information_schema.columns
+               WHERE table_schema = %s AND table_name = %s
+               ORDER BY ordinal_position""",
+            parameters=[schema, table_name])
+        return [dict(c) for c in columns] if columns else []
+
+    def _read_keys(self, db, table):
+        if not isinstance(db, Redshift):
+            return None, None
+
+        schema, table_name = table.split('.', 1)
+        info = db.query('SELECT diststyle, sortkey1 FROM svv_table_info '
+                        'WHERE "schema" = %s AND "table" = %s', parameters=[schema, table_name])
+        if not info:
+            return None, None
+
+        diststyle = info[0]['diststyle'] or ''
+        distkey = diststyle[4:-1] if diststyle.startswith('KEY(') else None
+        return distkey, info[0]['sortkey1']
+
+    def table_schema(self, db, table):
+        """
+        Get the schema of a table.
+        `Args:`
+            db: object
+                The parsons database connector
+            table: str
+                Full table path (e.g. ``my_schema.my_table``)
+        `Returns:`
+            dict with ``columns`` (names in table order), ``types`` (column name to its
+            ``information_schema`` type fields), ``rename_map`` (source name to
+            destination name, for the columns that are renamed), ``distkey``,
+            ``sortkey`` and ``read_at`` (when the columns were read), or ``None`` if
+            the table does not exist
+        """
+
+        key = (db_identity(db), table)
+        with self._lock:
+            if key in self._schemas:
+                return self._schemas[key]
+
+        saved = self.state_store and self.state_store.get_table_schema(*key)
+        if saved and time.time() - saved.get('read_at', 0) <= self.max_age_seconds:
+            with self._lock:
+                self._schemas[key] = saved
+            return saved
+
+        columns = self._read_columns(db, table)
+        if not columns:
+            schema = None
+        else:
+            # Sizes are stored as ints, so they compare equal to the saved JSON
+            types = {c['column_name']: {'data_type': c['data_type'],
+                                        **{k: int(c[k]) if c[k] is not None else None
+                                           for k in ('character_maximum_length',
+                                                     'numeric_precision', 'numeric_scale')}}
+                     for c in columns}
+            names = [c['column_name'] for c in columns]
+
+            if saved and saved['columns'] == names and saved['types'] == types:
+                distkey, sortkey = saved['distkey'], saved['sortkey']
+            else:
+                if saved:
+                    added = [c for c in names if c not in saved['columns']]
+                    removed = [c for c in saved['columns'] if c not in names]
+                    logger.info(f"Schema of {table} changed since the last run. "
+                                f"Added: {added or 'none'}. Removed: {removed or 'none'}.")
+                distkey, sortkey = self._read_keys(db, table)
+
+            schema = {'columns': names,
+                      'types': types,
+                      'rename_map': {c: self.rename(c) for c in names if self.rename(c) != c},
+                      'distkey': distkey,
+                      'sortkey': sortkey,
+                      'read_at': time.time()}
+
+            if self.state_store:
+                self.state_store.save_table_schema(*key, schema)
+
+        with self._lock:
+            self._schemas[key] = schema
+        return schema
+
+    def table_exists(self, db, table):
+        """
+        Check whether a table exists. The database is asked every time, since a
+        saved schema outlives a table dropped outside the sync; the schema of a table
+        that is gone is forgotten.
+        """
+
+        if db.table_exists(table):
+            return True
+        self.invalidate(db, table)
+        return False
+
+    def invalidate(self, db, table):
+        """
+        Forget the cached and saved schema of a table, e.g. after altering it, so it
+        is read again on the next lookup.
+        """
+
+        key = (db_identity(db), table)
+        with self._lock:
+            self._schemas.pop(key, None)
+        if self.state_store:
+            self.state_store.clear_table_schema(*key)
+
+    def destination_columns(self, db, table):
+        """
+        Get the destination names of the columns of a source table, in table order.
+        `Returns:`
+            list
+        """
+
+        schema = self.table_schema(db, table)
+        if schema is None:
+            return []
+        return [schema['rename_map'].get(c, c) for c in schema['columns']]
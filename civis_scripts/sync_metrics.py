@@ -0,0 +1,172 @@
+import json
+import time
+import uuid
+import logging
+import datetime
+import threading
+import collections
+from contextlib import contextmanager
+from parsons import Table
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+# Per-phase totals that are added up across calls
+SUMMED_FIELDS = ['seconds', 'rows', 'bytes', 'retries']
+
+
+class SyncMetrics:
+    """
+    Collects structured timings for every phase of every table sync in a run.
+
+    Each record holds the table, phase, duration, rows, bytes and retry count and is
+    appended to a JSON-lines file as soon as it is recorded, so the file is useful even
+    if the run dies. ``report`` logs where the time went at the end of the run and
+    ``to_redshift`` loads the per-phase totals into a summary table. The collector is
+    safe to share between sync workers.
+
+    `Args:`
+        path: str
+            Optional JSON-lines file to append records to
+        run_id: str
+            Identifier of the run. Defaults to a random id.
+    """
+
+    def __init__(self, path=None, run_id=None):
+        self.path = path
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, table, phase, seconds, rows=None, bytes=None, retries=0, **fields):
+        """
+        Record one timed phase.
+        `Args:`
+            table: str
+                The source table being synced
+            phase: str
+                The phase name, e.g. ``probe``, ``fetch`` or ``upsert``
+            seconds: float
+                The duration of the phase
+            rows: int
+                The number of rows handled
+            bytes: int
+                The estimated number of bytes handled
+            retries: int
+                The number of times the phase was retried
+            **fields: kwargs
+                Any other values to record
+        """
+
+        record = {'run_id': self.run_id,
+                  'recorded_at': datetime.datetime.utcnow().isoformat(),
+                  'table': table,
+                  'phase': phase,
+                  'seconds': round(seconds, 3),
+                  'rows': rows,
+                  'bytes': bytes,
+                  'retries': retries}
+        record.update(fields)
+
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    @contextmanager
+    def phase(self, table, phase, **fields):
+        """
+        Time a block of code as one phase. The yielded dict can be updated with
+        ``rows``, ``bytes``, ``retries`` or any other field before the block exits. A
+        block that raises is recorded with ``status`` ``error``.
+        """
+
+        values = dict(fields)
+        start = time.time()
+        try:
+            yield values
+        except BaseException:
+            values['status'] = 'error'
+            raise
+        finally:
+            values.setdefault('status', 'ok')
+            self.record(table, phase, time.time() - start, **values)
+
+    def summary(self):
+        """
+        Total the records of the run by table and phase.
+        `Returns:`
+            list of dicts with ``run_id``, ``table``, ``phase``, ``calls``, ``seconds``,
+            ``rows``, ``bytes``, ``retries`` and ``errors``
+        """
+
+        totals = collections.OrderedDict()
+        with self._lock:
+            records = list(self.records)
+
+        for r in records:
+            total = totals.setdefault((r['table'], r['phase']), {
+                'run_id': self.run_id, 'table': r['table'], 'phase': r['phase'],
+                'calls': 0, 'seconds': 0, 'rows': 0, 'bytes': 0, 'retries': 0, 'errors': 0})
+            total['calls'] += 1
+            for k in SUMMED_FIELDS:
+                total[k] += r.get(k) or 0
+            if r.get('status') == 'error':
+                total['errors'] += 1
+
+        return list(totals.values())
+
+    def report(self):
+        """
+        Log where the time went, per table and phase, slowest tables first.
+        `Returns:`
+            The ``summary`` of the run
+        """
+
+        summary = self.summary()
+        by_table = collections.defaultdict(list)
+        for s in summary:
+            by_table[s['table']].append(s)
+
+        # Phases can nest (e.g. a sync wraps its chunks), so rank tables by their
+        # slowest phase rather than the sum of all of them.
+        tables = sorted(by_table, key=lambda t: -max(s['seconds'] for s in by_table[t]))
+
+        logger.info(f'Sync timing report for run {self.run_id}:')
+        for t in tables:
+            logger.info(f'{t}:')
+            for s in sorted(by_table[t], key=lambda s: -s['seconds']):
+                rate = f", {s['rows'] / s['seconds']:.0f} rows/s" if s['rows'] and s['seconds'] else ''
+                logger.info(f"  {s['phase']:<16} {s['seconds']:>10.1f}s  {s['calls']:>5} calls  "
+                            f"{s['rows']:>12} rows  {s['bytes'] / 1024 / 1024:>9.1f} MB  "
+                            f"{s['retries']} retries  {s['errors']} errors{rate}")
+
+        return summary
+
+    def to_redshift(self, rs, table_name, **copy_args):
+        """
+        Append the per-phase totals of the run to a Redshift table.
+        `Args:`
+            rs: Redshift
+                The parsons Redshift connector
+            table_name: str
+                Full table path of the summary table
+            **copy_args: kwargs
+                Optional copy arguments
+        """
+
+        summary = self.summary()
+        if not summary:
+            return
+
+        for s in summary:
+            s['seconds'] = round(s['seconds'], 3)
+
+        rs.copy(Table(summary), table_name, if_exists='append', **copy_args)
+        logger.info(f'Loaded {len(summary)} sync timing rows to {table_name}.')
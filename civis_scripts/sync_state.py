@@ -0,0 +1,485 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+import datetime
+from parsons import S3
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+DEFAULT_STATE_PATH = 'sync_state.db'
+
+
+def db_identity(db):
+    """
+    Build a string identifying the database a parsons connector points at, used to key
+    sync state by (source, destination) pair.
+    `Args:`
+        db: object
+            A parsons Redshift, MySQL or Postgres connector
+    `Returns:`
+        str
+    """
+
+    host = getattr(db, 'host', None) or ''
+    name = getattr(db, 'db', None) or ''
+    return f"{type(db).__name__.lower()}://{host}/{name}"
+
+
+class SyncStateStore:
+    """
+    SQLite-backed store of sync watermarks, row counts and run metadata for each
+    (source, destination) table pair.
+
+    Civis containers do not keep files between runs, so the database file can be
+    mirrored to S3: ``pull`` downloads it at the start of a run and ``push`` uploads it
+    again once state has changed. The store is safe to share between sync workers.
+
+    `Args:`
+        path: str
+            Local path of the SQLite database file
+        s3_bucket: str
+            Optional S3 bucket to mirror the database file to
+        s3_key: str
+            The S3 key of the mirrored file. Defaults to the file name of ``path``.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH, s3_bucket=None, s3_key=None):
+        self.path = path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key or os.path.basename(path)
+        self._lock = threading.RLock()
+        self._conn = None
+
+    @classmethod
+    def from_env(cls, prefix='SYNC_STATE'):
+        """
+        Create a store from the ``{prefix}_PATH``, ``{prefix}_BUCKET`` and
+        ``{prefix}_KEY`` environment variables, pulling the latest copy from S3.
+        `Args:`
+            prefix: str
+                The environment variable prefix
+        `Returns:`
+            ``SyncStateStore`` or ``None`` if neither a path nor a bucket is set
+        """
+
+        path = os.environ.get(f'{prefix}_PATH')
+        bucket = os.environ.get(f'{prefix}_BUCKET')
+        if not path and not bucket:
+            return None
+
+        store = cls(path or DEFAULT_STATE_PATH, s3_bucket=bucket,
+                    s3_key=os.environ.get(f'{prefix}_KEY'))
+        store.pull()
+        return store
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._create_tables()
+        return self._conn
+
+    def _create_tables(self):
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                source TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                source_table TEXT NOT NULL,
+                destination_table TEXT NOT NULL,
+                watermark TEXT,
+                source_rows INTEGER,
+                destination_rows INTEGER,
+                rows_copied INTEGER,
+                verified_at TEXT,
+                updated_at TEXT NOT NULL,
+                metadata TEXT,
+                PRIMARY KEY (source, destination, source_table, destination_table)
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_checkpoint (
+                source TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                source_table TEXT NOT NULL,
+                destination_table TEXT NOT NULL,
+                cutoff_value TEXT,
+                chunk_id INTEGER NOT NULL,
+                start_key TEXT,
+                last_key TEXT NOT NULL,
+                chunk_rows INTEGER NOT NULL,
+                rows_copied INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (source, destination, source_table, destination_table)
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_size (
+                source TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                source_table TEXT NOT NULL,
+                destination_table TEXT NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                rows_per_second REAL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (source, destination, source_table, destination_table)
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS distinct_check (
+                source TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                source_table TEXT NOT NULL,
+                destination_table TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                row_count INTEGER,
+                distinct_keys INTEGER,
+                checked_at TEXT NOT NULL,
+                PRIMARY KEY (source, destination, source_table, destination_table, mode)
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS table_schema (
+                db TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                schema TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (db, table_name)
+            )""")
+        self._conn.commit()
+
+    def pull(self):
+        """
+        Replace the local database file with the copy in S3, if there is one.
+        """
+
+        if not self.s3_bucket:
+            return
+
+        with self._lock:
+            self.close()
+            s3 = S3()
+            if s3.key_exists(self.s3_bucket, self.s3_key):
+                s3.get_file(self.s3_bucket, self.s3_key, local_path=self.path)
+                logger.info(f"Pulled sync state from s3://{self.s3_bucket}/{self.s3_key}")
+
+    def push(self):
+        """
+        Upload the local database file to S3.
+        """
+
+        if not self.s3_bucket:
+            return
+
+        with self._lock:
+            self.conn.commit()
+            S3().put_file(self.s3_bucket, self.s3_key, self.path)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_state(self, source, destination, source_table, destination_table):
+        """
+        Get the saved state of a table pair.
+        `Args:`
+            source: str
+                The source database identity (see ``db_identity``)
+            destination: str
+                The destination database identity
+            source_table: str
+                Full source table path
+            destination_table: str
+                Full destination table path
+        `Returns:`
+            dict or ``None`` if the pair has never been synced
+        """
+
+        with self._lock:
+            row = self.conn.execute(
+                """SELECT * FROM sync_state WHERE source = ? AND destination = ?
+                   AND source_table = ? AND destination_table = ?""",
+                (source, destination, source_table, destination_table)).fetchone()
+
+        if row is None:
+            return None
+
+        state = dict(row)
+        state['watermark'] = json.loads(state['watermark']) if state['watermark'] else None
+        state['metadata'] = json.loads(state['metadata']) if state['metadata'] else {}
+        return state
+
+    def save_state(self, source, destination, source_table, destination_table, watermark,
+                   source_rows=None, destination_rows=None, rows_copied=None, verified=False,
+                   **metadata):
+        """
+        Record the last committed watermark of a table pair.
+        `Args:`
+            source: str
+                The source database identity (see ``db_identity``)
+            destination: str
+                The destination database identity
+            source_table: str
+                Full source table path
+            destination_table: str
+                Full destination table path
+            watermark: str
+                The highest updated value copied to the destination
+            source_rows: int
+                The source row count, if it was counted
+            destination_rows: int
+                The destination row count, if it was counted
+            rows_copied: int
+                The number of rows copied by this run
+            verified: bool
+                Whether this run checked the tables against each other with full-table
+                probes. The previous verification time is kept otherwise.
+            **metadata: kwargs
+                Any other run metadata to record
+        """
+
+        now = datetime.datetime.utcnow().isoformat()
+        previous = self.get_state(source, destination, source_table, destination_table) or {}
+
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO sync_state
+                   (source, destination, source_table, destination_table, watermark,
+                    source_rows, destination_rows, rows_copied, verified_at, updated_at,
+                    metadata)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (source, destination, source_table, destination_table,
+                 json.dumps(watermark, default=str),
+                 source_rows if source_rows is not None else previous.get('source_rows'),
+                 (destination_rows if destination_rows is not None
+                  else previous.get('destination_rows')),
+                 rows_copied,
+                 now if verified else previous.get('verified_at'),
+                 now,
+                 json.dumps(metadata, default=str)))
+            self.conn.commit()
+
+    def clear_state(self, source, destination, source_table, destination_table):
+        """
+        Forget the saved state of a table pair, so its next sync runs every probe.
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """DELETE FROM sync_state WHERE source = ? AND destination = ?
+                   AND source_table = ? AND destination_table = ?""",
+                (source, destination, source_table, destination_table))
+            self.conn.commit()
+
+    def save_checkpoint(self, source, destination, source_table, destination_table,
+                        cutoff_value, chunk_id, start_key, last_key, chunk_rows, rows_copied):
+        """
+        Record that a chunk of an in-progress sync has been committed to the destination.
+        `Args:`
+            source: str
+                The source database identity (see ``db_identity``)
+            destination: str
+                The destination database identity
+            source_table: str
+                Full source table path
+            destination_table: str
+                Full destination table path
+            cutoff_value: str
+                The watermark the in-progress sync started from
+            chunk_id: int
+                The sequence number of the committed chunk, starting at 1
+            start_key: tuple
+                The key tuple the chunk was read after, or ``None`` for the first chunk
+            last_key: tuple
+                The key tuple of the last row of the chunk
+            chunk_rows: int
+                The number of rows in the chunk
+            rows_copied: int
+                The total number of rows copied so far, including this chunk
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO sync_checkpoint
+                   (source, destination, source_table, destination_table, cutoff_value,
+                    chunk_id, start_key, last_key, chunk_rows, rows_copied, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (source, destination, source_table, destination_table,
+                 json.dumps(cutoff_value, default=str), chunk_id,
+                 json.dumps(start_key, default=str), json.dumps(last_key, default=str),
+                 chunk_rows, rows_copied, datetime.datetime.utcnow().isoformat()))
+            self.conn.commit()
+
+    def get_checkpoint(self, source, destination, source_table, destination_table):
+        """
+        Get the last committed chunk of an interrupted sync.
+        `Returns:`
+            dict or ``None`` if the last sync of the pair finished
+        """
+
+        with self._lock:
+            row = self.conn.execute(
+                """SELECT * FROM sync_checkpoint WHERE source = ? AND destination = ?
+                   AND source_table = ? AND destination_table = ?""",
+                (source, destination, source_table, destination_table)).fetchone()
+
+        if row is None:
+            return None
+
+        checkpoint = dict(row)
+        for k in ('cutoff_value', 'start_key', 'last_key'):
+            value = json.loads(checkpoint[k]) if checkpoint[k] else None
+            checkpoint[k] = tuple(value) if isinstance(value, list) else value
+        return checkpoint
+
+    def clear_checkpoint(self, source, destination, source_table, destination_table):
+        """
+        Remove the checkpoint of a table pair once its sync has finished.
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """DELETE FROM sync_checkpoint WHERE source = ? AND destination = ?
+                   AND source_table = ? AND destination_table = ?""",
+                (source, destination, source_table, destination_table))
+            self.conn.commit()
+
+    def get_chunk_size(self, source, destination, source_table, destination_table):
+        """
+        Get the best chunk size found by previous syncs of a table pair.
+        `Returns:`
+            int or ``None``
+        """
+
+        with self._lock:
+            row = self.conn.execute(
+                """SELECT chunk_size FROM chunk_size WHERE source = ? AND destination = ?
+                   AND source_table = ? AND destination_table = ?""",
+                (source, destination, source_table, destination_table)).fetchone()
+
+        return row['chunk_size'] if row else None
+
+    def save_chunk_size(self, source, destination, source_table, destination_table,
+                        chunk_size, rows_per_second=None):
+        """
+        Remember the best chunk size of a table pair for the next sync.
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO chunk_size
+                   (source, destination, source_table, destination_table, chunk_size,
+                    rows_per_second, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (source, destination, source_table, destination_table, int(chunk_size),
+                 rows_per_second, datetime.datetime.utcnow().isoformat()))
+            self.conn.commit()
+
+    def get_distinct_check(self, source, destination, source_table, destination_table,
+                           mode='full'):
+        """
+        Get the last distinct primary key check of a table pair run in a mode.
+        `Returns:`
+            dict with ``row_count``, ``distinct_keys`` and ``checked_at``, or ``None``
+        """
+
+        with self._lock:
+            row = self.conn.execute(
+                """SELECT row_count, distinct_keys, checked_at FROM distinct_check
+                   WHERE source = ? AND destination = ? AND source_table = ?
+                   AND destination_table = ? AND mode = ?""",
+                (source, destination, source_table, destination_table, mode)).fetchone()
+
+        return dict(row) if row else None
+
+    def save_distinct_check(self, source, destination, source_table, destination_table,
+                            mode, row_count=None, distinct_keys=None):
+        """
+        Record a passed distinct primary key check of a table pair.
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO distinct_check
+                   (source, destination, source_table, destination_table, mode, row_count,
+                    distinct_keys, checked_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (source, destination, source_table, destination_table, mode, row_count,
+                 distinct_keys, datetime.datetime.utcnow().isoformat()))
+            self.conn.commit()
+
+    def get_table_schema(self, db, table_name):
+        """
+        Get the schema of a table saved by ``SchemaCache``.
+        `Args:`
+            db: str
+                The database identity (see ``db_identity``)
+            table_name: str
+                Full table path
+        `Returns:`
+            dict or ``None``
+        """
+
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT schema FROM table_schema WHERE db = ? AND table_name = ?",
+                (db, table_name)).fetchone()
+
+        return json.loads(row['schema']) if row else None
+
+    def save_table_schema(self, db, table_name, schema):
+        """
+        Save the schema of a table for the next run.
+        """
+
+        with self._lock:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO table_schema (db, table_name, schema, updated_at)
+                   VALUES (?, ?, ?, ?)""",
+                (db, table_name, json.dumps(schema, default=str),
+                 datetime.datetime.utcnow().isoformat()))
+            self.conn.commit()
+
+    def clear_table_schema(self, db, table_name):
+        """
+        Forget the saved schema of a table, e.g. after altering it.
+        """
+
+        with self._lock:
+            self.conn.execute("DELETE FROM table_schema WHERE db = ? AND table_name = ?",
+                              (db, table_name))
+            self.conn.commit()
+
+    def get_table_versions(self, tables, destination=None):
+        """
+        Get the time each table was last synced, for telling whether something derived
+        from the tables is out of date. A table matches a destination table with the
+        name, and a table given without a schema matches that name in any schema.
+        `Args:`
+            tables: list
+                Table names, e.g. ``core_action`` or ``coc_ak.core_action``
+            destination: str
+                Optional destination database identity to only match tables synced to
+        `Returns:`
+            dict of table name to its last sync time, or ``None`` if it was never synced
+        """
+
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT destination_table, MAX(updated_at) AS updated_at FROM sync_state "
+                "WHERE ? IS NULL OR destination = ? "
+                "GROUP BY destination_table", (destination, destination)).fetchall()
+
+        versions = dict.fromkeys(tables)
+        for row in rows:
+            for t in tables:
+                if row['destination_table'] == t or ('.' not in t and
+                                                     row['destination_table'].endswith('.' + t)):
+                    versions[t] = max(filter(None, [versions[t], row['updated_at']]))
+        return versions
@@ -0,0 +1,284 @@
+import os
+import time
+import logging
+from parsons import Redshift, MySQL
+from sync_state import SyncStateStore, db_identity
+
+# Define the default logging config for Canales scripts
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+TMC_CIVIS_DATABASE = 815
+
+# Columns of the user_last_activity table, one row per user with any activity.
+# last_activity_at is the latest of the complete action, open and order times, so
+# inactivity segments are a range scan on one sorted column.
+ACTIVITY_COLUMNS = ['user_id', 'last_action_at', 'last_complete_action_at',
+                    'last_mailing_action_at', 'last_open_at', 'last_order_at',
+                    'last_activity_at', 'refreshed_at']
+ACTIVITY_TIMES = ACTIVITY_COLUMNS[1:-2]
+
+# The tables activity is read from, with the column that tracks new rows
+CHANGE_SOURCES = {'core_action': 'updated_at',
+                  'core_open': 'created_at',
+                  'core_order': 'created_at'}
+
+def set_env_var(name, value, overwrite=False):
+    """
+    Set an environment variable to a value.
+    `Args:`
+        name: str
+            Name of the env var
+        value: str
+            New value for the env var
+        overwrite: bool
+            Whether to set the env var even if it already exists
+    """
+    # Do nothing if we don't have a value
+    if not value:
+        return
+
+    # Do nothing if env var already exists
+    if os.environ.get(name) and not overwrite:
+        return
+
+    os.environ[name] = value
+
+def setup_environment(redshift_parameter="REDSHIFT", aws_parameter="AWS"):
+    """
+    Sets up environment variables needed for various common services used by our scripts.
+    Call this at the beginning of your script.
+    `Args:`
+        redshift_parameter: str
+            Name of the Civis script parameter holding Redshift credentials. This parameter
+            should be of type "database (2 dropdown)" in Civis.
+        aws_parameter: str
+            Name of the Civis script parameter holding AWS credentials.
+    """
+
+    env = os.environ
+
+    # Civis setup
+
+    set_env_var('CIVIS_DATABASE', str(TMC_CIVIS_DATABASE))
+
+    # Redshift setup
+
+    set_env_var('REDSHIFT_PORT', '5432')
+    set_env_var('REDSHIFT_DB', 'dev')
+    set_env_var('REDSHIFT_HOST', env.get(f'{redshift_parameter}_HOST'))
+    set_env_var('REDSHIFT_USERNAME', env.get(f'{redshift_parameter}_CREDENTIAL_USERNAME'))
+    set_env_var('REDSHIFT_PASSWORD', env.get(f'{redshift_parameter}_CREDENTIAL_PASSWORD'))
+
+    # AWS setup
+
+    set_env_var('S3_TEMP_BUCKET', 'parsons-tmc')
+    set_env_var('AWS_ACCESS_KEY_ID', env.get(f'{aws_parameter}_USERNAME'))
+    set_env_var('AWS_SECRET_ACCESS_KEY', env.get(f'{aws_parameter}_PASSWORD'))
+
+def _greatest(*columns):
+    # Latest non-null value. MySQL's GREATEST is null if any argument is, so every
+    # argument falls back to the others first.
+    return 'GREATEST({})'.format(', '.join(
+        f"COALESCE({', '.join([c] + [o for o in columns if o != c])})" for c in columns))
+
+def ensure_activity_table(db, table):
+    """
+    Create the user_last_activity table, sorted (Redshift) or indexed (MySQL) on
+    ``last_activity_at``.
+    `Args:`
+        db: Redshift or MySQL
+            The parsons connector of the database holding the ActionKit tables
+        table: str
+            Full table path of the user_last_activity table
+    """
+
+    time_type = 'datetime' if isinstance(db, MySQL) else 'timestamp'
+    columns_sql = ', '.join(['user_id bigint not null'] +
+                            [f"{c} {time_type}" for c in ACTIVITY_COLUMNS[1:]])
+
+    if isinstance(db, MySQL):
+        db.query(f"""create table if not exists {table} ({columns_sql},
+                     primary key (user_id), index (last_activity_at),
+                     index (last_mailing_action_at))""")
+    else:
+        db.query(f"""create table if not exists {table} ({columns_sql})
+                     distkey(user_id) sortkey(last_activity_at)""")
+
+def changed_activity_sql(source_schema='', time_type='timestamp'):
+    """
+    Build the query for the latest activity of each user in the rows added or updated
+    between two watermarks. Takes a ``(low, high)`` pair of parameters per source
+    table, in ``CHANGE_SOURCES`` order.
+    `Args:`
+        source_schema: str
+            Schema prefix of the ActionKit tables, e.g. ``coc_ak.``
+        time_type: str
+            The timestamp type of the database, for typing the null columns
+    `Returns:`
+        str
+    """
+
+    s = source_schema
+    null = f"cast(null as {time_type})"
+    return f"""
+        select user_id,
+               max(action_at) last_action_at,
+               max(complete_action_at) last_complete_action_at,
+               max(mailing_action_at) last_mailing_action_at,
+               max(open_at) last_open_at,
+               max(order_at) last_order_at
+        from (
+            select user_id, updated_at action_at,
+                   case when source <> 'import' and status = 'complete'
+                        then updated_at end complete_action_at,
+                   case when source <> 'import' and status = 'complete'
+                        and mailing_id is not null then updated_at end mailing_action_at,
+                   {null} open_at, {null} order_at
+            from {s}core_action where updated_at > %s and updated_at <= %s
+            union all
+            select user_id, {null}, {null}, {null}, created_at, {null}
+            from {s}core_open where created_at > %s and created_at <= %s
+            union all
+            select user_id, {null}, {null}, {null}, {null}, created_at
+            from {s}core_order where created_at > %s and created_at <= %s
+        ) activity
+        group by user_id"""
+
+def refresh_user_last_activity(db, table, source_schema='', state_store=None,
+                               full_refresh=False, version_store=None):
+    """
+    Fold the actions, opens and orders added since the last refresh into the
+    user_last_activity table. The latest activity of each touched user is merged
+    with their saved row and swapped in with a delete and insert in one transaction.
+    The table is rebuilt from all history when ``full_refresh`` is set or there is no
+    saved watermark for every source table.
+    `Args:`
+        db: Redshift or MySQL
+            The parsons connector of the database holding the ActionKit tables
+        table: str
+            Full table path of the user_last_activity table
+        source_schema: str
+            Schema prefix of the ActionKit tables, e.g. ``coc_ak.``
+        state_store: SyncStateStore
+            Optional store of the watermark of each source table
+        full_refresh: bool
+            Rebuild the whole table
+        version_store: SyncStateStore
+            Optional sync state store the query cache checks, to record the refresh in
+            so cached results that read the table go stale
+    """
+
+    ensure_activity_table(db, table)
+    identity = db_identity(db)
+    time_type = 'datetime' if isinstance(db, MySQL) else 'timestamp'
+
+    # Read the high marks first, so rows added during the refresh are picked up next time
+    high_marks = {}
+    for source_table, change_col in CHANGE_SOURCES.items():
+        tbl = db.query(f"select max({change_col}) high_mark from {source_schema}{source_table}")
+        high_marks[source_table] = tbl.first if tbl else None
+
+    watermarks = dict.fromkeys(CHANGE_SOURCES)
+    if state_store and not full_refresh:
+        for source_table in CHANGE_SOURCES:
+            state = state_store.get_state(identity, identity, f"{source_schema}{source_table}", table)
+            watermarks[source_table] = state['watermark'] if state else None
+    full_refresh = full_refresh or any(w is None for w in watermarks.values())
+
+    parameters = []
+    for source_table in CHANGE_SOURCES:
+        parameters += [watermarks[source_table] or '1900-01-01',
+                       high_marks[source_table] or '1900-01-01']
+
+    merged_times = ', '.join(f"{_greatest('saved.' + c, 'changed.' + c)} {c}" for c in ACTIVITY_TIMES)
+    activity_times = [_greatest(*[f"saved.{c}" for c in ('last_complete_action_at', 'last_open_at',
+                                                          'last_order_at')]),
+                      _greatest(*[f"changed.{c}" for c in ('last_complete_action_at', 'last_open_at',
+                                                            'last_order_at')])]
+
+    logger.info(f"{'Rebuilding' if full_refresh else 'Refreshing'} {table}")
+
+    # Temporary tables only live as long as their session, so it all runs on one connection
+    with db.connection() as connection:
+        db.query_with_connection(
+            f"""create temporary table user_activity_changed as
+                {changed_activity_sql(source_schema, time_type)}""",
+            connection, parameters=parameters, commit=False)
+
+        # A rebuild starts from an empty table, so nothing saved is merged in
+        if full_refresh:
+            db.query_with_connection(f"delete from {table}", connection, commit=False)
+
+        db.query_with_connection(f"""
+            create temporary table user_activity_merged as
+            select changed.user_id, {merged_times},
+                   {_greatest(*activity_times)} last_activity_at,
+                   current_timestamp refreshed_at
+            from user_activity_changed changed
+            left join {table} saved on saved.user_id = changed.user_id""",
+            connection, commit=False)
+
+        if not full_refresh:
+            db.query_with_connection(
+                f"delete from {table} where user_id in (select user_id from user_activity_changed)",
+                connection, commit=False)
+
+        columns = ', '.join(ACTIVITY_COLUMNS)
+        db.query_with_connection(
+            f"insert into {table} ({columns}) select {columns} from user_activity_merged",
+            connection, commit=False)
+        connection.commit()
+
+    if state_store:
+        for source_table, high_mark in high_marks.items():
+            if high_mark is not None:
+                state_store.save_state(identity, identity, f"{source_schema}{source_table}",
+                                       table, high_mark)
+
+    # The table is derived in place, so it is recorded as synced from itself
+    if version_store:
+        version_store.save_state(identity, identity, table, table,
+                                 max(filter(None, high_marks.values()), default=None))
+
+def main():
+    setup_environment()
+
+    #set begin time to see how long the script takes to run
+    start = time.time()
+
+    # Maintain the table next to the synced ActionKit tables in Redshift by default
+    if os.environ.get('USER_ACTIVITY_DB', 'redshift').lower() == 'mysql':
+        db = MySQL()
+        source_schema = os.environ.get('USER_ACTIVITY_SOURCE_SCHEMA', '')
+    else:
+        db = Redshift()
+        source_schema = os.environ.get('USER_ACTIVITY_SOURCE_SCHEMA', 'coc_ak.')
+
+    table = os.environ.get('USER_ACTIVITY_TABLE') or f"{source_schema}user_last_activity"
+    full_refresh = os.environ.get('USER_ACTIVITY_FULL_REFRESH', 'false').lower() == 'true'
+
+    # Watermarks of the source tables; without them every run is a full rebuild
+    state_store = SyncStateStore.from_env('USER_ACTIVITY_STATE')
+    # The sync state the query cache checks, so cached results over the table go stale
+    version_store = SyncStateStore.from_env()
+
+    try:
+        refresh_user_last_activity(db, table, source_schema=source_schema,
+                                   state_store=state_store, full_refresh=full_refresh,
+                                   version_store=version_store)
+    finally:
+        if state_store:
+            state_store.push()
+        if version_store:
+            version_store.push()
+
+    logger.info(f"User activity refresh took {time.time() - start:.1f} seconds")
+
+
+if __name__ == '__main__':
+    main()
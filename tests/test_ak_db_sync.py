@@ -0,0 +1,287 @@
+import re
+import sqlite3
+import datetime
+import pytest
+
+parsons = pytest.importorskip('parsons')
+Table = parsons.Table
+
+import ak_db_sync
+import schema_cache
+from schema_cache import SchemaCache
+from sync_state import SyncStateStore
+
+# psycopg2-style placeholders, rewritten to SQLite's
+PLACEHOLDER = re.compile(r'%s')
+
+
+class SQLiteTable:
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+    @property
+    def num_rows(self):
+        return self.db.query(f"SELECT COUNT(*) AS row_count FROM {self.table}").first
+
+    def get_new_rows_count(self, updated_col, cutoff_value):
+        return self.db.query(f"SELECT COUNT(*) AS row_count FROM {self.table} "
+                             f"WHERE {updated_col} >= %s", parameters=[cutoff_value]).first
+
+
+class SQLiteDB:
+    """
+    Just enough of a parsons connector, on an in-memory SQLite database, to run
+    ``table_sync_incremental_upsert`` in upsert mode.
+    """
+
+    def __init__(self, name):
+        self.host = 'localhost'
+        self.db = name
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+
+    def query(self, sql, parameters=None):
+        cursor = self.conn.execute(PLACEHOLDER.sub('?', sql), parameters or [])
+        self.conn.commit()
+        if cursor.description is None:
+            return None
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        return Table([dict(zip(columns, r)) for r in rows]) if rows else None
+
+    def table(self, table):
+        return SQLiteTable(self, table)
+
+    def table_exists(self, table_name):
+        schema, name = table_name.split('.', 1)
+        return bool(self.conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?",
+                                      [name]).fetchone())
+
+    def copy(self, tbl, table_name, if_exists='fail', **kwargs):
+        columns = list(tbl.columns)
+        if if_exists == 'drop':
+            self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)})")
+        self.conn.executemany(
+            f"INSERT INTO {table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [tuple(row[c] for c in columns) for row in tbl])
+        self.conn.commit()
+
+    def upsert(self, tbl, table_name, primary_key, **kwargs):
+        columns = list(tbl.columns)
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {table_name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [tuple(row[c] for c in columns) for row in tbl])
+        self.conn.commit()
+
+
+class SQLiteSchemaCache(SchemaCache):
+
+    def _read_columns(self, db, table):
+        schema, table_name = table.split('.', 1)
+        return [{'column_name': c[1], 'data_type': c[2], 'character_maximum_length': None,
+                 'numeric_precision': None, 'numeric_scale': None}
+                for c in db.conn.execute(f"PRAGMA {schema}.table_info({table_name})")]
+
+
+def insert_actions(db, first_id, count, updated_at):
+    db.conn.executemany("INSERT INTO core_action VALUES (?, ?, ?)",
+                        [(i, f"action {i}", updated_at) for i in range(first_id, first_id + count)])
+    db.conn.commit()
+
+
+def test_offset_sync_advances_saved_watermark(tmp_path, monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'postgres')
+
+    source = SQLiteDB('source')
+    destination = SQLiteDB('destination')
+    for db in (source, destination):
+        db.query("CREATE TABLE core_action (id INTEGER PRIMARY KEY, name TEXT, updated_at TEXT)")
+
+    state_store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    state_key = ('sqlite://localhost/source', 'sqlite://localhost/destination',
+                 'main.core_action', 'main.core_action')
+    # Both runs start from a saved watermark, skipping the full-table probes
+    state_store.save_state(*state_key, watermark='2024-01-01 00:00:00')
+    monkeypatch.setattr(ak_db_sync, 'db_identity', lambda db: f"sqlite://localhost/{db.db}")
+
+    dbsync = parsons.DBSync(source, destination)
+    dbsync.chunk_size = 4
+
+    def sync():
+        ak_db_sync.table_sync_incremental_upsert(
+            dbsync, 'main.core_action', 'main.core_action', 'id', 'updated_at',
+            distinct_check=False, pagination='offset', state_store=state_store,
+            schema_cache=SQLiteSchemaCache(rename=ak_db_sync.reserved_column_name))
+        return state_store.get_state(*state_key)['watermark']
+
+    insert_actions(source, 1, 10, '2024-01-02 00:00:00')
+    assert sync() == '2024-01-02 00:00:00'
+
+    insert_actions(source, 11, 5, '2024-01-03 00:00:00')
+    assert sync() == '2024-01-03 00:00:00'
+    assert destination.query("SELECT COUNT(*) AS row_count FROM core_action").first == 15
+
+
+def test_partition_ranges_cover_null_keys(monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'postgres')
+
+    source = SQLiteDB('source')
+    destination = SQLiteDB('destination')
+    source.query("CREATE TABLE core_action (id INTEGER PRIMARY KEY, name TEXT, updated_at TEXT)")
+    for day in range(1, 9):
+        insert_actions(source, day * 10, 3, f"2024-01-0{day} 00:00:00")
+    insert_actions(source, 100, 5, None)
+
+    ranges = ak_db_sync.get_partition_ranges(source, 'main.core_action', 'updated_at', 3)
+    assert ranges[-1] == ak_db_sync.NULL_KEY_RANGE
+
+    copied = sum(ak_db_sync.copy_key_range(source, destination, 'main.core_action',
+                                           'main.core_action', 'updated_at', 'id', key_range,
+                                           chunk_size=2)
+                 for key_range in ranges)
+    assert copied == 29
+    assert (sorted(r['id'] for r in destination.query("SELECT id FROM core_action"))
+            == sorted(r['id'] for r in source.query("SELECT id FROM core_action")))
+
+
+def test_parallel_full_refresh_keeps_destination_after_short_copy(monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'postgres')
+    # Every range after the first chunk copies nothing
+    monkeypatch.setattr(ak_db_sync, 'copy_key_range', lambda *args, **kwargs: 0)
+
+    source = SQLiteDB('source')
+    destination = SQLiteDB('destination')
+    for db in (source, destination):
+        db.query("CREATE TABLE core_action (id INTEGER PRIMARY KEY, name TEXT, updated_at TEXT)")
+    insert_actions(source, 1, 10, '2024-01-02 00:00:00')
+    insert_actions(destination, 1, 8, '2024-01-01 00:00:00')
+
+    dbsync = parsons.DBSync(source, destination)
+    dbsync.chunk_size = 2
+
+    with pytest.raises(ValueError, match='was left in place'):
+        ak_db_sync.table_sync_parallel(dbsync, 'main.core_action', 'main.core_action', 'id',
+                                       partitions=2)
+    assert destination.query("SELECT COUNT(*) AS row_count FROM core_action").first == 8
+
+
+def test_schema_drift_rereads_saved_schemas_before_altering(tmp_path, monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'postgres')
+    monkeypatch.setattr(ak_db_sync, 'db_identity', lambda db: f"sqlite://localhost/{db.db}")
+    monkeypatch.setattr(schema_cache, 'db_identity', lambda db: f"sqlite://localhost/{db.db}")
+
+    source = SQLiteDB('source')
+    destination = SQLiteDB('destination')
+    for db in (source, destination):
+        db.query("CREATE TABLE core_action (id INTEGER PRIMARY KEY, name TEXT, updated_at TEXT, "
+                 "source_id INTEGER)")
+    source.conn.executemany("INSERT INTO core_action VALUES (?, ?, ?, ?)",
+                            [(i, f"action {i}", '2024-01-02 00:00:00', i) for i in range(1, 4)])
+    source.conn.commit()
+
+    # A previous run saved the source schema before source_id was added to it
+    state_store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    cache = SQLiteSchemaCache(state_store, rename=ak_db_sync.reserved_column_name)
+    stale = dict(cache.table_schema(source, 'main.core_action'))
+    stale['columns'] = ['id', 'name', 'updated_at']
+    state_store.save_table_schema('sqlite://localhost/source', 'main.core_action', stale)
+
+    dbsync = parsons.DBSync(source, destination)
+    dbsync.chunk_size = 4
+    ak_db_sync.table_sync_incremental_upsert(
+        dbsync, 'main.core_action', 'main.core_action', 'id', 'updated_at',
+        distinct_check=False, state_store=state_store,
+        schema_cache=SQLiteSchemaCache(state_store, rename=ak_db_sync.reserved_column_name))
+
+    columns = [c[1] for c in destination.conn.execute("PRAGMA table_info(core_action)")]
+    assert 'source_id' in columns
+
+
+def test_row_hash_sql_hashes_the_same_text_on_every_dialect():
+    columns = ['id', 'name', 'updated_at']
+    rendered = {d: ak_db_sync.row_hash_sql(d, columns) for d in ('mysql', 'redshift', 'postgres')}
+
+    for dialect, sql in rendered.items():
+        # A backslash in a literal is an escape on MySQL and plain text elsewhere
+        assert '\\' not in sql, dialect
+        assert sql.count(f"'{ak_db_sync.NULL_HASH_TEXT}'") == len(columns), dialect
+        # Every dialect hashes the first 8 hex digits of the MD5 of the row text
+        assert 'LEFT(MD5(' in sql and ', 8)' in sql, dialect
+
+    # MySQL joins the values with CONCAT_WS, the others with ||, in the same order
+    assert "CONCAT_WS('|', COALESCE(CAST(id AS CHAR)" in rendered['mysql']
+    assert ("COALESCE(CAST(id AS VARCHAR(65535)), '<NULL>') || '|' || "
+            "COALESCE(CAST(name AS VARCHAR(65535))") in rendered['redshift']
+    # CONV returns text, which MySQL would sum as a DOUBLE
+    assert rendered['mysql'].startswith('CAST(CONV(') and rendered['mysql'].endswith('AS UNSIGNED)')
+
+
+def test_block_hashes_sum_exactly(monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'mysql')
+    queries = []
+
+    class RecordingDB:
+        def query(self, sql, parameters=None):
+            queries.append(sql)
+            return None
+
+    ak_db_sync.get_block_hashes(RecordingDB(), 'ak.core_action', 'id', ['id', 'name'], 1000)
+    assert 'AS DECIMAL(38, 0)) AS block_hash' in queries[0]
+
+
+@pytest.mark.parametrize('exact_distinct, passes', [(1000, True), (990, False)])
+def test_approx_distinct_check_counts_exactly_below_the_row_count(monkeypatch, exact_distinct,
+                                                                  passes):
+    counts = []
+
+    def count_distinct_keys(db, table, primary_key, approximate=False, **kwargs):
+        counts.append(approximate)
+        # The estimate is 3% low, which alone says nothing about duplicates
+        return 1000, 970 if approximate else exact_distinct
+
+    monkeypatch.setattr(ak_db_sync, 'count_distinct_keys', count_distinct_keys)
+
+    if passes:
+        assert ak_db_sync.check_distinct_key(None, 'ak.core_action', 'id', 'approx') == 'full'
+    else:
+        with pytest.raises(ValueError):
+            ak_db_sync.check_distinct_key(None, 'ak.core_action', 'id', 'approx')
+    assert counts == [True, False]
+
+
+def test_approx_distinct_check_trusts_an_estimate_at_the_row_count(monkeypatch):
+    counts = []
+
+    def count_distinct_keys(db, table, primary_key, approximate=False, **kwargs):
+        counts.append(approximate)
+        return 1000, 1004
+
+    monkeypatch.setattr(ak_db_sync, 'count_distinct_keys', count_distinct_keys)
+
+    assert ak_db_sync.check_distinct_key(None, 'ak.core_action', 'id', 'approx') == 'approx'
+    assert counts == [True]
+
+
+def test_prefetched_chunks_resize_from_the_size_they_were_read_with(monkeypatch):
+    monkeypatch.setattr(ak_db_sync, 'db_dialect', lambda db: 'postgres')
+    source = SQLiteDB('source')
+    source.query("CREATE TABLE core_action (id INTEGER PRIMARY KEY, name TEXT, updated_at TEXT)")
+    insert_actions(source, 1, 60, '2024-01-02 00:00:00')
+
+    controller = ak_db_sync.ChunkSizeController(16, min_size=1, target_seconds=60)
+    chunks = ak_db_sync.iter_new_row_chunks(source, 'main.core_action', 'updated_at', 'id',
+                                            chunk_size=controller, pagination='offset',
+                                            new_row_count=60)
+
+    read_rows = 0
+    for chunk in ak_db_sync.prefetch_chunks(chunks, max_in_flight=2):
+        read_rows += chunk.rows.num_rows
+        # Every write takes twice the target, so each chunk halves its own read size,
+        # however many chunks were read ahead of the previous resize
+        controller.record(chunk.rows.num_rows, 0, 0, 120, size=chunk.size)
+        assert controller.size == max(1, chunk.size // 2)
+    assert read_rows == 60
@@ -0,0 +1,87 @@
+import contextlib
+import pytest
+
+parsons = pytest.importorskip('parsons')
+Table = parsons.Table
+
+import ak_query_runner
+
+
+def test_conditional_blocks_follow_their_parameter():
+    template = ("select * from core_action"
+                "{% if since %} where created_at >= {since}{% else %} where true{% endif %}"
+                "{% if not everyone %} and subscribed{% endif %}")
+
+    assert ak_query_runner.render_template(template, {'since': '2024-01-01', 'everyone': False}) == (
+        "select * from core_action where created_at >= %s and subscribed", ['2024-01-01'])
+    assert ak_query_runner.render_template(template, {'since': None, 'everyone': True}) == (
+        "select * from core_action where true", None)
+
+    with pytest.raises(ValueError):
+        ak_query_runner.render_template(template, {'since': None})
+
+
+def test_named_placeholders_are_bound_and_regex_quantifiers_kept():
+    template = ("select * from core_user where zip ~ '^[0-9]{5}$' and state = {state} "
+                "and country = {{ country }} and phone ~ '[0-9]{3}-[0-9]{4}'")
+
+    sql, parameters = ak_query_runner.render_template(template, {'state': 'NY', 'country': 'US'})
+
+    assert sql == ("select * from core_user where zip ~ '^[0-9]{5}$' and state = %s "
+                   "and country = %s and phone ~ '[0-9]{3}-[0-9]{4}'")
+    assert parameters == ['NY', 'US']
+
+    with pytest.raises(ValueError, match='state'):
+        ak_query_runner.render_template(template, {'country': 'US'})
+
+
+def test_percent_signs_are_doubled_only_with_bound_parameters():
+    template = "select * from core_user where email like '%@example.org'"
+
+    assert ak_query_runner.render_template(template, {}) == (template, None)
+    assert ak_query_runner.render_template(template + " and id > {id}", {'id': 5}) == (
+        "select * from core_user where email like '%%@example.org' and id > %s", [5])
+
+
+class FailingRedshift:
+    """
+    Records the statements of a merge, failing the first one that matches ``fail_on``.
+    """
+
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.statements = []
+
+    def table_exists(self, table_name):
+        return True
+
+    def copy(self, tbl, table_name, **kwargs):
+        self.statements.append(f"COPY {table_name}")
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def commit(self):
+        self.statements.append("COMMIT")
+
+    def query_with_connection(self, sql, connection, parameters=None, commit=True):
+        self.query(sql, parameters)
+
+    def query(self, sql, parameters=None):
+        sql = ' '.join(sql.split())
+        self.statements.append(sql)
+        if sql.startswith(self.fail_on):
+            raise RuntimeError(f"{sql} failed")
+
+
+@pytest.mark.parametrize('fail_on', ['DELETE', 'INSERT'])
+def test_failed_upsert_merge_drops_the_staging_table(fail_on):
+    rs = FailingRedshift(fail_on)
+
+    with pytest.raises(RuntimeError):
+        ak_query_runner.merge_results(rs, Table([{'id': 1, 'total': 2}]), 'coc_reporting.totals',
+                                      merge='upsert', key='id')
+
+    assert "COMMIT" not in rs.statements
+    assert rs.statements[-1] == "DROP TABLE IF EXISTS coc_reporting.totals_stage"
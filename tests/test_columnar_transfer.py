@@ -0,0 +1,84 @@
+import re
+import datetime
+import contextlib
+import pytest
+
+pytest.importorskip('parsons')
+pyarrow = pytest.importorskip('pyarrow')
+
+import columnar_transfer
+
+
+class LoadDataDB:
+    """
+    Records the ``LOAD DATA`` statement a MySQL load runs and the file it reads.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, parameters):
+        with open(parameters[0], newline='') as f:
+            self.statements.append((sql, f.read()))
+
+    def commit(self):
+        pass
+
+
+def read_load_data(sql, contents):
+    """
+    Read a CSV file the way the ``LOAD DATA`` statement would: fields optionally
+    enclosed in double quotes, doubled quotes inside them, no escape character, and
+    a bare ``NULL`` as NULL.
+    """
+
+    assert "ESCAPED BY ''" in sql
+    assert 'IGNORE 1 LINES' in sql
+    field = re.compile(r'"((?:[^"]|"")*)"|([^,\n]*)')
+
+    rows = []
+    position = contents.index('\n') + 1
+    while position < len(contents):
+        row = []
+        while True:
+            match = field.match(contents, position)
+            if match.group(1) is not None:
+                row.append(match.group(1).replace('""', '"'))
+            else:
+                row.append(None if match.group(2) == 'NULL' else match.group(2))
+            position = match.end() + 1
+            if contents[match.end()] == '\n':
+                break
+        rows.append(row)
+    return rows
+
+
+def test_mysql_load_round_trips_backslashes_nulls_bools_and_timestamps():
+    eastern = datetime.timezone(datetime.timedelta(hours=-5))
+    tbl = pyarrow.table({
+        'id': [1, 2, 3],
+        'path': ['C:\\temp\\new', 'say "hi"\\', ''],
+        'note': ['NULL', 'two\nlines', None],
+        'subscribed': [True, False, None],
+        'updated_at': pyarrow.array([datetime.datetime(2024, 1, 1, 0, 6, 7, tzinfo=eastern),
+                                     datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc),
+                                     None], pyarrow.timestamp('us', tz='UTC')),
+        'created_at': pyarrow.array([datetime.datetime(2023, 6, 1, 12, 30), None, None],
+                                    pyarrow.timestamp('s'))})
+
+    db = LoadDataDB()
+    columnar_transfer.load_arrow(db, 'mysql', tbl, 'ak.core_action')
+
+    [(sql, contents)] = db.statements
+    assert read_load_data(sql, contents) == [
+        ['1', 'C:\\temp\\new', 'NULL', '1', '2024-01-01 05:06:07.000000',
+         '2023-06-01 12:30:00'],
+        ['2', 'say "hi"\\', 'two\nlines', '0', '2024-01-02 00:00:00.000000', None],
+        ['3', '', None, None, None, None]]
@@ -0,0 +1,186 @@
+import os
+import gzip
+import zipfile
+import contextlib
+import pytest
+
+pytest.importorskip('parsons')
+
+import dmarc_script
+
+REPORT_NAMESPACE = 'urn:ietf:params:xml:ns:dmarc-2.0'
+
+
+def report_xml(report_id, ips, namespace=None):
+    """
+    Build a DMARC aggregate report with one ``<record>`` per source IP.
+    """
+
+    xmlns = f' xmlns="{namespace}"' if namespace else ''
+    records = ''.join(
+        f'<record><row><source_ip>{ip}</source_ip><count>{i + 1}</count>'
+        '<policy_evaluated><disposition>None</disposition><dkim>pass</dkim>'
+        '<spf>fail</spf></policy_evaluated></row>'
+        '<identifiers><header_from>Example.org</header_from></identifiers>'
+        '<auth_results><dkim><domain>example.org</domain><result>pass</result></dkim>'
+        '<spf><domain>mail.example.org</domain><result>softfail</result></spf>'
+        '</auth_results></record>'
+        for i, ip in enumerate(ips))
+    return (f'<?xml version="1.0" encoding="UTF-8" ?>\n<feedback{xmlns}>'
+            '<report_metadata><org_name>receiver.example</org_name>'
+            '<email>dmarc@receiver.example</email>'
+            f'<report_id>{report_id}</report_id>'
+            '<date_range><begin>1704067200</begin><end>1704153599</end></date_range>'
+            '</report_metadata>'
+            '<policy_published><domain>example.org</domain><adkim>r</adkim><aspf>s</aspf>'
+            '<p>quarantine</p><sp>none</sp><pct>100</pct></policy_published>'
+            f'{records}</feedback>').encode()
+
+
+@pytest.mark.parametrize('namespace', [None, REPORT_NAMESPACE])
+def test_parse_report_rows_have_the_table_columns_and_types(tmp_path, namespace):
+    path = tmp_path / 'report.xml'
+    path.write_bytes(report_xml('r1', ['192.0.2.1', '2001:0db8:0000:0000:0000:0000:0000:0001'],
+                                namespace=namespace))
+
+    rows = dmarc_script.parse_report_file(str(path))
+
+    # The COPY names its columns, so only the set of columns has to match the table
+    assert [set(r) for r in rows] == [set(dmarc_script.DMARC_COLUMN_TYPES)] * 2
+    assert rows[0] == {'orgname': 'receiver.example',
+                       'email': 'dmarc@receiver.example',
+                       'reportid': 'r1',
+                       'date_range_begin': '2024-01-01 00:00:00',
+                       'date_range_end': '2024-01-01 23:59:59',
+                       'domain': 'example.org',
+                       'adkim': 'r',
+                       'aspf': 's',
+                       'p': 'quarantine',
+                       'sp': 'none',
+                       'pct': 100,
+                       'source_ip': '192.0.2.1',
+                       'disposition': 'none',
+                       'dkim_pass': True,
+                       'spf_pass': False,
+                       'count': 1,
+                       'header_from': 'example.org',
+                       'dkim_domain': 'example.org',
+                       'dkim_result': 'pass',
+                       'spf_domain': 'mail.example.org',
+                       'spf_result': 'softfail'}
+    assert rows[1]['source_ip'] == '2001:db8::1'
+    assert rows[1]['count'] == 2
+
+
+def test_invalid_values_load_as_null(tmp_path):
+    path = tmp_path / 'report.xml'
+    path.write_bytes(report_xml('r1', ['not an ip']).replace(b'<pct>100</pct>', b'<pct>250</pct>'))
+
+    [row] = dmarc_script.parse_report_file(str(path))
+
+    assert row['source_ip'] is None
+    assert row['pct'] is None
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_truncated_report_fails_to_parse(tmp_path, compress):
+    xml = report_xml('r1', ['192.0.2.1', '192.0.2.2'])
+    # Cut off part way through the second record
+    truncated = xml[:xml.rindex(b'<record>') + 40]
+    path = tmp_path / 'report.xml'
+    path.write_bytes(gzip.compress(truncated) if compress else truncated)
+
+    assert dmarc_script.parse_report_file(str(path)) is None
+
+
+def test_corrupt_gzip_fails_to_parse(tmp_path):
+    path = tmp_path / 'report.xml.gz'
+    path.write_bytes(gzip.compress(report_xml('r1', ['192.0.2.1']))[:-20])
+
+    assert dmarc_script.parse_report_file(str(path)) is None
+
+
+class RecordingRedshift:
+    """
+    Records the rows a load copies and the manifest entries it inserts.
+    """
+
+    def __init__(self):
+        self.copied = []
+        self.manifest = []
+
+    def copy(self, tbl, table_name, **kwargs):
+        self.copied.extend(tbl)
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def commit(self):
+        pass
+
+    def query_with_connection(self, sql, connection, parameters=None, commit=True):
+        if 'manifest' in sql:
+            self.manifest.extend(zip(*[iter(parameters)] * 3))
+
+    def query(self, sql, parameters=None):
+        return None
+
+
+def write_corpus(root):
+    """
+    Write plain, gzipped and zipped reports and a truncated one to a local bucket.
+    """
+
+    reports = os.path.join(root, 'dmarc-files', 'reports')
+    os.makedirs(reports)
+    with open(os.path.join(reports, 'plain.xml'), 'wb') as f:
+        f.write(report_xml('plain', ['192.0.2.1']))
+    with open(os.path.join(reports, 'gzipped.xml.gz'), 'wb') as f:
+        f.write(gzip.compress(report_xml('gzipped', ['192.0.2.2', '192.0.2.3'])))
+    with zipfile.ZipFile(os.path.join(reports, 'zipped.zip'), 'w') as archive:
+        archive.writestr('first.xml', report_xml('zipped-1', ['192.0.2.4'],
+                                                 namespace=REPORT_NAMESPACE))
+        archive.writestr('second.xml', report_xml('zipped-2', ['192.0.2.5']))
+    with open(os.path.join(reports, 'truncated.xml'), 'wb') as f:
+        f.write(report_xml('truncated', ['192.0.2.6'])[:200])
+
+
+@pytest.mark.parametrize('parse_processes', [0, 2])
+def test_fetch_and_batch_reports_from_a_local_bucket(tmp_path, parse_processes):
+    write_corpus(str(tmp_path))
+    s3 = dmarc_script.LocalBucket(str(tmp_path))
+    keys = s3.list_keys('dmarc-files', prefix='reports/')
+
+    reports = dict(dmarc_script.fetch_reports(s3, 'dmarc-files', keys,
+                                              parse_processes=parse_processes))
+    assert reports['reports/truncated.xml'] is None
+    assert {k: sorted(r['source_ip'] for r in rows) for k, rows in reports.items() if rows} == {
+        'reports/plain.xml': ['192.0.2.1'],
+        'reports/gzipped.xml.gz': ['192.0.2.2', '192.0.2.3'],
+        'reports/zipped.zip': ['192.0.2.4', '192.0.2.5']}
+
+    # Reports are never split across batches
+    batches = list(dmarc_script.batch_report_rows(
+        ((k, rows) for k, rows in sorted(reports.items()) if rows is not None), max_rows=2))
+    assert [(keys, len(rows)) for keys, rows in batches] == [
+        (['reports/gzipped.xml.gz'], 2),
+        (['reports/plain.xml', 'reports/zipped.zip'], 3)]
+
+
+def test_load_reports_records_only_loaded_files_in_the_manifest(tmp_path):
+    write_corpus(str(tmp_path))
+    s3 = dmarc_script.LocalBucket(str(tmp_path))
+    keys = s3.list_keys('dmarc-files')
+    rs = RecordingRedshift()
+
+    failed = dmarc_script.load_reports(rs, s3, 'dmarc-files', keys, 'coc_dmarc.dmarc_records',
+                                       manifest_table='coc_dmarc.dmarc_records_manifest',
+                                       batch_rows=2)
+
+    assert failed == ['reports/truncated.xml']
+    assert sorted(r['reportid'] for r in rs.copied) == [
+        'gzipped', 'gzipped', 'plain', 'zipped-1', 'zipped-2']
+    assert sorted(rs.manifest) == sorted(
+        (key, keys[key]['ETag'], keys[key]['Size'])
+        for key in ('reports/plain.xml', 'reports/gzipped.xml.gz', 'reports/zipped.zip'))
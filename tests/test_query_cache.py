@@ -0,0 +1,86 @@
+import pytest
+
+parsons = pytest.importorskip('parsons')
+Table = parsons.Table
+
+import ak_query_runner
+from query_cache import QueryCache
+from sync_state import SyncStateStore
+
+SQL = "select id, name from coc_ak.core_user where created_at >= %s"
+
+
+class CountingDB:
+    """
+    Answers every query with fixed rows and counts the queries that reach it.
+    """
+
+    host = 'localhost'
+    db = 'dev'
+
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, sql, parameters=None):
+        self.queries += 1
+        return Table([{'id': 1, 'name': 'Ada'}, {'id': 2, 'name': 'Grace'}])
+
+
+def sync_core_user(store):
+    store.save_state('mysql://ak/ak', 'countingdb://localhost/dev', 'ak.core_user',
+                     'coc_ak.core_user', watermark='2024-01-01 00:00:00')
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SyncStateStore(str(tmp_path / 'sync_state.db'))
+    sync_core_user(store)
+    return store
+
+
+def test_repeat_query_is_served_from_the_cache(tmp_path, store):
+    db = CountingDB()
+    cache = QueryCache(str(tmp_path / 'cache'), state_store=store)
+
+    first = ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+    second = ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+
+    assert db.queries == 1
+    assert list(second) == list(first) == [{'id': 1, 'name': 'Ada'}, {'id': 2, 'name': 'Grace'}]
+
+    # Other parameters are a different query
+    ak_query_runner.execute_query(db, SQL, ['2024-02-01'], cache=cache)
+    assert db.queries == 2
+
+
+def test_syncing_a_referenced_table_makes_the_cached_result_stale(tmp_path, store):
+    db = CountingDB()
+    cache = QueryCache(str(tmp_path / 'cache'), state_store=store)
+    ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+
+    sync_core_user(store)
+
+    ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+    assert db.queries == 2
+
+
+def test_least_recently_used_results_are_evicted_past_the_size_limit(tmp_path, store):
+    db = CountingDB()
+    cache = QueryCache(str(tmp_path / 'cache'), state_store=store)
+    ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+    entry_bytes = cache.conn.execute("SELECT bytes FROM query_cache").fetchone()[0]
+
+    # Room for two results
+    cache.max_bytes = 2 * entry_bytes
+    ak_query_runner.execute_query(db, SQL, ['2024-01-02'], cache=cache)
+    # Using the first result makes the second the least recently used
+    ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+    ak_query_runner.execute_query(db, SQL, ['2024-01-03'], cache=cache)
+    assert db.queries == 3
+
+    ak_query_runner.execute_query(db, SQL, ['2024-01-01'], cache=cache)
+    ak_query_runner.execute_query(db, SQL, ['2024-01-03'], cache=cache)
+    assert db.queries == 3
+    ak_query_runner.execute_query(db, SQL, ['2024-01-02'], cache=cache)
+    assert db.queries == 4
+    assert cache.conn.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0] == 2
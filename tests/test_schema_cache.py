@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip('parsons')
+
+from schema_cache import SchemaCache
+from sync_state import SyncStateStore
+
+
+class FakeDB:
+    host = 'localhost'
+    db = 'ak'
+    exists = True
+
+    def table_exists(self, table):
+        return self.exists
+
+
+class CountingSchemaCache(SchemaCache):
+    """
+    Serves fixed columns and counts the ``information_schema`` reads.
+    """
+
+    columns = [{'column_name': 'id', 'data_type': 'integer', 'character_maximum_length': None,
+                'numeric_precision': 32, 'numeric_scale': 0},
+               {'column_name': 'name', 'data_type': 'character varying',
+                'character_maximum_length': 255, 'numeric_precision': None,
+                'numeric_scale': None}]
+    reads = 0
+
+    def _read_columns(self, db, table):
+        CountingSchemaCache.reads += 1
+        return self.columns
+
+
+def test_saved_schema_is_reused_until_invalidated_or_expired(tmp_path, monkeypatch):
+    store = SyncStateStore(str(tmp_path / 'state.db'))
+    db = FakeDB()
+    monkeypatch.setattr(CountingSchemaCache, 'reads', 0)
+
+    first = CountingSchemaCache(store).table_schema(db, 'ak.core_user')
+    assert CountingSchemaCache.reads == 1
+
+    # A later run uses the saved schema without reading information_schema
+    second = CountingSchemaCache(store).table_schema(db, 'ak.core_user')
+    assert CountingSchemaCache.reads == 1
+    assert second['columns'] == first['columns'] == ['id', 'name']
+
+    # Altering the table invalidates the saved schema too
+    cache = CountingSchemaCache(store)
+    cache.invalidate(db, 'ak.core_user')
+    CountingSchemaCache(store).table_schema(db, 'ak.core_user')
+    assert CountingSchemaCache.reads == 2
+
+    # An expired schema is read again
+    CountingSchemaCache(store, max_age_seconds=-1).table_schema(db, 'ak.core_user')
+    assert CountingSchemaCache.reads == 3
+
+
+def test_table_dropped_outside_the_sync_does_not_exist(tmp_path, monkeypatch):
+    store = SyncStateStore(str(tmp_path / 'state.db'))
+    db = FakeDB()
+    monkeypatch.setattr(CountingSchemaCache, 'reads', 0)
+    CountingSchemaCache(store).table_schema(db, 'ak.core_user')
+
+    db.exists = False
+    assert not CountingSchemaCache(store).table_exists(db, 'ak.core_user')
+    assert store.get_table_schema('fakedb://localhost/ak', 'ak.core_user') is None